@@ -27,6 +27,7 @@ __all__ = (
     'oclIsTypeOf',
     'registerIsKindOfFunction',
     'registerIsTypeOfFunction',
+    'invalidateTypeTests',
 
     'Collection',
     'Set',
@@ -35,6 +36,9 @@ __all__ = (
     'asSet',
     'asBag',
     'asSeq',
+    'OrderedSet',
+    'asOrderedSet',
+    'Tuple',
 
     'isCollection',
     'asCollection',
@@ -135,18 +139,130 @@ class Invalid(Exception):
         super(Invalid,self).__init__(msg)
 
 
-_OCL_IS_KIND_OF_DELEGATES = []
-_OCL_IS_TYPE_OF_DELEGATES = []
+def _concreteType(value):
+    # type() returns the same type for all instances of old-style classes
+    try:
+        return value.__class__
+    except AttributeError:
+        return type(value)
+
+
+class TypeTestRegistry(object):
+    """
+    Registry of the functions (delegates) implementing oclIsKindOf or
+    oclIsTypeOf for types that are not (only) python classes, for instance
+    modelio metaclasses, java interfaces or stereotypes.
+
+    Each delegate is registered with the kind of type arguments it deals
+    with (e.g. MClass or Stereotype), so only the relevant delegates are
+    called for a given type argument. These delegates are found once per
+    concrete type of type arguments.
+
+    A delegate is cacheable if its result depends only on the type of the
+    value and on the type argument. The results of cacheable delegates are
+    memoized per (type(value), aType) pair. invalidate() must be called
+    when the metamodel changes.
+
+    Examples:
+        >>> class Tag(object):
+        ...     def __init__(self,name): self.name = name
+        >>> calls = []
+        >>> def hasTag(value,tag):
+        ...     calls.append(tag.name)
+        ...     return tag.name == type(value).__name__
+        >>> r = TypeTestRegistry()
+        >>> r.register(hasTag,typeKind=Tag,cacheable=True)
+        >>> intTag = Tag('int')
+        >>> r.test(3,intTag), r.test(4,intTag), r.test(3,Tag('str'))
+        (True, True, False)
+        >>> r.test(3,int), calls
+        (False, ['int', 'str'])
+        >>> r.invalidate()
+        >>> r.test(3,intTag), calls
+        (True, ['int', 'str', 'int'])
+    """
+    def __init__(self):
+        # list of (delegate,typeKind,cacheable)
+        self.delegates = []
+        self._dispatch = {}
+        self._results = {}
+
+    def register(self,function,typeKind=None,cacheable=False):
+        """
+        Register a delegate.
+
+        :param function: The function taking a value and a type argument.
+        :type function: (any,any) -> bool
+        :param typeKind: The class (or tuple of classes) of the type
+            arguments the function deals with. None for all.
+        :param cacheable: Whether the result of the function depends only
+            on the type of the value and on the type argument.
+        """
+        if function not in [d[0] for d in self.delegates]:
+            self.delegates.append((function,typeKind,cacheable))
+            self._dispatch = {}
+            self.invalidate()
 
-def registerIsKindOfFunction(function):
-    global _OCL_IS_KIND_OF_DELEGATES
-    if function not in _OCL_IS_KIND_OF_DELEGATES:
-        _OCL_IS_KIND_OF_DELEGATES.append(function)
+    def invalidate(self):
+        """
+        Forget the memoized results.
+        """
+        self._results = {}
 
-def registerIsTypeOfFunction(function):
-    global _OCL_IS_TYPE_OF_DELEGATES
-    if function not in _OCL_IS_TYPE_OF_DELEGATES:
-        _OCL_IS_TYPE_OF_DELEGATES.append(function)
+    def _delegatesFor(self,aType):
+        kindOfType = _concreteType(aType)
+        try:
+            return self._dispatch[kindOfType]
+        except KeyError:
+            selected = [(f,c) for (f,k,c) in self.delegates
+                        if k is None or isinstance(aType,k)]
+            entry = (tuple([f for (f,c) in selected]),
+                     all([c for (f,c) in selected]))
+            self._dispatch[kindOfType] = entry
+            return entry
+
+    def test(self,value,aType):
+        """
+        Return True if one of the delegates returns True.
+        """
+        (functions,cacheable) = self._delegatesFor(aType)
+        if not functions:
+            return False
+        if cacheable:
+            key = (_concreteType(value),aType)
+            try:
+                return self._results[key]
+            except KeyError:
+                pass
+            except TypeError:
+                # the type argument is not hashable
+                cacheable = False
+        result = False
+        for function in functions:
+            if function(value,aType):
+                result = True
+                break
+        if cacheable:
+            self._results[key] = result
+        return result
+
+
+IS_KIND_OF_REGISTRY = TypeTestRegistry()
+IS_TYPE_OF_REGISTRY = TypeTestRegistry()
+
+def registerIsKindOfFunction(function,typeKind=None,cacheable=False):
+    IS_KIND_OF_REGISTRY.register(function,typeKind,cacheable)
+
+def registerIsTypeOfFunction(function,typeKind=None,cacheable=False):
+    IS_TYPE_OF_REGISTRY.register(function,typeKind,cacheable)
+
+def invalidateTypeTests():
+    """
+    Forget the results memoized by oclIsKindOf and oclIsTypeOf. To be
+    called when the metamodel changes.
+    """
+    IS_KIND_OF_REGISTRY.invalidate()
+    IS_TYPE_OF_REGISTRY.invalidate()
 
 
 def oclIsKindOf(value1,value2):
@@ -186,10 +302,7 @@ def oclIsKindOf(value1,value2):
     if inspect.isclass(value2) and isinstance(value1, value2):
         return True
     else:
-        for is_kind_of_function in _OCL_IS_KIND_OF_DELEGATES:
-            if is_kind_of_function(value1, value2):
-                return True
-        return False
+        return IS_KIND_OF_REGISTRY.test(value1, value2)
 
 
 def oclIsTypeOf(value1,value2):
@@ -217,10 +330,7 @@ def oclIsTypeOf(value1,value2):
     if type(value1) == value2:
         return True
     else:
-        for is_type_of_function in _OCL_IS_TYPE_OF_DELEGATES:
-            if is_type_of_function(value1, value2):
-                return True
-        return False
+        return IS_TYPE_OF_REGISTRY.test(value1, value2)
 
 
 def evaluate(value,expression):
@@ -259,26 +369,13 @@ def evaluate(value,expression):
         25
 
     """
-    if callable(expression):
-        return expression(value)
-    elif isinstance(expression,(str,unicode)):
-        try:
-            r = getattr(value,expression)
-        except AttributeError:
-            if '_' in expression:
-                _ = value
-                return eval(expression)
-            else:
-                msg = "evaluate(): %s is not an attribute of the type %s" \
-                    % (expression,type(value))
-                raise Invalid(msg)
-        if callable(r):
-            return r()
-        else:
-            return r
+    return compileExpression(expression)(value)
 
 def evaluatePredicate(value,predicate):
-    r = evaluate(value,predicate)
+    return _checkPredicateResult(compileExpression(predicate)(value))
+
+
+def _checkPredicateResult(r):
     t = type(r)
     if t is not bool:
         msg = "Predicate expected. Returned a value of type" \
@@ -288,6 +385,675 @@ def evaluatePredicate(value,predicate):
         return r
 
 
+def compileExpression(expression):
+    """
+    Return a function computing the expression on a given value.
+
+    Callables are returned unchanged. Strings are compiled only once thanks
+    to EXPRESSION_CACHE, so that collection operations can resolve their
+    expression before iterating over their elements.
+
+    Errors in the expression are therefore raised eagerly: an operation
+    given a string with a syntax error, or a value that is neither a
+    callable nor a string, fails even if the collection is empty (it used
+    to fail only when the expression was evaluated on an element).
+
+    :param expression: A callable or a string expression.
+    :type expression: X->Y|str
+    :return: A function evaluating the expression.
+    :rtype: X->Y
+
+    Examples:
+        >>> compileExpression(len)('hello')
+        5
+        >>> compileExpression('_ * 2')(21)
+        42
+        >>> compileExpression('upper')('hello')
+        'HELLO'
+        >>> Set().select('_ >')
+        Traceback (most recent call last):
+          ...
+        SyntaxError: invalid syntax
+        >>> Set().collect(3)
+        Traceback (most recent call last):
+          ...
+        Invalid: evaluate(): 3 is neither a callable nor a string expression
+    """
+    if callable(expression):
+        return expression
+    elif isinstance(expression,basestring):
+        return EXPRESSION_CACHE.compile(expression)
+    else:
+        msg = "evaluate(): %s is neither a callable nor a string expression" \
+            % (expression,)
+        raise Invalid(msg)
+
+
+def compilePredicate(predicate):
+    """
+    Return a function computing the predicate on a given value and checking
+    that the result is a boolean. The function is cached for strings, as in
+    compileExpression, and errors are raised eagerly in the same way.
+
+    :param predicate: A callable or a string expression returning a boolean.
+    :type predicate: X->bool|str
+    :return: A function evaluating the predicate.
+    :rtype: X->bool
+
+    Examples:
+        >>> compilePredicate('_ > 2')(3)
+        True
+        >>> compilePredicate('_ + 2')(3)
+        Traceback (most recent call last):
+          ...
+        Invalid: Predicate expected. Returned a value of type <type 'int'> instead of a boolean
+    """
+    if isinstance(predicate,basestring):
+        return EXPRESSION_CACHE.compile(predicate,predicate=True)
+    return _checkedPredicate(compileExpression(predicate))
+
+
+def _checkedPredicate(function):
+    return lambda value: _checkPredicateResult(function(value))
+
+
+import re
+import threading
+from collections import OrderedDict
+
+_IDENTIFIER = re.compile('[_A-Za-z][_a-zA-Z0-9]*$')
+
+
+class ExpressionCache(object):
+    """
+    Bounded and thread-safe cache of compiled string expressions.
+
+    A string expression is either the name of an attribute or method (e.g.
+    'name' or 'isAbstract') or a python expression where '_' denotes the
+    value (e.g. '_.isAbstract()'). Each string is compiled only once into a
+    function. The least recently used functions are evicted when more than
+    maxSize expressions are stored.
+
+    Examples:
+        >>> cache = ExpressionCache(maxSize=2)
+        >>> cache.compile('_+1')(1)
+        2
+        >>> cache.compile('_+1')(10)
+        11
+        >>> cache.compile('_+2')(1)
+        3
+        >>> cache.compile('_+3')(1)
+        4
+        >>> cache.stats() == {'hits': 1, 'misses': 3, 'evictions': 1, \
+                              'size': 2, 'maxSize': 2}
+        True
+    """
+    def __init__(self,maxSize=1024):
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def compile(self,expression,predicate=False):
+        """
+        Return the function corresponding to the string expression. If
+        predicate is True the function also checks that the result is a
+        boolean (see compilePredicate).
+        Raise SyntaxError if the expression is not a valid python
+        expression.
+        """
+        def newFunction():
+            function = self._newFunction(expression)
+            return _checkedPredicate(function) if predicate else function
+        return self.lookup((expression,predicate),newFunction)
+
+    def lookup(self,key,compute):
+        """
+        Return the value cached for the key. If there is none, it is
+        computed with compute() and cached. This allows other compiled forms
+        of expressions (navigation paths, iterate bodies, ...) to be cached
+        in the same way.
+        """
+        with self._lock:
+            value = self._values.pop(key,None)
+            if value is not None:
+                self.hits += 1
+                self._values[key] = value
+                return value
+            self.misses += 1
+        # compute outside the lock; two threads may compute the same
+        # value but this is harmless.
+        value = compute()
+        with self._lock:
+            self._values[key] = value
+            while len(self._values) > self.maxSize:
+                self._values.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._values),
+                'maxSize': self.maxSize,
+            }
+
+    @classmethod
+    def _newFunction(cls,expression):
+        if '_' in expression:
+            # The expression is evaluated within the globals of this
+            # module, as it was the case with eval.
+            code = eval('lambda _: (\n%s\n)' % expression, globals())
+        else:
+            code = None
+        if _IDENTIFIER.match(expression):
+            return cls._newAttributeFunction(expression,code)
+        elif code is not None:
+            return code
+        else:
+            def notAnAttribute(value):
+                msg = "evaluate(): %s is not an attribute of the type %s" \
+                    % (expression,type(value))
+                raise Invalid(msg)
+            return notAnAttribute
+
+    @staticmethod
+    def _newAttributeFunction(name,code):
+        def attribute(value):
+            try:
+                r = getattr(value,name)
+            except AttributeError:
+                if code is not None:
+                    return code(value)
+                else:
+                    msg = "evaluate(): %s is not an attribute of the type %s" \
+                        % (name,type(value))
+                    raise Invalid(msg)
+            if callable(r):
+                return r()
+            else:
+                return r
+        return attribute
+
+
+EXPRESSION_CACHE = ExpressionCache()
+
+
+#------------------------------------------------------------------------------
+#   Navigation
+#------------------------------------------------------------------------------
+
+import operator
+
+# Accessors of the navigation paths, see _navigationPath
+_NAVIGATION_PATHS = ExpressionCache()
+_IMPLICIT_NAVIGATION = True
+
+
+def useImplicitNavigation(enabled=True):
+    """
+    Enable or disable the navigation through attributes on collections
+    (e.g. classes.ownedAttribute). When disabled, an unknown attribute on a
+    collection raises AttributeError instead of silently collecting the
+    attribute on all elements; navigate() must then be used explicitly.
+
+    Examples:
+        >>> useImplicitNavigation(False)
+        >>> Seq(1j).imag
+        Traceback (most recent call last):
+          ...
+        AttributeError: Collections have no attribute 'imag'. Use navigate('imag').
+        >>> Seq(1j).navigate('imag')
+        Seq(1.0)
+        >>> useImplicitNavigation()
+        >>> Seq(1j).imag
+        Seq(1.0)
+    """
+    global _IMPLICIT_NAVIGATION
+    _IMPLICIT_NAVIGATION = enabled
+
+
+def _navigationPath(path):
+    # Return the tuple of accessors for a dotted path. Cached per path.
+    return _NAVIGATION_PATHS.lookup(path,lambda: _newNavigationPath(path))
+
+
+def _newNavigationPath(path):
+    names = path.split('.')
+    for name in names:
+        if not _IDENTIFIER.match(name):
+            raise Invalid('Invalid navigation path: %r' % path)
+    return tuple([operator.attrgetter(name) for name in names])
+
+
+#------------------------------------------------------------------------------
+#   Iterate
+#------------------------------------------------------------------------------
+
+import ast
+import copy
+import numbers
+
+# Compiled string bodies of iterate, see _compileIterateBody
+_ITERATE_BODIES = ExpressionCache()
+
+
+class _IterateBody(object):
+    """
+    Compiled body of an iterate operation. The shape is either 'generic',
+    or one of the shapes that are executed without calling the body at
+    each step:
+
+    * 'sum':       acc + e  or  e + acc
+    * 'including': acc.including(e)
+    * 'max':       max(acc,e)  or  max(e,acc)
+    * 'min':       min(acc,e)  or  min(e,acc)
+
+    where the expression e does not use the accumulator. In this case
+    'function' is the function computing e from the element. 'generic' is
+    always the function of the element and the accumulator.
+    """
+    def __init__(self,generic,shape='generic',function=None,
+                 accumulatorFirst=True):
+        self.generic = generic
+        self.shape = shape
+        self.function = function
+        self.accumulatorFirst = accumulatorFirst
+
+
+def _usesAccumulator(node):
+    for n in ast.walk(node):
+        if isinstance(n,ast.Name) and n.id == 'acc':
+            return True
+    return False
+
+def _isAccumulator(node):
+    return isinstance(node,ast.Name) and node.id == 'acc'
+
+def _elementFunction(node,name='_'):
+    # Compile the expression node into a function of the given variable
+    function = ast.Lambda(
+        args=ast.arguments(
+            args=[ast.Name(id=name,ctx=ast.Param())],
+            vararg=None,kwarg=None,defaults=[]),
+        body=node)
+    expression = ast.fix_missing_locations(ast.Expression(body=function))
+    return eval(compile(expression,'<expression>','eval'),globals())
+
+def _bodyShape(tree):
+    # Return (shape,elementNode,accumulatorFirst) or None
+    if isinstance(tree,ast.BinOp) and isinstance(tree.op,ast.Add):
+        if _isAccumulator(tree.left) and not _usesAccumulator(tree.right):
+            return ('sum',tree.right,True)
+        if _isAccumulator(tree.right) and not _usesAccumulator(tree.left):
+            return ('sum',tree.left,False)
+    elif isinstance(tree,ast.Call) and len(tree.args) == 2 \
+            and not (tree.keywords or tree.starargs or tree.kwargs) \
+            and isinstance(tree.func,ast.Name) \
+            and tree.func.id in ('max','min'):
+        (a,b) = tree.args
+        if _isAccumulator(a) and not _usesAccumulator(b):
+            return (tree.func.id,b,True)
+        if _isAccumulator(b) and not _usesAccumulator(a):
+            return (tree.func.id,a,False)
+    elif isinstance(tree,ast.Call) and len(tree.args) == 1 \
+            and not (tree.keywords or tree.starargs or tree.kwargs) \
+            and isinstance(tree.func,ast.Attribute) \
+            and tree.func.attr == 'including' \
+            and _isAccumulator(tree.func.value) \
+            and not _usesAccumulator(tree.args[0]):
+        return ('including',tree.args[0],True)
+    return None
+
+def _compileIterateBody(body):
+    """
+    Return the _IterateBody corresponding to a body. Callable bodies are
+    taken as is, with the element and the accumulator as parameters.
+    String bodies are python expressions where '_' denotes the element and
+    'acc' the accumulator. They are compiled only once.
+    """
+    if callable(body):
+        return _IterateBody(body)
+    if not isinstance(body,basestring):
+        raise Invalid('iterate(): body expected, but found %s' % body)
+    return _ITERATE_BODIES.lookup(body,lambda: _newIterateBody(body))
+
+def _newIterateBody(body):
+    try:
+        tree = ast.parse(body.strip(),mode='eval').body
+    except SyntaxError:
+        raise Invalid('iterate(): invalid body %r' % body)
+    generic = eval('lambda _,acc: (\n%s\n)' % body, globals())
+    shape = _bodyShape(tree)
+    if shape is None:
+        return _IterateBody(generic)
+    else:
+        (kind,node,accumulatorFirst) = shape
+        return _IterateBody(
+            generic,kind,_elementFunction(node),accumulatorFirst)
+
+def _iterate(pairs,body,initial):
+    # Fold the body over (element,count) pairs
+    compiled = _compileIterateBody(body)
+    function = compiled.function
+    shape = compiled.shape
+    acc = initial
+    if shape == 'sum' and isinstance(initial,numbers.Number):
+        # n occurrences of the same element add n times the same value
+        if compiled.accumulatorFirst:
+            for (e,n) in pairs:
+                acc = acc + (function(e) if n == 1 else function(e)*n)
+        else:
+            for (e,n) in pairs:
+                acc = (function(e) if n == 1 else function(e)*n) + acc
+        return acc
+    elif shape in ('max','min'):
+        # the extremum does not depend on the number of occurrences
+        extremum = max if shape == 'max' else min
+        if compiled.accumulatorFirst:
+            for (e,n) in pairs:
+                acc = extremum(acc,function(e))
+        else:
+            for (e,n) in pairs:
+                acc = extremum(function(e),acc)
+        return acc
+    elif shape == 'including' and isinstance(initial,Collection):
+        # all values are added at once, with a single copy
+        if isinstance(initial,Bag):
+            values = Counter()
+            for (e,n) in pairs:
+                values[function(e)] += n
+        else:
+            values = []
+            for (e,n) in pairs:
+                v = function(e)
+                values.extend([v]*n if n > 1 else (v,))
+        return initial.includingAll(values)
+    else:
+        # Also used when the initial value does not fit the shape
+        generic = compiled.generic
+        for (e,n) in pairs:
+            for _ in xrange(n):
+                acc = generic(e,acc)
+        return acc
+
+
+#------------------------------------------------------------------------------
+#   Quantifiers with several variables
+#------------------------------------------------------------------------------
+
+import itertools
+
+# Compiled string predicates on k-tuples, see _compileTuplePredicate
+_TUPLE_PREDICATES = ExpressionCache()
+
+
+class _TuplePredicate(object):
+    """
+    Compiled predicate on k-tuples of elements.
+
+    For string predicates on pairs, the following shapes are recognized,
+    where f and g are expressions of one variable only:
+
+    * 'equal':      f(_1) == g(_2)
+    * 'different':  f(_1) != g(_2)
+    * 'unique':     _1 == _2 or f(_1) != f(_2)
+                    implies(_1 != _2, f(_1) != f(_2))
+                    (_1 != _2) >>implies>> (f(_1) != f(_2))
+                    or the same with 'is' / 'is not'
+
+    Quantifiers over these shapes are answered with hash tables on the
+    keys f and g instead of enumerating all pairs.
+    """
+    def __init__(self,function,shape=None,keys=None,identity=False):
+        self.function = function
+        self.shape = shape
+        self.keys = keys
+        # for 'unique': whether the guard compares elements with 'is'
+        self.identity = identity
+
+
+def _variablesOf(node):
+    return set(n.id for n in ast.walk(node)
+               if isinstance(n,ast.Name) and n.id in ('_1','_2'))
+
+def _isVariable(node,name):
+    return isinstance(node,ast.Name) and node.id == name
+
+def _singleComparison(node,operators):
+    return (isinstance(node,ast.Compare) and len(node.ops) == 1
+            and isinstance(node.ops[0],operators))
+
+def _keySides(comparison):
+    # Return the expressions of _1 and of _2 compared, or None
+    (left,right) = (comparison.left,comparison.comparators[0])
+    (leftVariables,rightVariables) = (_variablesOf(left),_variablesOf(right))
+    if leftVariables == set(['_1']) and rightVariables == set(['_2']):
+        return (left,right)
+    elif leftVariables == set(['_2']) and rightVariables == set(['_1']):
+        return (right,left)
+    else:
+        return None
+
+def _isGuard(node,operators):
+    # _1 op _2 or _2 op _1
+    return (_singleComparison(node,operators)
+            and set([getattr(node.left,'id',None),
+                     getattr(node.comparators[0],'id',None)])
+                == set(['_1','_2']))
+
+class _Renamer(ast.NodeTransformer):
+    """
+    Rename the variables of an expression according to a dictionary. The
+    occurrences bound by a nested lambda or comprehension are not renamed.
+    """
+    def __init__(self,names):
+        self.names = names
+
+    def visit_Name(self,node):
+        if node.id in self.names:
+            return ast.copy_location(
+                ast.Name(id=self.names[node.id],ctx=node.ctx),node)
+        return node
+
+    def visit_Lambda(self,node):
+        bound = set(n.id for n in ast.walk(node.args)
+                    if isinstance(n,ast.Name))
+        bound.update([node.args.vararg,node.args.kwarg])
+        return self._visitScope(node,bound)
+
+    def visit_comprehension(self,node):
+        # generators are handled by _visitComprehension
+        return node
+
+    def _visitComprehension(self,node):
+        bound = set(n.id for generator in node.generators
+                    for n in ast.walk(generator.target)
+                    if isinstance(n,ast.Name))
+        return self._visitScope(node,bound)
+
+    visit_ListComp = _visitComprehension
+    visit_SetComp = _visitComprehension
+    visit_DictComp = _visitComprehension
+    visit_GeneratorExp = _visitComprehension
+
+    def _visitScope(self,node,bound):
+        if bound & set(self.names):
+            # keep the whole scope unchanged; this is only conservative
+            return node
+        for generator in getattr(node,'generators',()):
+            self.generic_visit(generator)
+        return self.generic_visit(node)
+
+def _sameExpression(f,g,names):
+    # Whether f is g once the variables of g are renamed
+    renamed = _Renamer(names).visit(copy.deepcopy(g))
+    return ast.dump(f) == ast.dump(renamed)
+
+def _implication(tree):
+    # Return (premise,conclusion) for implies(p,c) or (p) >>implies>> (c)
+    if (isinstance(tree,ast.Call) and _isVariable(tree.func,'implies')
+            and len(tree.args) == 2
+            and not (tree.keywords or tree.starargs or tree.kwargs)):
+        return tuple(tree.args)
+    if (isinstance(tree,ast.BinOp) and isinstance(tree.op,ast.RShift)
+            and isinstance(tree.left,ast.BinOp)
+            and isinstance(tree.left.op,ast.RShift)
+            and _isVariable(tree.left.right,'implies')):
+        return (tree.left.left,tree.right)
+    return None
+
+def _pairShape(tree):
+    # Return (shape,(f,g),identity) or None
+    if _singleComparison(tree,(ast.Eq,ast.NotEq)):
+        sides = _keySides(tree)
+        if sides is not None:
+            shape = 'equal' if isinstance(tree.ops[0],ast.Eq) else 'different'
+            return (shape,sides,False)
+        return None
+    if isinstance(tree,ast.BoolOp) and isinstance(tree.op,ast.Or) \
+            and len(tree.values) == 2:
+        (guard,conclusion) = tree.values
+        if _isGuard(guard,ast.Eq):
+            identity = False
+        elif _isGuard(guard,ast.Is):
+            identity = True
+        else:
+            return None
+    else:
+        implication = _implication(tree)
+        if implication is None:
+            return None
+        (guard,conclusion) = implication
+        if _isGuard(guard,ast.NotEq):
+            identity = False
+        elif _isGuard(guard,ast.IsNot):
+            identity = True
+        else:
+            return None
+    if not _singleComparison(conclusion,ast.NotEq):
+        return None
+    sides = _keySides(conclusion)
+    if sides is None:
+        return None
+    # the same key must be used on both sides
+    (f,g) = sides
+    if not _sameExpression(f,g,{'_2':'_1'}):
+        return None
+    return ('unique',sides,identity)
+
+def _compileTuplePredicate(predicate,arity):
+    """
+    Return the _TuplePredicate corresponding to a predicate on k-tuples.
+    String predicates are python expressions where _1, _2, ... denote the
+    elements of the tuple. They are compiled only once.
+    """
+    if callable(predicate):
+        return _TuplePredicate(
+            lambda *values: _checkPredicateResult(predicate(*values)))
+    if not isinstance(predicate,basestring):
+        raise Invalid('Predicate expected, but found %s' % predicate)
+    return _TUPLE_PREDICATES.lookup(
+        (predicate,arity),lambda: _newTuplePredicate(predicate,arity))
+
+def _newTuplePredicate(predicate,arity):
+    try:
+        tree = ast.parse(predicate.strip(),mode='eval').body
+    except SyntaxError:
+        raise Invalid('Invalid predicate %r' % predicate)
+    parameters = ','.join(['_%i' % (i+1) for i in range(arity)])
+    function = eval('lambda %s: (\n%s\n)' % (parameters,predicate),
+                    globals())
+    checked = lambda *values: _checkPredicateResult(function(*values))
+    shape = _pairShape(tree) if arity == 2 else None
+    if shape is None:
+        return _TuplePredicate(checked)
+    else:
+        ((kind,(f,g),identity)) = shape
+        return _TuplePredicate(
+            checked,kind,
+            (_elementFunction(f,'_1'),_elementFunction(g,'_2')),
+            identity)
+
+def _existsEqualKeys(elements,f,g):
+    keys = set(g(e) for e in elements)
+    for e in elements:
+        if f(e) in keys:
+            return True
+    return False
+
+def _allEqualKeys(elements,f,g):
+    if not elements:
+        return True
+    keys = set(f(e) for e in elements)
+    return len(keys) == 1 and keys == set(g(e) for e in elements)
+
+def _uniqueKeys(elements,f,identity):
+    # True if elements that are not the same have different keys
+    firsts = {}
+    for e in elements:
+        key = f(e)
+        if key in firsts:
+            other = firsts[key]
+            if not (e is other if identity else e == other):
+                return False
+        else:
+            firsts[key] = e
+    return True
+
+def _quantify(pairs,predicate,arity,symmetric,universal):
+    # forAll (universal) or exists over the k-tuples of elements. With
+    # bags each value is considered once, as several occurrences of the
+    # same value give the same tuples of values.
+    compiled = _compileTuplePredicate(predicate,arity)
+    elements = [e for (e,n) in pairs]
+    if compiled.shape is not None:
+        (f,g) = compiled.keys
+        try:
+            if compiled.shape == 'equal':
+                if universal:
+                    return _allEqualKeys(elements,f,g)
+                else:
+                    return _existsEqualKeys(elements,f,g)
+            elif compiled.shape == 'different':
+                if universal:
+                    return not _existsEqualKeys(elements,f,g)
+                else:
+                    return not _allEqualKeys(elements,f,g)
+            elif universal:
+                return _uniqueKeys(elements,f,compiled.identity)
+        except TypeError:
+            # unhashable keys: enumerate the tuples
+            pass
+    if symmetric:
+        tuples = itertools.combinations_with_replacement(elements,arity)
+    else:
+        tuples = itertools.product(elements,repeat=arity)
+    function = compiled.function
+    if universal:
+        for values in tuples:
+            if not function(*values):
+                return False
+        return True
+    else:
+        for values in tuples:
+            if function(*values):
+                return True
+        return False
+
+
 def flatten(value):
     """
     Return an OCL collection with all the elements at the first level.
@@ -296,17 +1062,47 @@ def flatten(value):
     :rtype value: iterable[iterable]
     :return: A flatten collection.
     :rtype: Seq
+
+    Examples:
+        >>> flatten([1,[2,(3,4)],[]])
+        [1, 2, 3, 4]
+        >>> flatten(Seq(Seq(1),Set(2))) == Seq(1,2)
+        True
+        >>> flatten(3)
+        [3]
     """
-    try:
+    if hasattr(value,'flatten'):
         return value.flatten()
-    except NameError:
-        if isCollection(value):
-            flat = []
-            for e in value:
-                flat.extend(flatten(e))
-            return flat
+    elif isCollection(value):
+        return list(_leaves(value))
+    else:
+        return [value]
+
+
+def _elementsOf(value):
+    if isinstance(value,Counter):
+        return value.elements()
+    else:
+        return iter(value)
+
+
+def _leaves(value):
+    """
+    Iterate over the elements of a collection that are not collections
+    themselves, at any level of nesting. The order of elements is kept.
+    The iteration is done without recursion and without building any
+    intermediate collection.
+    """
+    iterators = [_elementsOf(value)]
+    while iterators:
+        for e in iterators[-1]:
+            if isCollection(e):
+                iterators.append(_elementsOf(e))
+                break
+            else:
+                yield e
         else:
-            return [value]
+            iterators.pop()
 
 #==============================================================================
 #                              Collections
@@ -317,14 +1113,62 @@ from abc import ABCMeta, abstractmethod
 
 
 
-# noinspection PyClassicStyleClass
-class GenericCollection:  # old-class style required
+from collections import deque
+
+
+class _VisitedSet(object):
+    """
+    Set of values already visited during a traversal. Hashable values are
+    stored in a set, others are tracked by identity.
+    """
+    def __init__(self):
+        self.hashable = set()
+        self.unhashable = {}
+
+    def add(self,value):
+        """ Add the value. Return False if it was already visited. """
+        try:
+            if value in self.hashable:
+                return False
+            self.hashable.add(value)
+        except TypeError:
+            if id(value) in self.unhashable:
+                return False
+            # keep a reference on the value so that its id is not reused
+            self.unhashable[id(value)] = value
+        return True
+
+
+import functools
+
+
+def _parallelizable(method):
+    """
+    Decorator adding the 'parallel' and 'executor' options to an operation
+    taking an expression. Without these options the operation is called
+    directly, otherwise it is executed by pyalaocl.parallel.
+    """
+    @functools.wraps(method)
+    def operation(self,expression,parallel=None,executor=None):
+        if executor is None and not parallel:
+            return method(self,expression)
+        from pyalaocl import parallel as _parallel
+        return _parallel.run(self,method,expression,parallel,executor)
+    return operation
+
+
+class GenericCollection(object):
     """
     Class used both to define brand new OCL collection (classes under
-    Collection) but also to define JavaCollectionExtension. Due to restriction
-    of class instrumentation we use old-style class, hence object is not the
-    base class.
+    Collection) but also to define JavaCollectionExtension. It has no slots,
+    so that collections can use __slots__. Due to restriction of class
+    instrumentation, JavaCollectionExtension must be an old-style class:
+    the operations are copied into it (see _copyGenericOperations) and the
+    java collection classes are registered as virtual subclasses.
     """
+    __metaclass__ = ABCMeta
+    __slots__ = ()
+
     def __init__(self):
         pass
 
@@ -409,6 +1253,7 @@ class GenericCollection:  # old-class style required
         return self.union(anyCollection)
 
 
+    @_parallelizable
     def any(self,predicate):
         """
         Return any element in the collection that satisfy the predicate.
@@ -430,9 +1275,10 @@ class GenericCollection:  # old-class style required
               ...
             Invalid: .any(...) failed: No such element.
         """
+        test = compilePredicate(predicate)
         # noinspection PyTypeChecker
         for e in self:
-            if evaluatePredicate(e,predicate):
+            if test(e):
                 return e
         raise Invalid(".any(...) failed: No such element.")
 
@@ -460,6 +1306,7 @@ class GenericCollection:  # old-class style required
     def selectByType(self,aType):
         return self.select(lambda e:oclIsTypeOf(e,aType))
 
+    @_parallelizable
     def reject(self,predicate):
         """
         Discard from the set all elements that satisfy the predicate.
@@ -475,16 +1322,36 @@ class GenericCollection:  # old-class style required
                      == Set(Set())
             True
         """
-        return self.select(lambda e:not evaluatePredicate(e,predicate))
+        test = compilePredicate(predicate)
+        return self.select(lambda e:not test(e))
 
+    @_parallelizable
     def collect(self,expression):
-        return self.collectNested(expression).flatten()
+        """
+        Return the flatten collection of the values of the expression.
+
+        This is equivalent to collectNested(expression).flatten() but
+        nested collections are flatten on the fly, so the intermediate
+        collection of collections is never built.
+
+        Examples:
+            >>> Set(1,2).collect(lambda e:Seq(e,Set(e*10))) == Bag(1,10,2,20)
+            True
+            >>> Seq(1,2).collect(lambda e:[e,e]) == Seq(1,1,2,2)
+            True
+        """
+        return self.lazy().collect(expression).asCollection()
 
     def __getattr__(self,name):
         """
+        Navigate through the attribute, as navigate(name) does. Each step of
+        a chain like classes.ownedAttribute.type builds its own collection:
+        use navigate('ownedAttribute.type') or lazy() to walk the whole path
+        in a single pass. The same applies to chains through the fields of
+        Tuples.
 
-        :param name:
-        :return:
+        :param name: The name of the attribute.
+        :return: A Seq if this collection is a Seq, a Bag otherwise.
 
         Examples:
             >>> class P(object):
@@ -499,8 +1366,44 @@ class GenericCollection:  # old-class style required
             >>> Set(P1,P4).a == Bag(1,4)
             True
         """
-        return self.collect(lambda e:getattr(e,name))
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if not _IMPLICIT_NAVIGATION:
+            msg = "Collections have no attribute '%s'. Use navigate('%s')."
+            raise AttributeError(msg % (name,name))
+        return self.navigate(name)
+
+    def navigate(self,path):
+        """
+        Return the flatten collection of the values found along a path of
+        attributes, as a sequence of collect would do. The path is walked
+        in a single pass, so only the final collection is built.
+        Accessors are compiled once per path.
+
+        :param path: Names of attributes separated by dots.
+        :type path: str
+        :return: A Seq if this collection is a Seq, a Bag otherwise.
+        :rtype: Collection
+
+        Examples:
+            >>> class P(object):
+            ...     def __init__(self,name,*friends):
+            ...         self.name = name
+            ...         self.friends = Set(*friends)
+            >>> a, b = P('a'), P('b')
+            >>> Seq(P('c',a),P('d',b,b)).navigate('friends.name') \
+                    == Seq('a','b')
+            True
+            >>> Set(P('e')).navigate('friends.name')
+            Bag()
+            >>> Set(a).navigate('name.1')
+            Traceback (most recent call last):
+              ...
+            Invalid: Invalid navigation path: 'name.1'
+        """
+        return self.lazy().navigate(path).asCollection()
 
+    @_parallelizable
     def forAll(self,predicate):
         """
         Return True if the predicate given as parameter is satisfied by all
@@ -523,12 +1426,14 @@ class GenericCollection:  # old-class style required
             >>> Seq(Bag(1),Set(2),Seq(3)).forAll(lambda e:e.size()==1)
             True
         """
+        test = compilePredicate(predicate)
         # noinspection PyTypeChecker
         for e in self:
-            if not evaluatePredicate(e,predicate):
+            if not test(e):
                 return False
         return True
 
+    @_parallelizable
     def exists(self,predicate):
         """
         Return True if the predicate given as parameter is satisfied by at
@@ -550,12 +1455,82 @@ class GenericCollection:  # old-class style required
             >>> Bag(Set(),Set(),Set(2),Set(3)).exists(lambda e:e.size()==1)
             True
         """
+        test = compilePredicate(predicate)
         # noinspection PyTypeChecker
         for e in self:
-            if evaluatePredicate(e,predicate):
+            if test(e):
                 return True
         return False
 
+    def forAll2(self,predicate,symmetric=False):
+        """
+        Return True if the predicate is satisfied by all pairs of elements,
+        as forAll(e1,e2|...) in OCL. See forAllN.
+
+        Examples:
+            >>> Set(1,2,3).forAll2(lambda a,b:a+b < 7)
+            True
+            >>> Set('ab','cd','ef').forAll2('_1 == _2 or _1[0] != _2[0]')
+            True
+            >>> Seq('ab','cd','ae').forAll2( \
+                    '(_1 != _2) >>implies>> (_1[0] != _2[0])')
+            False
+        """
+        return self.forAllN(predicate,2,symmetric)
+
+    def exists2(self,predicate,symmetric=False):
+        """
+        Return True if the predicate is satisfied by at least one pair of
+        elements, as exists(e1,e2|...) in OCL. See forAllN.
+
+        Examples:
+            >>> Set(1,2,3).exists2(lambda a,b:a*b == 6, symmetric=True)
+            True
+            >>> Set(1,2,3).exists2('_1 * 2 == _2 + 1')
+            True
+        """
+        return self.existsN(predicate,2,symmetric)
+
+    def forAllN(self,predicate,arity,symmetric=False):
+        """
+        Return True if the predicate is satisfied by all the k-tuples of
+        elements, k being the arity. The tuples are enumerated lazily and
+        the enumeration stops at the first failure.
+
+        :param predicate: A function with k parameters, or a string where
+            _1, _2, ... denote the elements.
+        :type predicate: (X,...,X)->bool|str
+        :param arity: The number of variables.
+        :type arity: int
+        :param symmetric: If True the predicate is declared to give the same
+            result whatever the order of the elements, and only one order
+            of each tuple is checked.
+        :type symmetric: bool
+        :rtype: bool
+
+        String predicates on pairs of the forms f(_1) == g(_2),
+        f(_1) != g(_2) and _1 == _2 or f(_1) != f(_2) (that is unicity
+        of f, also written with implies or 'is') are evaluated with a hash
+        table instead of checking all pairs.
+
+        Examples:
+            >>> Seq(1,2,3).forAllN(lambda a,b,c:a+b+c <= 9,3,symmetric=True)
+            True
+        """
+        return _quantify(self.lazy()._pairs(),predicate,arity,symmetric,True)
+
+    def existsN(self,predicate,arity,symmetric=False):
+        """
+        Return True if the predicate is satisfied by at least one k-tuple of
+        elements. See forAllN.
+
+        Examples:
+            >>> Seq(1,2,4).existsN('_1+_2+_3 == 7',3)
+            True
+        """
+        return _quantify(self.lazy()._pairs(),predicate,arity,symmetric,False)
+
+    @_parallelizable
     def one(self,predicate):
         """
         Return True if the predicate given as parameter is satisfied by at
@@ -581,10 +1556,11 @@ class GenericCollection:  # old-class style required
             >>> Bag(Set(2),Set(),Set(3),Set()).one(lambda e:e.size()==0)
             False
         """
+        test = compilePredicate(predicate)
         foundOne = False
         # noinspection PyTypeChecker
         for e in self:
-            found = evaluatePredicate(e,predicate)
+            found = test(e)
             if found and foundOne:
                 return False
             elif found:
@@ -596,61 +1572,177 @@ class GenericCollection:  # old-class style required
         Return the transitive closure of the expression for all element in
         the collection.
 
-        See OCL (section 7.6.5.
-
+        See OCL (section 7.6.5. As in OCL the result is an OrderedSet (in
+        breadth first order) if the collection is ordered, and a Set
+        otherwise. Undefined values (None) returned by the
+        expression are ignored. An OrderedSet requires hashable elements:
+        if some elements are not hashable, the result of an ordered
+        collection is a Seq without duplicates instead.
 
         :param expression: The expression to be applied again and again.
         :type: X->X
         :return: A set representing the transitive closure including the
         source elements/
-        :type: Seq[X]
+        :type: Set[X]|OrderedSet[X]
         Examples:
 
             >>> def f(x):
             ...     successors = {1:[2], 2:[1, 2, 3], 3:[4], 4:[], \
                                   5:[5], 6:[5], 7:[5, 7]}
             ...     return successors[x]
-            >>> Set(1).closure(f) == Seq(1,2,3,4)
+            >>> Set(1).closure(f) == Set(1,2,3,4)
+            True
+            >>> Set(5).closure(f) == Set(5)
             True
-            >>> Set(5).closure(f) == Seq(5)
+            >>> Seq(6,6,3).closure(f) == OrderedSet(6,3,5,4)
             True
-            >>> Seq(6,6,3).closure(f) == Seq(6,3,5,4)
+            >>> Bag(7,7).closure(f) == Set(7,5)
             True
+            >>> Seq(3).closure(lambda x: None if x==0 else x-1) \
+                    == OrderedSet(3,2,1,0)
+            True
+            >>> Seq([1],[2]).closure(lambda x: None)
+            Seq([1], [2])
         """
+        elements = self.closureIter(expression)
+        if isinstance(self.emptyCollection(),(Seq,OrderedSet)):
+            elements = elements.asSeq()
+            try:
+                return OrderedSet.new(elements)
+            except TypeError:
+                # unhashable elements: the sequence is already without
+                # duplicates (elements are compared by identity)
+                return elements
+        else:
+            return Set.new(elements)
 
-        # FIXME: returns always a sequence, but the type changes in OCL.
-        from collections import deque
-        sources = list(self)
-        to_visit = deque(sources)
-        visited = []
-        while len(to_visit) != 0:
-            current = to_visit.popleft()
-            if current not in visited:
-                result = evaluate(current,expression)
-                if isCollection(result):
-                    successors = listAll(result)
-                else:
-                    successors = [result]
-                # print "visited %s -> %s" % (current,successors)
-                for s in successors:
-                    if s not in visited:
-                        to_visit.append(s)
-                visited.append(current)
-        return Seq.new(visited)
-
-    def iterate(self):
-        # FIXME: Not implemented (See 7.6.6)
-        raise NotImplementedError()
+    def closureIter(self,expression):
+        """
+        Return the transitive closure as a Stream, that is lazily: the
+        expression is evaluated only when further elements are needed.
+        Operations like includes or exists on the result therefore stop
+        as soon as possible without exploring the whole graph.
+
+        Elements are produced in breadth first order, source elements
+        first. Elements that cannot be hashed are compared by identity.
+
+        Examples:
+            >>> def successor(x):
+            ...     return x+1
+            >>> Set(0).closureIter(successor).includes(1000)
+            True
+            >>> Seq(0).closureIter('[_+1,_+2] if _<5 else []').asSeq()
+            Seq(0, 1, 2, 3, 4, 5, 6)
+            >>> a = []
+            >>> b = [a]
+            >>> Seq(b).closureIter(lambda x: x).asSeq() == Seq(b,a)
+            True
+        """
+        return Stream(self._closureGenerator(compileExpression(expression)))
+
+    def _closureGenerator(self,function):
+        visited = _VisitedSet()
+        to_visit = deque()
+        for source in self:
+            if visited.add(source):
+                to_visit.append(source)
+                yield source
+        while to_visit:
+            current = to_visit.popleft()
+            result = function(current)
+            if result is None:
+                continue
+            if isCollection(result):
+                successors = result
+            else:
+                successors = (result,)
+            for s in successors:
+                if s is not None and visited.add(s):
+                    to_visit.append(s)
+                    yield s
+
+    def iterate(self,body,initial):
+        """
+        Fold the body over the elements of the collection, starting with
+        the initial value of the accumulator (See OCL 7.6.6). The body is
+        either a function of the element and of the accumulator or a
+        string expression where '_' denotes the element and 'acc' the
+        accumulator.
+
+        Bodies like 'acc + e', 'acc.including(e)', 'max(acc,e)' or
+        'min(acc,e)', where e does not use the accumulator, are executed
+        in a single pass: numbers are summed (with the number of
+        occurrences for bags), values are included all at once with a
+        single copy of the initial collection, and extrema are tracked
+        without intermediate values.
+
+        :param body: The body of the iteration.
+        :type body: (X,Y)->Y|str
+        :param initial: The initial value of the accumulator.
+        :type initial: Y
+        :return: The final value of the accumulator.
+        :rtype: Y
+
+        Examples:
+            >>> Seq(1,2,3).iterate(lambda e,acc:acc*10+e,0)
+            123
+            >>> Bag(2,2,3).iterate('acc + _*_',0)
+            17
+            >>> Seq(1,2,2).iterate('acc.including(_*10)',Set()) \
+                    == Set(10,20)
+            True
+            >>> Bag(1,1,2).iterate('acc.including(_)',Bag(5)) \
+                    == Bag(1,1,2,5)
+            True
+            >>> Set(3,-7,5).iterate('max(acc,abs(_))',0)
+            7
+            >>> Seq('a','b').iterate('acc + _','')
+            'ab'
+            >>> Set().iterate('acc + 1',0)
+            0
+        """
+        return _iterate(self.lazy()._pairs(),body,initial)
 
     def isUnique(self,expression):
         return not self.collect(expression).hasDuplicates()
 
+    def lazy(self):
+        """
+        Return a lazy view on this collection. Operations like select,
+        reject or collect are then recorded and executed in a single pass,
+        without intermediate collections, when a terminal operation like
+        size, forAll or asSet is called. See LazyCollection.
+
+        Examples:
+            >>> Seq(1,2,3).lazy().select(lambda e:e>1).asSeq() == Seq(2,3)
+            True
+        """
+        return LazyCollection(self.asCollection())
+
+    def product(self,anyCollection):
+        """
+        Return the cartesian product of this collection and of the given
+        one, that is the Set of all Tuple(first=e1,second=e2). The result
+        is a lazy collection: tuples are only created when enumerated.
+        See Product.
+
+        Examples:
+            >>> Set(1,2).product(Set(3)).asSet() \
+                    == Set(Tuple(first=1,second=3),Tuple(first=2,second=3))
+            True
+        """
+        return Product(self,anyCollection)
+
 
 
 
 from collections import deque
 
-class Collection(object, GenericCollection):
+# Classes instantiated when Set, Bag or Seq are created. By default the
+# class itself is used. See pyalaocl.persistent.usePersistentCollections.
+COLLECTION_IMPLEMENTATIONS = {}
+
+class Collection(GenericCollection):
     """
     Base class for OCL collections.
     Collections are either:
@@ -658,8 +1750,60 @@ class Collection(object, GenericCollection):
     * ordered set (OrderedSet)
     * bags (Bag),
     * sequences (Seq)
+
+    Collections use __slots__ so that they have no __dict__: a collection
+    object only holds its representation (theSet, theCounter, theList...).
+    Subclasses that do not declare __slots__ still get a __dict__.
+
+    Collections are pickled with their class: unpickling does not go
+    through COLLECTION_IMPLEMENTATIONS.
+
+    Examples:
+        >>> hasattr(Set(1), '__dict__'), hasattr(Seq(1), '__dict__')
+        (False, False)
+        >>> isinstance(Set(1), GenericCollection)
+        True
+        >>> import pickle
+        >>> s = pickle.loads(pickle.dumps(OrderedSet(3,1,2)))
+        >>> s, s.indexOf(2)
+        (OrderedSet(3, 1, 2), 3)
+        >>> pickle.loads(pickle.dumps(Bag(1,1,2),2)).count(1)
+        2
+        >>> import pyalaocl.persistent
+        >>> data = pickle.dumps(pyalaocl.Set(1,2),2)
+        >>> pyalaocl.persistent.usePersistentCollections()
+        >>> p = pickle.loads(pickle.dumps(pyalaocl.Seq(1,2),2))
+        >>> type(pickle.loads(data)).__name__, type(p).__name__, p.append(3)
+        ('Set', 'PersistentSeq', Seq(1, 2, 3))
+        >>> pyalaocl.persistent.usePersistentCollections(False)
     """
-    __metaclass__ = ABCMeta
+    __slots__ = ('_hash',)
+
+    def __new__(cls,*args):
+        return object.__new__(COLLECTION_IMPLEMENTATIONS.get(cls,cls))
+
+    def __reduce__(self):
+        return (_restoreCollection,(type(self),self.__getstate__()))
+
+    def __getstate__(self):
+        state = dict(getattr(self,'__dict__',{}))
+        for (name,slot) in _slotsOf(type(self)):
+            if name == '_hash':
+                # hashes of strings may differ from one process to another
+                continue
+            try:
+                state[name] = slot.__get__(self)
+            except AttributeError:
+                pass
+        return state
+
+    def __setstate__(self,state):
+        slots = dict(_slotsOf(type(self)))
+        for (name,value) in state.items():
+            if name in slots:
+                slots[name].__set__(self,value)
+            else:
+                self.__dict__[name] = value
 
     @abstractmethod
     def size(self):
@@ -677,6 +1821,14 @@ class Collection(object, GenericCollection):
     def excluding(self,value):
         pass
 
+    @abstractmethod
+    def includingAll(self,values):
+        pass
+
+    @abstractmethod
+    def excludingAll(self,values):
+        pass
+
     @abstractmethod
     def union(self,value):
         pass
@@ -728,6 +1880,9 @@ class Collection(object, GenericCollection):
     def asSeq(self):
         pass
 
+    def asOrderedSet(self):
+        return OrderedSet.new(self)
+
     @abstractmethod
     def __str__(self):
         pass
@@ -742,8 +1897,31 @@ class Collection(object, GenericCollection):
     def __ne__(self,value):
         return not self.__eq__(value)
 
-    @abstractmethod
     def __hash__(self):
+        """
+        Return the hash of the collection. Collections are never modified,
+        so the hash is computed on first use and then cached. This matters
+        for collections stored in other collections: Set(Set(...)), bags of
+        sets, ... The hash of Sets and Bags does not depend on the order
+        of their elements, as for equality.
+
+        Examples:
+            >>> Bag(Set(1,2),Set(2,1)).count(Set(1,2))
+            2
+            >>> hash(Bag('a','b','b')) == hash(Bag('b','a','b'))
+            True
+            >>> s = Seq(1,Set(2))
+            >>> hash(s) == hash(s) == hash(Seq(1,Set(2)))
+            True
+        """
+        try:
+            return self._hash
+        except AttributeError:
+            self._hash = self._hashValue()
+            return self._hash
+
+    @abstractmethod
+    def _hashValue(self):
         pass
 
     @abstractmethod
@@ -755,6 +1933,31 @@ class Collection(object, GenericCollection):
         pass
 
 
+def _slotsOf(cls):
+    # Return the pairs (name,descriptor) of the slots of a class
+    return [(name,base.__dict__[name])
+            for base in reversed(cls.__mro__)
+            for name in base.__dict__.get('__slots__',())]
+
+
+def _restoreCollection(cls,state):
+    # Unpickle a collection, without the dispatch of Collection.__new__
+    collection = object.__new__(cls)
+    collection.__setstate__(state)
+    return collection
+
+
+def _copyGenericOperations(cls):
+    # Copy the operations of GenericCollection that cls does not define,
+    # for old-style classes that cannot inherit from it. The methods of
+    # object (__init__, __str__...) are not copied.
+    for (name,value) in GenericCollection.__dict__.items():
+        if (inspect.isfunction(value)
+                or isinstance(value,(classmethod,staticmethod,property))) \
+                and name not in cls.__dict__ and not hasattr(object,name):
+            setattr(cls,name,value)
+
+
 
 
 #------------------------------------------------------------------------------
@@ -784,6 +1987,7 @@ class Set(Collection):
     any kind of elements at the same time. OCL sets are homogeneous,
     all elements being of the same type (or at least same supertype).
     """
+    __slots__ = ('theSet',)
 
     def __init__(self,*args):
         """
@@ -804,16 +2008,32 @@ class Set(Collection):
            >>> Set(Set(2),Set(2)).size()
            1
         """
-        # We cannot have Counter here. So list is ok (see listAll)
+        # We cannot have Counter here, so no need for listAll
         super(Set, self).__init__()
-        self.theSet = set(list(args))
+        self.theSet = set(args)
 
     @classmethod
     def new(cls,anyCollection=()):
-        newSet = cls()
-        newSet.theSet = set(anyCollection)
+        implementation = COLLECTION_IMPLEMENTATIONS.get(cls)
+        if implementation is not None:
+            return implementation.new(anyCollection)
+        return cls._fromSet(set(anyCollection))
+
+    @classmethod
+    def _fromSet(cls,theSet):
+        # Create a set with the given representation, without copying it
+        newSet = object.__new__(cls)
+        newSet.theSet = theSet
         return newSet
 
+    @classmethod
+    def builder(cls):
+        """
+        Return a mutable builder to create a set without copying it at
+        each step. See SetBuilder.
+        """
+        return SetBuilder(COLLECTION_IMPLEMENTATIONS.get(cls,cls))
+
     def emptyCollection(self):
         return Set.new()
 
@@ -898,6 +2118,41 @@ class Set(Collection):
         fresh.discard(value)
         return Set.new(fresh)
 
+    def includingAll(self,values):
+        """
+        Includes all the values in the set. The set is copied only once.
+        :param values: The values to add to the set.
+        :type values: collection
+        :return: A set including these values.
+        :rtype: Set
+
+        Examples:
+            >>> Set(1,3).includingAll([3,4,5]) == Set(1,3,4,5)
+            True
+            >>> Set().includingAll(Bag(2,2)) == Set(2)
+            True
+        """
+        return Set.builder().addAll(self.theSet).addAll(values).freeze()
+
+    def excludingAll(self,values):
+        """
+        Excludes all the values from the set (if there). The set is copied
+        only once.
+        :param values: The values to remove from the set.
+        :type values: collection
+        :return: A set without these values.
+        :rtype: Set
+
+        Examples:
+            >>> Set(1,3,4).excludingAll([3,4,5]) == Set(1)
+            True
+            >>> Set(1,2).excludingAll(Set()) == Set(1,2)
+            True
+        """
+        excluded = _membershipOf(values)
+        return Set.builder().addAll(
+            e for e in self.theSet if e not in excluded).freeze()
+
     def union(self,anyCollection):
         """
         Add all elements from the collection given to the set.
@@ -1069,12 +2324,12 @@ class Set(Collection):
         fresh = set()
         for e in self.theSet:
             if isCollection(e):
-                flat_set = set(flatten(e))
+                fresh.update(_leaves(e))
             else:
-                flat_set = {e}
-            fresh = fresh | flat_set
-        return Set.new(fresh)
+                fresh.add(e)
+        return Set._fromSet(fresh)
 
+    @_parallelizable
     def select(self,predicate):
         """
         Retain in the set only the elements satisfying the expression.
@@ -1090,8 +2345,10 @@ class Set(Collection):
                     == Set(Set(1,2,3,4))
             True
         """
-        return Set.new(set([e for e in self if evaluatePredicate(e,predicate)]))
+        test = compilePredicate(predicate)
+        return Set.new(set([e for e in self if test(e)]))
 
+    @_parallelizable
     def collectNested(self,expression):
         """
         Return a bag of values resulting from the evaluation of the given expression
@@ -1112,12 +2369,17 @@ class Set(Collection):
                     == Bag(Bag(2,2),Bag(3,3))
             True
         """
-        return Bag.new(map((lambda e:evaluate(e,expression)),self.theSet))
+        return Bag.new(map(compileExpression(expression),self.theSet))
 
+    @_parallelizable
     def sortedBy(self,expression):
-        # FIXME: should return a OrderedSet
-        return \
-            Seq.new(sorted(self.theSet,key=(lambda e:evaluate(e,expression))))
+        """
+        Examples:
+            >>> Set(3,1,2).sortedBy(lambda e:-e)
+            OrderedSet(3, 2, 1)
+        """
+        return OrderedSet._fromList(
+            sorted(self.theSet,key=compileExpression(expression)))
 
     def asSet(self):
         return self
@@ -1179,14 +2441,22 @@ class Set(Collection):
             >>> Set(Set(1),Set(2,1)) == Set(Set(1,2),Set(1))
             True
         """
+        if isinstance(value,LazyCollection):
+            return value == self
         if not isinstance(value,Set):
             return False
+        if type(self.theSet) is not type(value.theSet):
+            # e.g. a python set and a persistent one. Python sets are
+            # only equal to python sets, so compare the other way around.
+            return value.theSet == self.theSet \
+                if isinstance(self.theSet,(set,frozenset)) \
+                else self.theSet == value.theSet
         return self.theSet == value.theSet
 
     def __ne__(self,value):
         return not self.__eq__(value)
 
-    def __hash__(self):
+    def _hashValue(self):
         return hash(frozenset(self.theSet))
 
     def __iter__(self):
@@ -1220,6 +2490,7 @@ def asBag(anyCollection):
 from collections import Counter
 
 class Bag(Collection):
+    __slots__ = ('theCounter','theSize')
 
     def __init__(self,*args):
         """
@@ -1238,23 +2509,48 @@ class Bag(Collection):
            2
         """
         super(Bag,self).__init__()
-        # We cannot have Counter here. So list is ok (see listAll)
-        self.theCounter = Counter(list(args))
+        # We cannot have Counter here, so no need for listAll
+        self.theCounter = Counter(args)
+        # The total number of occurrences is maintained by all operations
+        # so that size() takes constant time.
+        self.theSize = len(args)
 
     @classmethod
     def new(cls,anyCollection=()):
-        newBag = Bag()
+        implementation = COLLECTION_IMPLEMENTATIONS.get(cls)
+        if implementation is not None:
+            return implementation.new(anyCollection)
         if isinstance(anyCollection,Counter):
-            newBag.theCounter = anyCollection.copy()
+            counter = anyCollection.copy()
             # Remove the 0 and negative elements from the counter. This
             # weird trick is indicated in python documentation for Counter.
-            newBag.theCounter += Counter()
+            counter += Counter()
+            return cls._fromCounter(counter)
         elif isinstance(anyCollection,Bag):
-            newBag.theCounter = anyCollection.theBag.copy()
+            counter = Counter(dict(anyCollection.theCounter.iteritems()))
+            return cls._fromCounter(counter,anyCollection.theSize)
         else:
-            newBag.theCounter = Counter(listAll(anyCollection))
+            elements = listAll(anyCollection)
+            return cls._fromCounter(Counter(elements),len(elements))
+
+    @classmethod
+    def _fromCounter(cls,theCounter,size=None):
+        # Create a bag with the given representation, without copying it.
+        # The size is computed if not given.
+        newBag = object.__new__(cls)
+        newBag.theCounter = theCounter
+        newBag.theSize = \
+            sum(theCounter.itervalues()) if size is None else size
         return newBag
 
+    @classmethod
+    def builder(cls):
+        """
+        Return a mutable builder to create a bag without copying it at
+        each step. See BagBuilder.
+        """
+        return BagBuilder(COLLECTION_IMPLEMENTATIONS.get(cls,cls))
+
     def emptyCollection(self):
         return Bag.new()
 
@@ -1269,8 +2565,13 @@ class Bag(Collection):
            1
            >>> Bag().size()
            0
+           >>> Bag(1,1,2).including(1).excluding(2).size()
+           3
         """
-        return sum(self.theCounter.values())
+        return self.theSize
+
+    def isEmpty(self):
+        return self.theSize == 0
 
     def count(self,value):
         """
@@ -1310,7 +2611,7 @@ class Bag(Collection):
         """
         fresh = self.theCounter.copy()
         fresh[value] += 1
-        return Bag.new(fresh)
+        return Bag._fromCounter(fresh,self.theSize+1)
 
     def excluding(self,value):
         """
@@ -1330,8 +2631,37 @@ class Bag(Collection):
             True
         """
         fresh = self.theCounter.copy()
-        del fresh[value]
-        return Bag.new(fresh)
+        removed = fresh.pop(value,0)
+        return Bag._fromCounter(fresh,self.theSize-removed)
+
+    def includingAll(self,values):
+        """
+        Add one occurrence of the bag for each value in the collection.
+        The bag is copied only once.
+
+        Examples:
+            >>> Bag(1,2).includingAll([2,3,3]) == Bag(1,2,2,3,3)
+            True
+            >>> Bag().includingAll(Counter([1,1])) == Bag(1,1)
+            True
+        """
+        return Bag.builder().addAll(self).addAll(values).freeze()
+
+    def excludingAll(self,values):
+        """
+        Remove *all* occurrences of each value in the collection. The bag is
+        copied only once.
+
+        Examples:
+            >>> Bag(1,2,2,3,3).excludingAll([2,3,4]) == Bag(1)
+            True
+        """
+        excluded = _membershipOf(values)
+        builder = Bag.builder()
+        for (e,n) in self.theCounter.iteritems():
+            if e not in excluded:
+                builder.add(e,n)
+        return builder.freeze()
 
     def union(self,anyCollection):
         """
@@ -1355,9 +2685,10 @@ class Bag(Collection):
         """
         assert isCollection(anyCollection), \
             'Any collection expected, but found %s' % anyCollection
+        added = listAll(anyCollection)
         fresh = self.theCounter.copy()
-        fresh.update(listAll(anyCollection))
-        return Bag.new(fresh)
+        fresh.update(added)
+        return Bag._fromCounter(fresh,self.theSize+len(added))
 
     def intersection(self,anyCollection):
         """
@@ -1375,7 +2706,9 @@ class Bag(Collection):
         """
         assert isCollection(anyCollection), \
             'Any collection expected, but found %s' % anyCollection
-        return Bag.new(self.theCounter & Counter(list(anyCollection)))
+        # & removes the elements with no occurrences left
+        return Bag._fromCounter(
+            self.theCounter & Counter(list(anyCollection)))
 
     def __and__(self,anyCollection):
         return self.intersection(anyCollection)
@@ -1402,26 +2735,35 @@ class Bag(Collection):
         If the bag is a bag of collection then return the bag union of all
         its elements.
 
-        :return: the sum of all elements .
-        :rtype: int
+        The bag is not modified.
+
+        :return: The flatten bag.
+        :rtype: Bag
 
         Examples:
             >>> Bag(Bag(2),Bag(3,3)).flatten() == Bag(2,3,3)
             True
             >>> Bag(Bag(),Bag(),Bag(3,2),Set(3)).flatten()  == Bag(3,2,3)
             True
+            >>> b = Bag(Bag(1),Bag(1),Seq(Bag(2,2)))
+            >>> b.flatten() == Bag(1,1,2,2)
+            True
+            >>> b == Bag(Bag(1),Bag(1),Seq(Bag(2,2)))
+            True
         """
         counter = Counter()
-        for (e,n) in self.theCounter.items():
+        size = 0
+        for (e,n) in self.theCounter.iteritems():
             if isCollection(e):
-                coll = e.flatten()
+                for x in _leaves(e):
+                    counter[x] += n
+                    size += n
             else:
-                coll = [e]
-            for x in coll:
-                counter[x] += n
-        self.theCounter = counter
-        return self
+                counter[e] += n
+                size += n
+        return Bag._fromCounter(counter,size)
 
+    @_parallelizable
     def select(self,predicate):
         """
         Retain in the bag only the elements that satisfy the predicate.
@@ -1436,11 +2778,16 @@ class Bag(Collection):
             >>> Bag().select(lambda e:True) == Bag()
             True
         """
-        fresh = \
-            Counter(dict([(e,n) for (e,n) in self.theCounter.items()
-                          if evaluatePredicate(e,predicate)]))
-        return Bag.new(fresh)
-
+        test = compilePredicate(predicate)
+        fresh = Counter()
+        size = 0
+        for (e,n) in self.theCounter.iteritems():
+            if test(e):
+                fresh[e] = n
+                size += n
+        return Bag._fromCounter(fresh,size)
+
+    @_parallelizable
     def collectNested(self,expression):
         """
         Return a bag of values resulting from the evaluation of the given
@@ -1462,12 +2809,13 @@ class Bag(Collection):
                     == Bag(Bag(2,2),Bag(2,2))
             True
         """
-        results = [(evaluate(e,expression),n)
+        function = compileExpression(expression)
+        results = [(function(e),n)
                    for (e,n) in self.theCounter.items()]
         fresh = Counter()
         for (r,n) in results:
             fresh[r] += n
-        return Bag.new(fresh)
+        return Bag._fromCounter(fresh,self.theSize)
 
     def hasDuplicates(self):
         """
@@ -1526,17 +2874,28 @@ class Bag(Collection):
                       if n == number]))
         return Bag.new(new_counter)
 
+    @_parallelizable
     def sortedBy(self,expression):
+        """
+        As in OCL, sorting a bag gives a sequence, since elements can be
+        duplicated.
+
+        Examples:
+            >>> Bag(3,1,3,2).sortedBy(lambda e:e)
+            Seq(1, 2, 3, 3)
+        """
         r = []
-        s = sorted(self.theCounter.keys(),key=lambda e:evaluate(e,expression))
+        s = sorted(self.theCounter.keys(),key=compileExpression(expression))
         for key in s:
             r += [key] * self.theCounter[key]
-        # FIXME: Should be an ordered set
-        return r
+        return Seq._fromList(r)
 
     def asSet(self):
         return Set.new(self.theCounter.keys())
 
+    def asOrderedSet(self):
+        return OrderedSet._fromList(self.theCounter.keys())
+
     def asBag(self):
         return self
 
@@ -1575,15 +2934,19 @@ class Bag(Collection):
             >>> Bag(Set(2))==Bag(Set(2))
             True
         """
+        if isinstance(value,LazyCollection):
+            return value == self
         if not isinstance(value,Bag):
             return False
-        return self.theCounter == value.theCounter
+        return (self.theSize == value.theSize
+                and self.theCounter == value.theCounter)
 
     def __ne__(self,value):
         return not self.__eq__(value)
 
-    def __hash__(self):
-        return hash(tuple(self.theCounter.items()))
+    def _hashValue(self):
+        # Independent of the iteration order, as for equality.
+        return hash(frozenset(self.theCounter.iteritems()))
 
     def __iter__(self):
         """ Make Bags iterable for pythonic usage.
@@ -1623,6 +2986,8 @@ def asSeq(anyCollection):
 
 
 class Seq(Collection):
+    __slots__ = ('theList',)
+
     def __init__(self,*args):
         """
         Create a Seq from some elements or from one collection.
@@ -1647,10 +3012,26 @@ class Seq(Collection):
 
     @classmethod
     def new(cls,anyCollection=()):
-        newSeq = Seq()
-        newSeq.theList = listAll(anyCollection)
+        implementation = COLLECTION_IMPLEMENTATIONS.get(cls)
+        if implementation is not None:
+            return implementation.new(anyCollection)
+        return cls._fromList(listAll(anyCollection))
+
+    @classmethod
+    def _fromList(cls,theList):
+        # Create a sequence with the given representation, without copying it
+        newSeq = object.__new__(cls)
+        newSeq.theList = theList
         return newSeq
 
+    @classmethod
+    def builder(cls):
+        """
+        Return a mutable builder to create a sequence without copying it at
+        each step. See SeqBuilder.
+        """
+        return SeqBuilder(COLLECTION_IMPLEMENTATIONS.get(cls,cls))
+
     def emptyCollection(self):
         return Seq.new()
 
@@ -1667,8 +3048,15 @@ class Seq(Collection):
         return element in self.theList
 
     def including(self,value):
-        self.theList.append(value)
-        return self
+        """
+        Examples:
+            >>> s = Seq(1,2)
+            >>> s.including(3) == Seq(1,2,3)
+            True
+            >>> s == Seq(1,2)
+            True
+        """
+        return self.append(value)
 
     def excluding(self,value):
         """
@@ -1688,9 +3076,33 @@ class Seq(Collection):
         """
         return Seq.new([e for e in self.theList if e != value])
 
+    def includingAll(self,values):
+        """
+        Append all the values at the end of the sequence. The sequence is
+        copied only once.
+
+        Examples:
+            >>> Seq(1,2).includingAll([2,3]) == Seq(1,2,2,3)
+            True
+        """
+        return Seq.builder().addAll(self.theList).addAll(values).freeze()
+
+    def excludingAll(self,values):
+        """
+        Excludes all occurrences of the values from the sequence (if there).
+        The sequence is copied only once.
+
+        Examples:
+            >>> Seq(1,3,2,3,4).excludingAll(Set(3,4)) == Seq(1,2)
+            True
+        """
+        excluded = _membershipOf(values)
+        return Seq._fromList([e for e in self.theList if e not in excluded])
+
+    @_parallelizable
     def select(self,predicate):
-        return Seq.new([e for e in self.theList
-                        if evaluatePredicate(e,predicate)])
+        test = compilePredicate(predicate)
+        return Seq.new([e for e in self.theList if test(e)])
 
     def hasDuplicates(self):
         """
@@ -1729,23 +3141,38 @@ class Seq(Collection):
         return Seq.new([e for e in self.theList if e in keep ])
 
     def flatten(self):
-        r = []
+        """
+        If the sequence is a sequence of collections, then return the
+        concatenation of all its elements, at any level of nesting.
+        The sequence is not modified.
+
+        :return: The flatten sequence.
+        :rtype: Seq
+
+        Examples:
+            >>> s = Seq(Seq(1,2),3,Seq(),Seq(Seq(4),[5,(6,)]))
+            >>> s.flatten() == Seq(1,2,3,4,5,6)
+            True
+            >>> s.size()
+            4
+        """
+        flat = []
         for e in self.theList:
             if isCollection(e):
-                flat_list = listAll(flatten(e))
+                flat.extend(_leaves(e))
             else:
-                flat_list = [e]
-            r = r + flat_list
-        self.theList = r
-        return self
+                flat.append(e)
+        return Seq._fromList(flat)
 
 
+    @_parallelizable
     def collectNested(self,expression):
-        return Seq.new(map((lambda e:evaluate(e,expression)),self.theList))
+        return Seq.new(map(compileExpression(expression),self.theList))
 
+    @_parallelizable
     def sortedBy(self,expression):
         return \
-            Seq.new(sorted(self.theList,key=(lambda e:evaluate(e,expression))))
+            Seq.new(sorted(self.theList,key=compileExpression(expression)))
 
     def union(self,anyCollection):
         assert isCollection(anyCollection), \
@@ -1813,6 +3240,9 @@ class Seq(Collection):
     def asSeq(self):
         return self
 
+    def asOrderedSet(self):
+        return OrderedSet.new(self.theList)
+
     def first(self):
         try:
             return self.theList[0]
@@ -1835,11 +3265,13 @@ class Seq(Collection):
         return self.__str__()
 
     def __eq__(self,value):
+        if isinstance(value,LazyCollection):
+            return value == self
         if not isinstance(value,Seq):
             return False
         return self.theList == value.theList
 
-    def __hash__(self):
+    def _hashValue(self):
         return hash(tuple(self.theList))
 
     def __contains__(self,item):
@@ -1851,97 +3283,1242 @@ class Seq(Collection):
 
 
 
+#------------------------------------------------------------------------------
+#   OCL Ordered Sets
+#------------------------------------------------------------------------------
 
 
-
-#==============================================================================
-#     Conversions
-#==============================================================================
+def asOrderedSet(anyCollection):
+    """
+    Convert the given collection to an OrderedSet
+    :param anyCollection:
+    :return:
+    :rtype: OrderedSet
+    """
+    try:
+        return anyCollection.asOrderedSet()
+    except AttributeError:
+        return OrderedSet.new(anyCollection)
 
 
+class OrderedSet(Collection):
+    """
+    Set whose elements are ordered, by default in insertion order.
 
+    Elements are stored in a list and indexed by a dictionary from elements
+    to positions. Membership, indexOf, at, first and last therefore take
+    constant time. As other collections, ordered sets are not modified by
+    operations: append, prepend, insertAt, ... return new ordered sets.
+    Elements must be hashable.
 
-import collections
+    Examples:
+        >>> s = OrderedSet(3,1,2,1)
+        >>> s
+        OrderedSet(3, 1, 2)
+        >>> s.at(1), s.first(), s.last(), s.indexOf(2), 1 in s
+        (3, 3, 2, 3, True)
+        >>> s.append(4).prepend(0)
+        OrderedSet(0, 3, 1, 2, 4)
+        >>> s.append(3)
+        OrderedSet(1, 2, 3)
+        >>> s.insertAt(2,5)
+        OrderedSet(3, 5, 1, 2)
+        >>> s.subOrderedSet(2,3)
+        OrderedSet(1, 2)
+        >>> s.collect(lambda e:e%2) == Seq(1,1,0)
+        True
+        >>> s == OrderedSet(3,1,2), s == OrderedSet(1,2,3), s == Seq(3,1,2)
+        (True, False, False)
+    """
+    __slots__ = ('theList','theIndex')
 
+    def __init__(self,*args):
+        super(OrderedSet,self).__init__()
+        (self.theList,self.theIndex) = self._unique(args)
+
+    @staticmethod
+    def _unique(elements):
+        # Return the list of elements without duplicates and its index
+        theList = []
+        theIndex = {}
+        for e in elements:
+            if e not in theIndex:
+                theIndex[e] = len(theList)
+                theList.append(e)
+        return (theList,theIndex)
 
-class ConversionRule(object):
-    def __init__(self,language,sourceType,collectionType):
-        self.language = language
-        self.sourceType = sourceType
-        self.collectionType = collectionType
-    def accept(self,value):
-        return isinstance(value,self.sourceType)
-    def asCollection(self,value):
-        return self.collectionType.new(value)
-    def emptyCollection(self):
-        return self.collectionType.new()
+    @classmethod
+    def new(cls,anyCollection=()):
+        implementation = COLLECTION_IMPLEMENTATIONS.get(cls)
+        if implementation is not None:
+            return implementation.new(anyCollection)
+        return cls._fromList(*cls._unique(_elementsOf(anyCollection)))
 
-from collections import OrderedDict
+    @classmethod
+    def _fromList(cls,theList,theIndex=None):
+        # Create an ordered set with the given representation, without
+        # copying it. The list must not contain duplicates.
+        newSet = object.__new__(cls)
+        newSet.theList = theList
+        if theIndex is None:
+            theIndex = dict((e,i) for (i,e) in enumerate(theList))
+        newSet.theIndex = theIndex
+        return newSet
 
+    def emptyCollection(self):
+        return OrderedSet.new()
 
-class Converter(object):
-    def __init__(self):
-        self.rules = OrderedDict()
-        self.language_collections = OrderedDict()
-        self.all_collections = []
+    def size(self):
+        return len(self.theList)
 
-    def registerConversionRules(self,language,conversionList):
-        for (source,target) in conversionList:
-            rule = ConversionRule(language,source,target)
-            self.rules[source] = rule
-            if language not in self.language_collections:
-                self.language_collections[language] = []
-            self.language_collections[language].append(source)
-            self.all_collections.append(source)
+    def isEmpty(self):
+        return False if self.theList else True
 
-    def _registerActualTypeRule(self,source,rule):
-        self.registerConversionRules(
-            self,rule.language,[(source,rule.collectionType)])
-        return self.rules[source]
+    def count(self,value):
+        return 1 if value in self.theIndex else 0
 
-    def isCollection(self,value,language=None):
-        if isinstance(value,basestring):
-            return False
-        if language == None:
-            collections = self.all_collections
-        else:
-            collections = self.language_collections[language]
-        return isinstance(value,tuple(collections))
+    def includes(self,value):
+        return value in self.theIndex
 
-    def findRule(self,value):
+    def including(self,value):
         """
-        Return the type of the OCL collection corresponding to the given type.
+        Add the value at the end of the ordered set if it is not there.
 
-        Raise an exception if no conversion is possible for the given type
-        :param aType: The type to be converted.
-        :type aType: type
-        :return: A collection type.
-        :rtype: type < Collection
-        :raise: ValueError if there is no correspondance possible.
+        Examples:
+            >>> OrderedSet(1,2).including(3) == OrderedSet(1,2,3)
+            True
+            >>> OrderedSet(1,2).including(1) == OrderedSet(1,2)
+            True
         """
-        valueType = type(value)
-        # check if we have some chance and the type is already registered
-        if valueType in self.rules:
-            return self.rules[valueType]
-        else:
-            # no chance. We have to check if this is a subtype.
-            for rule in self.rules.values():
-                if rule.accept(value):
-                    return self._registerActualTypeRule(self,valueType,rule)
-            msg = "getConversionRule(): Can't convert a value of type %s"
-            raise ValueError(msg % valueType)
+        if value in self.theIndex:
+            return self
+        fresh = list(self.theList)
+        fresh.append(value)
+        index = dict(self.theIndex)
+        index[value] = len(self.theList)
+        return OrderedSet._fromList(fresh,index)
 
-    def asCollection(self,value):
-        try:
-            return value.asCollection()
-        except AttributeError:
-            return self.findRule(value).asCollection(value)
+    def excluding(self,value):
+        if value not in self.theIndex:
+            return self
+        return OrderedSet._fromList([e for e in self.theList if e != value])
 
-    def emptyCollection(self,value):
-        try:
-            return value.emptyCollection()
-        except NameError:
-            return self.findRule(value).emptyCollection(value)
+    def includingAll(self,values):
+        """
+        Examples:
+            >>> OrderedSet(1,2).includingAll([3,1,4]) == OrderedSet(1,2,3,4)
+            True
+        """
+        fresh = list(self.theList)
+        index = dict(self.theIndex)
+        for e in _elementsOf(values):
+            if e not in index:
+                index[e] = len(fresh)
+                fresh.append(e)
+        return OrderedSet._fromList(fresh,index)
+
+    def excludingAll(self,values):
+        excluded = _membershipOf(values)
+        return OrderedSet._fromList(
+            [e for e in self.theList if e not in excluded])
+
+    def union(self,anyCollection):
+        assert isCollection(anyCollection), \
+            'Any collection expected, but found %s' % anyCollection
+        return self.includingAll(anyCollection)
+
+    def __or__(self,anyCollection):
+        return self.union(anyCollection)
+
+    @_parallelizable
+    def select(self,predicate):
+        test = compilePredicate(predicate)
+        return OrderedSet._fromList([e for e in self.theList if test(e)])
+
+    def flatten(self):
+        """
+        Examples:
+            >>> OrderedSet(Seq(3,1),2,OrderedSet(1,4)).flatten()
+            OrderedSet(3, 1, 2, 4)
+        """
+        return OrderedSet._fromList(*self._unique(_leaves(self.theList)))
+
+    @_parallelizable
+    def collectNested(self,expression):
+        return Seq.new(map(compileExpression(expression),self.theList))
+
+    def hasDuplicates(self):
+        return False
+
+    def duplicates(self):
+        return OrderedSet.new()
+
+    def selectWithCount(self,number):
+        return self if number == 1 else OrderedSet.new()
+
+    @_parallelizable
+    def sortedBy(self,expression):
+        return OrderedSet._fromList(
+            sorted(self.theList,key=compileExpression(expression)))
+
+    def append(self,value):
+        """
+        Return the ordered set with the value at the end. The value is
+        moved if it was already there.
+        """
+        return OrderedSet._fromList(
+            [e for e in self.theList if e != value]+[value])
+
+    def prepend(self,value):
+        """
+        Return the ordered set with the value at the beginning. The value is
+        moved if it was already there.
+        """
+        return OrderedSet._fromList(
+            [value]+[e for e in self.theList if e != value])
+
+    def insertAt(self,index,value):
+        """
+        Return the ordered set with the value at the given position,
+        starting from 1. The value is moved if it was already there.
+        """
+        fresh = [e for e in self.theList if e != value]
+        if not 1 <= index <= len(fresh)+1:
+            raise Invalid(".insertAt(%s,...) failed: No such position."
+                          % index)
+        fresh.insert(index-1,value)
+        return OrderedSet._fromList(fresh)
+
+    def subOrderedSet(self,lower,upper):
+        """
+        Return the elements from the lower to the upper position, both
+        included and starting from 1.
+        """
+        if not 1 <= lower <= upper+1 <= len(self.theList)+1:
+            msg = ".subOrderedSet(%s,%s) failed: No such element."
+            raise Invalid(msg % (lower,upper))
+        return OrderedSet._fromList(self.theList[lower-1:upper])
+
+    def at(self,index):
+        """
+        Return the nth element of the ordered set starting from 1 (or from 0
+        with the python [] operator).
+        """
+        if not 1 <= index <= len(self.theList):
+            raise Invalid(".at(%s) failed: No such element." % index)
+        return self.theList[index-1]
+
+    def __getitem__(self,item):
+        return self.theList[item]
+
+    def indexOf(self,value):
+        """
+        Return the position of the value, starting from 1.
+        """
+        try:
+            return self.theIndex[value]+1
+        except KeyError:
+            raise Invalid(".indexOf(%s) failed: No such element." % value)
+
+    def first(self):
+        try:
+            return self.theList[0]
+        except IndexError:
+            raise Invalid(".first() failed: No such element.")
+
+    def last(self):
+        try:
+            return self.theList[-1]
+        except IndexError:
+            raise Invalid(".last() failed: No such element.")
+
+    def asSet(self):
+        return Set.new(self.theList)
+
+    def asBag(self):
+        return Bag._fromCounter(Counter(self.theList),len(self.theList))
+
+    def asSeq(self):
+        return Seq.new(self.theList)
+
+    def asOrderedSet(self):
+        return self
+
+    def __str__(self):
+        body = ", ".join(map(str,self.theList))
+        return 'OrderedSet(%s)' % body
+
+    def __eq__(self,value):
+        if isinstance(value,LazyCollection):
+            return value == self
+        if not isinstance(value,OrderedSet):
+            return False
+        return self.theList == value.theList
+
+    def _hashValue(self):
+        return hash(tuple(self.theList))
+
+    def __contains__(self,item):
+        return item in self.theIndex
+
+    def __iter__(self):
+        return self.theList.__iter__()
+
+
+
+
+#------------------------------------------------------------------------------
+#   OCL Tuples
+#------------------------------------------------------------------------------
+
+# names -> (names, {name: position}). Shared by all tuples with these names.
+_TUPLE_LAYOUTS = {}
+
+def _tupleLayout(names):
+    try:
+        return _TUPLE_LAYOUTS[names]
+    except KeyError:
+        layout = (names,dict((n,i) for (i,n) in enumerate(names)))
+        _TUPLE_LAYOUTS[names] = layout
+        return layout
+
+def _makeTuple(names,values):
+    return Tuple._fromLayout(_tupleLayout(names),values)
+
+
+class Tuple(object):
+    """
+    Immutable OCL tuple with named fields, e.g. Tuple{name='a', age=3}.
+
+    Tuples are compact: fields are stored in slots and the field names are
+    shared by all tuples with the same names. They are hashable and their
+    hash is computed only once. As in OCL the order of the fields does not
+    matter. Fields are accessed as attributes or with [].
+
+    Examples:
+        >>> t = Tuple(name='a',age=3)
+        >>> t.name, t['age'], t
+        ('a', 3, Tuple(age=3, name='a'))
+        >>> t == Tuple(age=3,name='a'), t == Tuple(age=3), hash(t) == hash(t)
+        (True, False, True)
+        >>> t.age = 4
+        Traceback (most recent call last):
+          ...
+        AttributeError: Tuples are immutable
+        >>> t._asdict() == {'name':'a','age':3}
+        True
+    """
+    __slots__ = ('_layout','_values','_hash')
+
+    def __init__(self,**fields):
+        names = tuple(sorted(fields))
+        object.__setattr__(self,'_layout',_tupleLayout(names))
+        object.__setattr__(self,'_values',tuple([fields[n] for n in names]))
+        object.__setattr__(self,'_hash',None)
+
+    @classmethod
+    def _fromLayout(cls,layout,values):
+        # Create a tuple with fields sorted as in the layout
+        newTuple = object.__new__(cls)
+        object.__setattr__(newTuple,'_layout',layout)
+        object.__setattr__(newTuple,'_values',values)
+        object.__setattr__(newTuple,'_hash',None)
+        return newTuple
+
+    @property
+    def _fields(self):
+        return self._layout[0]
+
+    def _asdict(self):
+        return dict(zip(self._layout[0],self._values))
+
+    def __getattr__(self,name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._values[self._layout[1][name]]
+        except KeyError:
+            raise AttributeError("Tuple has no field '%s'" % name)
+
+    def __getitem__(self,name):
+        try:
+            return self._values[self._layout[1][name]]
+        except KeyError:
+            raise Invalid("Tuple has no field '%s'" % name)
+
+    def __setattr__(self,name,value):
+        raise AttributeError('Tuples are immutable')
+
+    def __delattr__(self,name):
+        raise AttributeError('Tuples are immutable')
+
+    def __reduce__(self):
+        return (_makeTuple,(self._layout[0],self._values))
+
+    def __eq__(self,value):
+        return (isinstance(value,Tuple)
+                and self._layout[0] == value._layout[0]
+                and self._values == value._values)
+
+    def __ne__(self,value):
+        return not self.__eq__(value)
+
+    def __hash__(self):
+        if self._hash is None:
+            object.__setattr__(
+                self,'_hash',hash((self._layout[0],self._values)))
+        return self._hash
+
+    def __str__(self):
+        body = ", ".join(['%s=%r' % field
+                          for field in zip(self._layout[0],self._values)])
+        return 'Tuple(%s)' % body
+
+    def __repr__(self):
+        return self.__str__()
+
+
+
+
+#------------------------------------------------------------------------------
+#   Builders
+#------------------------------------------------------------------------------
+
+class CollectionBuilder(object):
+    """
+    Base class for mutable builders of collections (see Set.builder(),
+    Bag.builder() and Seq.builder()). Elements are added in place and the
+    collection is obtained with freeze(), without copying the elements.
+    A builder cannot be used anymore once frozen.
+    """
+    def __init__(self,collectionClass,representation):
+        self.collectionClass = collectionClass
+        self.representation = representation
+
+    def _current(self):
+        if self.representation is None:
+            raise Invalid('The builder has already been frozen.')
+        return self.representation
+
+    def freeze(self):
+        representation = self._current()
+        self.representation = None
+        return self._freeze(representation)
+
+    def size(self):
+        return len(self._current())
+
+    def __len__(self):
+        return self.size()
+
+
+class SetBuilder(CollectionBuilder):
+    """
+    Examples:
+        >>> b = Set.builder()
+        >>> b.add(1).add(2).addAll([2,3,4]).remove(4).size()
+        3
+        >>> b.freeze() == Set(1,2,3)
+        True
+        >>> b.add(5)
+        Traceback (most recent call last):
+          ...
+        Invalid: The builder has already been frozen.
+    """
+    def __init__(self,collectionClass=None):
+        super(SetBuilder,self).__init__(
+            Set if collectionClass is None else collectionClass,set())
+
+    def add(self,value):
+        self._current().add(value)
+        return self
+
+    def addAll(self,values):
+        self._current().update(values)
+        return self
+
+    def remove(self,value):
+        self._current().discard(value)
+        return self
+
+    def _freeze(self,theSet):
+        if self.collectionClass is Set:
+            return Set._fromSet(theSet)
+        else:
+            return self.collectionClass.new(theSet)
+
+
+class BagBuilder(CollectionBuilder):
+    """
+    remove(value) removes all the occurrences of the value, as excluding.
+
+    Examples:
+        >>> b = Bag.builder()
+        >>> b.add(1).add(1).addAll(Bag(2,2,3)).remove(3).size()
+        4
+        >>> b.freeze() == Bag(1,1,2,2)
+        True
+    """
+    def __init__(self,collectionClass=None):
+        super(BagBuilder,self).__init__(
+            Bag if collectionClass is None else collectionClass,Counter())
+
+    def add(self,value,count=1):
+        self._current()[value] += count
+        return self
+
+    def addAll(self,values):
+        if isinstance(values,Bag):
+            counter = self._current()
+            for (e,n) in values.theCounter.iteritems():
+                counter[e] += n
+        else:
+            # Counter.update deals with iterables and counters
+            self._current().update(values)
+        return self
+
+    def remove(self,value):
+        self._current().pop(value,None)
+        return self
+
+    def size(self):
+        return sum(self._current().itervalues())
+
+    def _freeze(self,theCounter):
+        if self.collectionClass is Bag:
+            # Remove the 0 and negative elements, as in Bag.new. This is
+            # done in place: Counter += Counter() would copy the counter.
+            for e in [e for (e,n) in theCounter.iteritems() if n <= 0]:
+                del theCounter[e]
+            return Bag._fromCounter(theCounter)
+        else:
+            return self.collectionClass.new(theCounter)
+
+
+class SeqBuilder(CollectionBuilder):
+    """
+    remove(value) removes all the occurrences of the value, as excluding.
+
+    Examples:
+        >>> b = Seq.builder()
+        >>> b.add(1).add(2).addAll([3,1]).remove(1).size()
+        2
+        >>> b.freeze() == Seq(2,3)
+        True
+    """
+    def __init__(self,collectionClass=None):
+        super(SeqBuilder,self).__init__(
+            Seq if collectionClass is None else collectionClass,[])
+
+    def add(self,value):
+        self._current().append(value)
+        return self
+
+    def addAll(self,values):
+        self._current().extend(_elementsOf(values))
+        return self
+
+    def remove(self,value):
+        self._current()[:] = [e for e in self._current() if e != value]
+        return self
+
+    def _freeze(self,theList):
+        if self.collectionClass is Seq:
+            return Seq._fromList(theList)
+        else:
+            return self.collectionClass.new(theList)
+
+
+def _membershipOf(values):
+    # A container efficient for membership tests, even for unhashable values
+    values = list(_elementsOf(values))
+    try:
+        return set(values)
+    except TypeError:
+        return values
+
+
+#------------------------------------------------------------------------------
+#   Lazy collections
+#------------------------------------------------------------------------------
+
+# A lazy collection streams (element,count) pairs through the recorded
+# operations. For sets and sequences the count is always 1, for bags each
+# distinct element is processed only once with its number of occurrences,
+# as in Bag.select and Bag.collectNested.
+
+def _lazySelect(pairs,test):
+    for (e,n) in pairs:
+        if test(e):
+            yield (e,n)
+
+def _lazyReject(pairs,test):
+    for (e,n) in pairs:
+        if not test(e):
+            yield (e,n)
+
+def _lazyCollectNested(pairs,function):
+    for (e,n) in pairs:
+        yield (function(e),n)
+
+def _lazyCollect(pairs,function):
+    for (e,n) in pairs:
+        r = function(e)
+        if isCollection(r):
+            for x in _leaves(r):
+                yield (x,n)
+        else:
+            yield (r,n)
+
+
+def _lazyFlatten(pairs,unused):
+    for (e,n) in pairs:
+        if isCollection(e):
+            for x in _leaves(e):
+                yield (x,n)
+        else:
+            yield (e,n)
+
+def _navigationStep(values,accessor):
+    for v in values:
+        r = accessor(v)
+        if isCollection(r):
+            for x in _leaves(r):
+                yield x
+        else:
+            yield r
+
+def _lazyNavigate(pairs,accessors):
+    # The steps are chained generators, so the whole path is walked in a
+    # single pass without building any intermediate collection.
+    for (e,n) in pairs:
+        values = (e,)
+        for accessor in accessors:
+            values = _navigationStep(values,accessor)
+        for v in values:
+            yield (v,n)
+
+def _lazyUnique(pairs,unused):
+    visited = _VisitedSet()
+    for (e,n) in pairs:
+        if visited.add(e):
+            yield (e,n)
+
+
+class LazyCollection(object):
+    """
+    Lazy view on a collection recording select/reject/collect operations.
+
+    No intermediate collection is built: the operations are executed in a
+    single streaming pass when a terminal operation is called (size, sum,
+    forAll, exists, asSet, iteration, ...). The kind of the result is the
+    one OCL would give: select and reject keep the kind of the source;
+    collect and collectNested produce a Seq from a Seq and a Bag otherwise.
+    Lazy collections are immutable, so a partial pipeline can be reused.
+    Comparisons and hashing force the evaluation: a lazy collection is
+    equal to the collection it evaluates to.
+
+    Examples:
+        >>> s = Set(1,2,3,4,5).lazy().select(lambda e:e>1)
+        >>> s.reject(lambda e:e==4).asCollection() == Set(2,3,5)
+        True
+        >>> s.collect(lambda e:e%2).asCollection() == Bag(0,0,1,1)
+        True
+        >>> s.collect(lambda e:e%2).asSet() == Set(0,1)
+        True
+        >>> Seq(3,1,2).lazy().collect(lambda e:Seq(e,e)).asCollection() \
+                == Seq(3,3,1,1,2,2)
+        True
+        >>> Bag(1,1,2).lazy().collect('_*10').sum()
+        40
+        >>> Set(1,2,3).lazy().select('_>1').size()
+        2
+        >>> Seq(1,2).lazy() == Seq(1,2), Seq(1,2) == Seq(1,2).lazy()
+        (True, True)
+        >>> Set(1,2).lazy().collect('_%2') != Bag(0,1)
+        False
+        >>> hash(Set(1,2).lazy()) == hash(Set(2,1))
+        True
+    """
+
+    def __init__(self,source,kind=None,operations=()):
+        self.source = source
+        self.kind = type(source) if kind is None else kind
+        self.operations = operations
+
+    @classmethod
+    def new(cls,anyCollection=()):
+        return asCollection(anyCollection).lazy()
+
+    def _then(self,operation,function,kind=None):
+        return self._derive(
+            self.kind if kind is None else kind,
+            self.operations+((operation,function),))
+
+    def _derive(self,kind,operations):
+        return LazyCollection(self.source,kind,operations)
+
+    def _sourcePairs(self):
+        if isinstance(self.source,Bag):
+            return self.source.theCounter.iteritems()
+        else:
+            return ((e,1) for e in self.source)
+
+    def _pairs(self):
+        pairs = self._sourcePairs()
+        for (operation,function) in self.operations:
+            pairs = operation(pairs,function)
+        return pairs
+
+    def _collectKind(self):
+        return Seq if issubclass(self.kind,(Seq,OrderedSet)) else Bag
+
+    #---- operations recorded -------------------------------------------------
+
+    def lazy(self):
+        return self
+
+    def select(self,predicate):
+        return self._then(_lazySelect,compilePredicate(predicate))
+
+    def reject(self,predicate):
+        return self._then(_lazyReject,compilePredicate(predicate))
+
+    def selectByKind(self,aType):
+        return self.select(lambda e:oclIsKindOf(e,aType))
+
+    def selectByType(self,aType):
+        return self.select(lambda e:oclIsTypeOf(e,aType))
+
+    def collectNested(self,expression):
+        return self._then(
+            _lazyCollectNested,compileExpression(expression),
+            self._collectKind())
+
+    def collect(self,expression):
+        return self._then(
+            _lazyCollect,compileExpression(expression),
+            self._collectKind())
+
+    def flatten(self):
+        """
+        Record a flatten operation. Nested collections are flatten during
+        the final pass, so no level of nesting is built in memory.
+
+        Examples:
+            >>> s = Set(Set(1,2),Seq(2,Bag(3)),4).lazy().flatten()
+            >>> s.size(), s.asCollection() == Set(1,2,3,4)
+            (4, True)
+            >>> Seq(Seq(1,2),Seq(Seq(2))).lazy().flatten().asSeq()
+            Seq(1, 2, 2)
+        """
+        flat = self._then(_lazyFlatten,None)
+        if issubclass(self.kind,(Set,OrderedSet)):
+            # nested sets can share elements
+            return flat._then(_lazyUnique,None)
+        else:
+            return flat
+
+    def navigate(self,path):
+        """
+        Record a navigation along a path of attributes. Consecutive
+        navigations are fused into a single one.
+
+        Examples:
+            >>> class N(object):
+            ...     def __init__(self,v,*next):
+            ...         self.v = v
+            ...         self.next = list(next)
+            >>> nodes = Seq(N(1,N(2),N(3,N(4))),N(5))
+            >>> nodes.lazy().next.next.v.asSeq()
+            Seq(4)
+            >>> len(nodes.lazy().next.next.operations)
+            1
+        """
+        accessors = _navigationPath(path)
+        if self.operations and self.operations[-1][0] is _lazyNavigate:
+            (_,previous) = self.operations[-1]
+            return self._derive(
+                self.kind,
+                self.operations[:-1]+((_lazyNavigate,previous+accessors),))
+        else:
+            return self._then(_lazyNavigate,accessors,self._collectKind())
+
+    def __getattr__(self,name):
+        """
+        Operations of the collection kind that are not recorded lazily
+        (including, union, at, ...) are executed on the forced collection.
+        Other names are navigations, as on collections.
+
+        Examples:
+            >>> Set(1,2).lazy().including(3) == Set(1,2,3)
+            True
+            >>> Seq(1,2).lazy().collect('_*2').at(2)
+            4
+            >>> Set(1j).lazy().imag.asSet()
+            Set(1.0)
+        """
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if callable(getattr(self.kind,name,None)):
+            return getattr(self._forced(),name)
+        if not _IMPLICIT_NAVIGATION:
+            raise AttributeError(name)
+        return self.navigate(name)
+
+    #---- terminal operations -------------------------------------------------
+
+    def size(self):
+        return sum(n for (e,n) in self._pairs())
+
+    def __len__(self):
+        return self.size()
+
+    def isEmpty(self):
+        for _ in self._pairs():
+            return False
+        return True
+
+    def notEmpty(self):
+        return not self.isEmpty()
+
+    def count(self,value):
+        return sum(n for (e,n) in self._pairs() if e == value)
+
+    def includes(self,value):
+        for (e,n) in self._pairs():
+            if e == value:
+                return True
+        return False
+
+    def __contains__(self,value):
+        return self.includes(value)
+
+    def excludes(self,value):
+        return not self.includes(value)
+
+    def sum(self):
+        return sum(e*n for (e,n) in self._pairs())
+
+    def max(self):
+        return max(e for (e,n) in self._pairs())
+
+    def min(self):
+        return min(e for (e,n) in self._pairs())
+
+    def forAll(self,predicate):
+        test = compilePredicate(predicate)
+        for (e,n) in self._pairs():
+            if not test(e):
+                return False
+        return True
+
+    def exists(self,predicate):
+        test = compilePredicate(predicate)
+        for (e,n) in self._pairs():
+            if test(e):
+                return True
+        return False
+
+    def forAll2(self,predicate,symmetric=False):
+        return self.forAllN(predicate,2,symmetric)
+
+    def exists2(self,predicate,symmetric=False):
+        return self.existsN(predicate,2,symmetric)
+
+    def forAllN(self,predicate,arity,symmetric=False):
+        return _quantify(self._pairs(),predicate,arity,symmetric,True)
+
+    def existsN(self,predicate,arity,symmetric=False):
+        return _quantify(self._pairs(),predicate,arity,symmetric,False)
+
+    def one(self,predicate):
+        test = compilePredicate(predicate)
+        found = 0
+        for (e,n) in self._pairs():
+            if test(e):
+                found += n
+                if found > 1:
+                    return False
+        return found == 1
+
+    def any(self,predicate):
+        test = compilePredicate(predicate)
+        for (e,n) in self._pairs():
+            if test(e):
+                return e
+        raise Invalid(".any(...) failed: No such element.")
+
+    def sortedBy(self,expression):
+        return self.asCollection().sortedBy(expression)
+
+    def iterate(self,body,initial):
+        return _iterate(self._pairs(),body,initial)
+
+    def product(self,anyCollection):
+        return Product(self.asCollection(),anyCollection)
+
+    def asSet(self):
+        return Set.new(e for (e,n) in self._pairs())
+
+    def asBag(self):
+        counter = Counter()
+        size = 0
+        for (e,n) in self._pairs():
+            counter[e] += n
+            size += n
+        return Bag._fromCounter(counter,size)
+
+    def asSeq(self):
+        return Seq._fromList(list(self.__iter__()))
+
+    def asOrderedSet(self):
+        return OrderedSet.new(e for (e,n) in self._pairs())
+
+    def asCollection(self):
+        if issubclass(self.kind,Set):
+            return self.asSet()
+        elif issubclass(self.kind,Bag):
+            return self.asBag()
+        elif issubclass(self.kind,OrderedSet):
+            return self.asOrderedSet()
+        else:
+            return self.asSeq()
+
+    def emptyCollection(self):
+        return self.kind.new()
+
+    def _forced(self):
+        # The collection this lazy collection evaluates to
+        return LazyCollection.asCollection(self)
+
+    def __eq__(self,value):
+        if isinstance(value,LazyCollection):
+            value = value._forced()
+        return self._forced() == value
+
+    def __ne__(self,value):
+        return not self.__eq__(value)
+
+    def __hash__(self):
+        return hash(self._forced())
+
+    def __iter__(self):
+        for (e,n) in self._pairs():
+            if n == 1:
+                yield e
+            else:
+                for _ in xrange(n):
+                    yield e
+
+    def __str__(self):
+        return 'Lazy%s' % self.asCollection()
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class Stream(LazyCollection):
+    """
+    One-pass collection over an iterator or a generator.
+
+    Elements are not materialized: exists, forAll, any, one and includes
+    stop as soon as the result is known, select, reject and collect
+    return streams, and the elements are stored only when an explicit
+    conversion (asSet, asBag, asSeq) is requested. As the underlying
+    iterator can be consumed only once, a stream (or any stream derived
+    from it) can be traversed only once.
+
+    Examples:
+        >>> def naturals():
+        ...     n = 0
+        ...     while True:
+        ...         yield n
+        ...         n += 1
+        >>> asCollection(naturals()).exists(lambda e:e>100)
+        True
+        >>> asCollection(naturals()).select(lambda e:e%2==0).includes(10)
+        True
+        >>> s = asCollection(iter([3,1,2,1]))
+        >>> isinstance(s,Stream)
+        True
+        >>> s.collect(lambda e:e*10).asSeq() == Seq(30,10,20,10)
+        True
+        >>> s.size()
+        Traceback (most recent call last):
+          ...
+        Invalid: Stream already consumed.
+    """
+
+    def __init__(self,iterator,kind=Seq,operations=(),state=None):
+        super(Stream,self).__init__(iterator,kind,operations)
+        # shared by all the streams derived from the same iterator
+        self._state = {'consumed': False} if state is None else state
+
+    @classmethod
+    def new(cls,anyCollection=()):
+        return cls(iter(anyCollection))
+
+    def _derive(self,kind,operations):
+        return Stream(self.source,kind,operations,self._state)
+
+    def _sourcePairs(self):
+        if self._state['consumed']:
+            raise Invalid('Stream already consumed.')
+        self._state['consumed'] = True
+        return ((e,1) for e in self.source)
+
+    def sortedBy(self,expression):
+        return self.asSeq().sortedBy(expression)
+
+    def __len__(self):
+        # Raising TypeError (and not consuming the stream) allows list()
+        # and other builtins to ignore the length hint.
+        raise TypeError('Streams have no len(). Use size() instead.')
+
+    def asCollection(self):
+        return self
+
+    def emptyCollection(self):
+        return Stream(iter(()))
+
+    def __str__(self):
+        return 'Stream(...)'
+
+
+_PRODUCT_LAYOUT = _tupleLayout(('first','second'))
+
+
+def _distinctElements(collection):
+    # A Set or an OrderedSet with the elements of the collection
+    collection = asCollection(collection)
+    if isinstance(collection,(Set,OrderedSet)):
+        return collection
+    elif isinstance(collection,Bag):
+        return Set.new(collection.theCounter.iterkeys())
+    else:
+        return OrderedSet.new(collection)
+
+
+class Product(LazyCollection):
+    """
+    Lazy cartesian product of two collections, that is the Set of the
+    tuples Tuple(first=e1,second=e2). See Collection.product.
+
+    The tuples are created only when they are enumerated. Without further
+    operations, size, isEmpty and includes are computed from the two
+    collections, without enumerating the product.
+
+    Examples:
+        >>> p = Set.new(range(10000)).product(Seq.new(range(10000)))
+        >>> p.size(), p.includes(Tuple(first=3,second=4))
+        (100000000, True)
+        >>> Seq(1,2).product(Bag('a','a')).asSeq()
+        Seq(Tuple(first=1, second='a'), Tuple(first=2, second='a'))
+        >>> q = Seq(0,1,2).product(Set(0,1))
+        >>> q.select(lambda t:t.first+t.second < 2).asCollection() \
+                == Set(Tuple(first=0,second=0),Tuple(first=0,second=1), \
+                       Tuple(first=1,second=0))
+        True
+    """
+
+    def __init__(self,first,second,kind=Set,operations=()):
+        super(Product,self).__init__(
+            (_distinctElements(first),_distinctElements(second)),
+            kind,operations)
+
+    def _derive(self,kind,operations):
+        derived = object.__new__(Product)
+        LazyCollection.__init__(derived,self.source,kind,operations)
+        return derived
+
+    def _sourcePairs(self):
+        (first,second) = self.source
+        layout = _PRODUCT_LAYOUT
+        for e1 in first:
+            for e2 in second:
+                yield (Tuple._fromLayout(layout,(e1,e2)),1)
+
+    def size(self):
+        if self.operations:
+            return super(Product,self).size()
+        (first,second) = self.source
+        return first.size() * second.size()
+
+    def isEmpty(self):
+        if self.operations:
+            return super(Product,self).isEmpty()
+        (first,second) = self.source
+        return first.isEmpty() or second.isEmpty()
+
+    def includes(self,value):
+        if self.operations:
+            return super(Product,self).includes(value)
+        (first,second) = self.source
+        return (isinstance(value,Tuple)
+                and value._fields == _PRODUCT_LAYOUT[0]
+                and first.includes(value.first)
+                and second.includes(value.second))
+
+    def __str__(self):
+        return 'Product(%s, %s)' % self.source
+
+
+
+
+
+
+
+#==============================================================================
+#     Conversions
+#==============================================================================
+
+
+
+
+import collections
+
+
+class ConversionRule(object):
+    def __init__(self,language,sourceType,collectionType):
+        self.language = language
+        self.sourceType = sourceType
+        self.collectionType = collectionType
+    def accept(self,value):
+        return isinstance(value,self.sourceType)
+    def asCollection(self,value):
+        return self.collectionType.new(value)
+    def emptyCollection(self):
+        return self.collectionType.new()
+
+from collections import OrderedDict
+
+
+class Converter(object):
+    """
+    Conversion rules from python/java/ocl collections to ocl collections.
+
+    Both isCollection and findRule are resolved once per concrete type and
+    then dispatched through a table, including for types that are not
+    collections. These tables are invalidated when rules are registered.
+    """
+    def __init__(self):
+        self.rules = OrderedDict()
+        self.language_collections = OrderedDict()
+        self.all_collections = []
+        self.invalidateCaches()
+
+    def registerConversionRules(self,language,conversionList):
+        for (source,target) in conversionList:
+            rule = ConversionRule(language,source,target)
+            self.rules[source] = rule
+            if language not in self.language_collections:
+                self.language_collections[language] = []
+            self.language_collections[language].append(source)
+            self.all_collections.append(source)
+        self.invalidateCaches()
+
+    def invalidateCaches(self):
+        """
+        Forget the types resolved so far.
+        """
+        # concrete type -> rule, or None if the type cannot be converted
+        self._ruleCache = {}
+        # language -> concrete type -> bool. None stands for all languages.
+        self._collectionCache = {None:{}}
+        # language -> tuple of source types
+        self._sourceTypes = {}
+
+    def isCollection(self,value,language=None):
+        """
+        Examples:
+            >>> class MyList(list): pass
+            >>> CONVERTER.isCollection(MyList()), CONVERTER.isCollection('ab')
+            (True, False)
+            >>> CONVERTER.isCollection(Set(),'ocl')
+            True
+            >>> CONVERTER.isCollection(3), CONVERTER.isCollection(4)
+            (False, False)
+        """
+        valueType = _concreteType(value)
+        try:
+            return self._collectionCache[language][valueType]
+        except KeyError:
+            return self._resolveIsCollection(value,valueType,language)
+
+    def _resolveIsCollection(self,value,valueType,language):
+        if isinstance(value,basestring):
+            result = False
+        else:
+            sources = self._sourceTypes.get(language)
+            if sources is None:
+                if language is None:
+                    sources = tuple(self.all_collections)
+                else:
+                    sources = tuple(self.language_collections[language])
+                self._sourceTypes[language] = sources
+            result = isinstance(value,sources)
+        self._collectionCache.setdefault(language,{})[valueType] = result
+        return result
+
+    def findRule(self,value):
+        """
+        Return the type of the OCL collection corresponding to the given type.
+
+        Raise an exception if no conversion is possible for the given type
+        :param aType: The type to be converted.
+        :type aType: type
+        :return: A collection type.
+        :rtype: type < Collection
+        :raise: ValueError if there is no correspondance possible.
+
+        Examples:
+            >>> class MyCounter(Counter): pass
+            >>> CONVERTER.findRule(MyCounter()).collectionType is Bag
+            True
+            >>> CONVERTER.findRule(iter([])).collectionType is Stream
+            True
+            >>> CONVERTER.findRule(3)
+            Traceback (most recent call last):
+              ...
+            ValueError: getConversionRule(): Can't convert a value of type <type 'int'>
+        """
+        valueType = _concreteType(value)
+        try:
+            rule = self._ruleCache[valueType]
+        except KeyError:
+            rule = self._resolveRule(value,valueType)
+            self._ruleCache[valueType] = rule
+        if rule is None:
+            msg = "getConversionRule(): Can't convert a value of type %s"
+            raise ValueError(msg % valueType)
+        return rule
+
+    def _resolveRule(self,value,valueType):
+        # The most specific type registered in the MRO is used first, so
+        # that for instance a subclass of Set is converted to a Set and
+        # not to a Seq as an Iterable.
+        for aType in inspect.getmro(valueType):
+            if aType in self.rules:
+                return self.rules[aType]
+        # Then abstract types, which are not in the MRO, in the order of
+        # registration.
+        for rule in self.rules.itervalues():
+            if rule.accept(value):
+                return rule
+        return None
+
+    def asCollection(self,value):
+        try:
+            return value.asCollection()
+        except AttributeError:
+            return self.findRule(value).asCollection(value)
+
+    def emptyCollection(self,value):
+        try:
+            return value.emptyCollection()
+        except AttributeError:
+            return self.findRule(value).emptyCollection()
 
     def listAll(self,value):
         """
@@ -1965,6 +4542,7 @@ pythonConversionRules = [   # Order is very important
     (list,Seq),
     (tuple,Seq),
     (collections.deque,Seq),
+    (collections.Iterator,Stream),
     (collections.Iterable,Seq),
     (collections.Iterable,Seq),
 ]
@@ -1974,6 +4552,9 @@ oclConversionRules = [
     (Set,Set),
     (Bag,Bag),
     (Seq,Seq),
+    (OrderedSet,OrderedSet),
+    (LazyCollection,LazyCollection),
+    (Stream,Stream),
 ]
 CONVERTER.registerConversionRules('ocl',oclConversionRules)
 
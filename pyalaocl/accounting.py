@@ -0,0 +1,298 @@
+# coding=utf-8
+"""
+The pyalaocl.accounting module counts the copies made by collection
+operations, to find out which pipelines would benefit from lazy
+collections (see lazy()) or builders (see Set.builder())::
+
+    with accounting() as a:
+        validateModel()
+    print a.text()
+
+While accounting is active, each public operation called from outside
+pyalaocl (e.g. 'Bag.including' called from rules.py line 12) is
+recorded with:
+
+- collections: the number of collection objects created, including
+  those created by the operations it calls internally,
+- elementCopies: the number of elements stored in these collections.
+  Most operations copy the elements of their source into a new set, list
+  or Counter. Persistent collections, whose representation is shared, are
+  not counted,
+- temporaryCopies: the number of elements copied by listAll into lists
+  that were not kept in a collection,
+- peakMemory: the growth of the resident memory of the process during
+  the operation, in bytes, if accounting(traceMemory=True) is used. The
+  peak resident size is reset before each operation through
+  /proc/self/clear_refs, so this requires Linux. Memory freed before the
+  operation and reused by it is not counted, and memory allocated by
+  other threads is, so this is an estimate.
+
+Collections created directly by the caller, e.g. Set(1,2), are recorded
+as 'Set()'. Records are grouped by operation and call site.
+
+Examples:
+    >>> from pyalaocl import Set, Bag, Seq
+    >>> with accounting() as a:
+    ...     b = Bag.new(range(10)*2)
+    ...     b = b.including(3).including(4)
+    >>> [stats] = [s for ((name,site),s) in a.sites.items()
+    ...            if name == 'Bag.including']
+    >>> stats.calls, stats.collections, stats.elementCopies
+    (2, 2, 20)
+    >>> a.operations['Bag.new'].collections
+    1
+    >>> 'Bag.including' in a.text()
+    True
+"""
+
+import os
+import sys
+
+import pyalaocl
+from pyalaocl import profiling
+from pyalaocl.benchmarks import _residentSizes
+
+__all__ = (
+    'accounting',
+    'Accounting',
+    'CopyStats',
+)
+
+_PACKAGE_DIRECTORY = os.path.dirname(os.path.abspath(pyalaocl.__file__))
+
+# (class, name of the attribute containing the representation)
+_REPRESENTATIONS = (
+    (pyalaocl.Set,'theSet'),
+    (pyalaocl.Bag,'theCounter'),
+    (pyalaocl.Seq,'theList'),
+    (pyalaocl.OrderedSet,'theList'),
+)
+
+_CONSTRUCTORS = ('_fromSet','_fromCounter','_fromList')
+
+
+def _callSite():
+    """
+    Return 'file:line' for the innermost frame outside of pyalaocl.
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if os.path.dirname(os.path.abspath(filename)) != _PACKAGE_DIRECTORY:
+            return '%s:%i' % (filename,frame.f_lineno)
+        frame = frame.f_back
+    return '?'
+
+
+def _resetPeak():
+    # Reset the peak resident size of the process (VmHWM)
+    with open('/proc/self/clear_refs','w') as f:
+        f.write('5')
+
+
+def _representationOf(collection):
+    for (cls,attribute) in _REPRESENTATIONS:
+        if isinstance(collection,cls):
+            return getattr(collection,attribute,None)
+    return None
+
+
+class CopyStats(object):
+    """
+    Copies made by an operation, for one call site or for all of them.
+    """
+    __slots__ = ('calls','collections','elementCopies','temporaryCopies',
+                 'peakMemory')
+
+    def __init__(self):
+        self.calls = 0
+        self.collections = 0
+        self.elementCopies = 0
+        self.temporaryCopies = 0
+        self.peakMemory = None
+
+    def add(self,counters,peakMemory):
+        self.calls += 1
+        self.collections += counters.collections
+        self.elementCopies += counters.elementCopies
+        self.temporaryCopies += sum(n for (_,n)
+                                    in counters.temporaries.values())
+        if peakMemory is not None:
+            self.peakMemory = peakMemory if self.peakMemory is None \
+                else max(self.peakMemory,peakMemory)
+
+    def asDict(self):
+        return dict((name,getattr(self,name)) for name in self.__slots__)
+
+
+class _Counters(object):
+    # Copies made by the current top level operation of a thread
+    def __init__(self):
+        self.collections = 0
+        self.elementCopies = 0
+        # id -> (list,size) for the lists returned by listAll
+        self.temporaries = {}
+
+
+class Accounting(profiling.Profile):
+    """
+    Copies counted while accounting is active. sites maps pairs (operation
+    name, call site) to CopyStats, operations maps operation names to
+    CopyStats for all call sites.
+    """
+
+    def __init__(self,traceMemory=False):
+        super(Accounting,self).__init__()
+        if traceMemory:
+            try:
+                _resetPeak()
+                _residentSizes()
+            except (IOError,OSError,KeyError):
+                raise pyalaocl.Invalid(
+                    'traceMemory requires Linux (/proc/self/clear_refs).')
+        self.traceMemory = traceMemory
+        self.sites = {}
+
+    #---- instrumentation -----------------------------------------------------
+
+    def _install(self):
+        super(Accounting,self)._install()
+        for (cls,_) in _REPRESENTATIONS:
+            self._hook(cls,'__init__',self._wrapInit)
+            for name in _CONSTRUCTORS:
+                if isinstance(cls.__dict__.get(name),classmethod):
+                    self._hook(cls,name,self._wrapConstructor)
+        self._hook(pyalaocl,'listAll',self._wrapListAll)
+
+    def _hook(self,owner,name,wrapper):
+        value = owner.__dict__[name]
+        self._originals.append((owner,name,value))
+        if isinstance(value,classmethod):
+            setattr(owner,name,classmethod(wrapper(value.__func__)))
+        else:
+            setattr(owner,name,wrapper(value))
+
+    def _wrapInit(self,function):
+        accounting = self
+
+        def __init__(collection,*args,**kwargs):
+            function(collection,*args,**kwargs)
+            accounting._created(collection)
+        return __init__
+
+    def _wrapConstructor(self,function):
+        accounting = self
+
+        def constructor(cls,*args,**kwargs):
+            collection = function(cls,*args,**kwargs)
+            accounting._created(collection)
+            return collection
+        constructor.__name__ = function.__name__
+        return constructor
+
+    def _wrapListAll(self,function):
+        accounting = self
+
+        def listAll(value):
+            result = function(value)
+            counters = accounting._counters()
+            if counters is not None and result is not value:
+                counters.temporaries[id(result)] = (result,len(result))
+            return result
+        return listAll
+
+    #---- counting ------------------------------------------------------------
+
+    def _counters(self):
+        return getattr(self._local,'counters',None)
+
+    def _created(self,collection):
+        counters = self._counters()
+        if counters is None:
+            # created by the caller, outside of any operation
+            counters = _Counters()
+            self._count(counters,collection)
+            self._record('%s()' % collection.__class__.__name__,
+                         _callSite(),counters,None)
+        else:
+            self._count(counters,collection)
+
+    def _count(self,counters,collection):
+        counters.collections += 1
+        representation = _representationOf(collection)
+        if isinstance(representation,(set,frozenset,list,dict)):
+            # a list copied by listAll is stored, not temporary
+            counters.temporaries.pop(id(representation),None)
+            counters.elementCopies += len(representation)
+
+    def _call(self,function,name,receiver,args,kwargs,withExpression,
+              measure=True):
+        local = self._local
+        if getattr(local,'counters',None) is not None:
+            # nested operations are accounted for in the top level one
+            return function(receiver,*args,**kwargs)
+        counters = local.counters = _Counters()
+        if self.traceMemory:
+            _resetPeak()
+            (start,_) = _residentSizes()
+        try:
+            return function(receiver,*args,**kwargs)
+        finally:
+            local.counters = None
+            peakMemory = None
+            if self.traceMemory:
+                peakMemory = max(0,_residentSizes()[1] - start)
+            self._record(name,_callSite(),counters,peakMemory)
+
+    def _record(self,name,site,counters,peakMemory):
+        with self._lock:
+            for (table,key) in ((self.sites,(name,site)),
+                                (self.operations,name)):
+                if key not in table:
+                    table[key] = CopyStats()
+                table[key].add(counters,peakMemory)
+
+    #---- reports -------------------------------------------------------------
+
+    def asDict(self):
+        """
+        Return the statistics as a dictionary with two entries, operations
+        and sites. Sites are listed with their operation.
+        """
+        return {
+            'operations': dict(
+                (name,stats.asDict())
+                for (name,stats) in self.operations.items()),
+            'sites': [
+                dict(stats.asDict(),operation=name,site=site)
+                for ((name,site),stats) in self.sites.items()],
+        }
+
+    def text(self,limit=30,sortBy='elementCopies'):
+        """
+        Return a textual report of the operations and of the call sites,
+        the most expensive first.
+        """
+        def rows(items):
+            items = sorted(items,key=lambda (k,s):getattr(s,sortBy),
+                           reverse=True)[:limit]
+            return ['%8i %10i %10i %10i %10s  %s' % (
+                s.calls,s.collections,s.elementCopies,s.temporaryCopies,
+                '-' if s.peakMemory is None else s.peakMemory,k)
+                for (k,s) in items]
+        header = '%8s %10s %10s %10s %10s  %s' % (
+            'calls','objects','copies','temporary','peak(B)','%s')
+        lines = [header % 'operation']
+        lines += rows(self.operations.items())
+        lines += ['',header % 'operation / call site']
+        lines += rows(('%s / %s' % key,s)
+                      for (key,s) in self.sites.items())
+        return '\n'.join(lines)
+
+
+def accounting(traceMemory=False):
+    """
+    Return a new Accounting to be used as a context manager. It cannot be
+    used while a profile is active.
+    """
+    return Accounting(traceMemory)
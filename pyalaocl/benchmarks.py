@@ -0,0 +1,668 @@
+# coding=utf-8
+"""
+Benchmarks of the core collection operations.
+
+Each benchmark measures one operation for collections from 10 to 10^6
+elements, with flat data (integers) and/or nested data (collections of
+small collections). Results are written as a JSON document so that runs
+on different commits can be compared::
+
+    python -m pyalaocl.benchmarks --output bench_output.txt
+    python -m pyalaocl.benchmarks --max-size 10000 --compare old.json
+
+With --compare, the ratio to the baseline is printed for each benchmark
+and the exit status is 1 if a benchmark is slower than the threshold.
+
+With --memory, memory benchmarks are run instead::
+
+    python -m pyalaocl.benchmarks --memory --output memory.json
+
+They measure, for sizes from 10^2 to 10^6:
+
+- the bytes per element of Set, Bag, Seq and OrderedSet containing
+  integers, strings or nested collections. The collection objects and
+  their representations (sets, lists, dictionaries) are counted, but not
+  the leaf elements, which are shared with the model,
+- the size of the collection objects themselves, without their elements
+  (the '.wrapper' benchmarks),
+- the peak memory allocated by collect, collectNested/flatten and closure
+  pipelines. tracemalloc is used when available. Otherwise each pipeline
+  is run in a new interpreter and the increase of its maximum resident
+  size is measured (Linux only), so peaks of less than a few hundred
+  kilobytes are not significant. The peak is None when neither is
+  available.
+
+Memory results have bytes and bytesPerElement instead of seconds and
+calls, and are compared in the same way.
+
+Benchmarks can also be run from python. Times are in seconds per call.
+
+Examples:
+    >>> results = run(sizes=[10],names='Seq.new|evaluate')
+    >>> sorted(set(r['name'] for r in results))
+    ['Seq.new', 'evaluate.callable', 'evaluate.string']
+    >>> sorted(results[0].keys())
+    ['calls', 'name', 'seconds', 'shape', 'size']
+    >>> compare([{'name':'a','shape':'flat','size':10,'seconds':2.0}],
+    ...         [{'name':'a','shape':'flat','size':10,'seconds':1.0}])
+    [('a', 'flat', 10, 2.0)]
+    >>> memory = runMemory(sizes=[1000],names='^Seq',shapes=['ints'])
+    >>> [(r['name'],r['size']) for r in memory]
+    [('Seq', 1000), ('Seq.wrapper', 0)]
+    >>> sorted(memory[0].keys())
+    ['bytes', 'bytesPerElement', 'name', 'shape', 'size']
+    >>> memory[0]['bytes'] > 0 and memory[0]['bytesPerElement'] > 0
+    True
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import time
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import pyalaocl
+from pyalaocl import Set, Bag, Seq
+
+__all__ = (
+    'benchmark',
+    'run',
+    'runMemory',
+    'compare',
+    'main',
+)
+
+SIZES = [10, 100, 1000, 10000, 100000, 1000000]
+
+MEMORY_SIZES = [100, 1000, 10000, 100000, 1000000]
+
+# Minimal duration of the measure of one benchmark for one size
+MIN_TIME = 0.2
+
+# Size of the inner collections of nested data
+NESTED_SIZE = 10
+
+
+#==============================================================================
+#   Registry
+#==============================================================================
+
+_BENCHMARKS = []
+
+
+def benchmark(name,shapes=('flat',)):
+    """
+    Decorator registering a benchmark. The decorated function takes a size
+    and a shape ('flat' or 'nested'), prepares the data and returns the
+    function without parameters to measure.
+    """
+    def register(prepare):
+        _BENCHMARKS.append((name,shapes,prepare))
+        return prepare
+    return register
+
+
+#------------------------------------------------------------------------------
+#   Data
+#------------------------------------------------------------------------------
+
+def _elements(size,shape):
+    # size elements in total. Nested data are collections of NESTED_SIZE
+    # elements, but for the smallest sizes.
+    if shape == 'flat':
+        return range(size)
+    n = min(NESTED_SIZE,size)
+    return [Seq.new(range(i,i+n)) for i in xrange(0,size,n)]
+
+
+def _shuffled(size):
+    elements = range(size)
+    random.Random(size).shuffle(elements)
+    return elements
+
+
+#------------------------------------------------------------------------------
+#   Benchmarks
+#------------------------------------------------------------------------------
+
+@benchmark('Set.new',('flat','nested'))
+def _setNew(size,shape):
+    elements = _elements(size,shape)
+    return lambda:Set.new(elements)
+
+
+@benchmark('Bag.new',('flat','nested'))
+def _bagNew(size,shape):
+    elements = [e for e in _elements(size,shape) for _ in (1,2)]
+    return lambda:Bag.new(elements)
+
+
+@benchmark('Seq.new',('flat','nested'))
+def _seqNew(size,shape):
+    elements = _elements(size,shape)
+    return lambda:Seq.new(elements)
+
+
+def _including(kind):
+    def prepare(size,shape):
+        c = kind.new(range(size))
+        return lambda:c.including(-1).excluding(0)
+    return prepare
+
+for _kind in (Set,Bag,Seq):
+    benchmark('%s.including.excluding' % _kind.__name__)(_including(_kind))
+
+
+def _unionIntersection(kind):
+    def prepare(size,shape):
+        c1 = kind.new(range(size))
+        c2 = kind.new(range(size//2,size+size//2))
+        return lambda:(c1.union(c2),c1.intersection(c2))
+    return prepare
+
+for _kind in (Set,Bag):
+    benchmark('%s.union.intersection' % _kind.__name__)(
+        _unionIntersection(_kind))
+
+
+@benchmark('Seq.select',('flat','nested'))
+def _select(size,shape):
+    s = Seq.new(_elements(size,shape))
+    if shape == 'flat':
+        return lambda:s.select(lambda e:e % 2 == 0)
+    return lambda:s.select(lambda e:e.first() % 20 == 0)
+
+
+@benchmark('Seq.collect',('flat','nested'))
+def _collect(size,shape):
+    s = Seq.new(_elements(size,shape))
+    if shape == 'flat':
+        return lambda:s.collect(lambda e:e * 2)
+    return lambda:s.collect(lambda e:e)
+
+
+@benchmark('Bag.collect',('flat','nested'))
+def _bagCollect(size,shape):
+    b = Bag.new(_elements(size,shape))
+    if shape == 'flat':
+        return lambda:b.collect(lambda e:e % 100)
+    return lambda:b.collect(lambda e:e)
+
+
+@benchmark('flatten',('nested',))
+def _flatten(size,shape):
+    s = Seq.new(_elements(size,shape))
+    b = Bag.new(s)
+    return lambda:(s.flatten(),b.flatten())
+
+
+@benchmark('closure',('flat','nested'))
+def _closure(size,shape):
+    if shape == 'flat':
+        # a chain
+        successor = lambda x:x+1 if x+1 < size else None
+    else:
+        # a binary tree
+        successor = lambda x:[y for y in (2*x+1,2*x+2) if y < size]
+    s = Set(0)
+    return lambda:s.closure(successor)
+
+
+@benchmark('Seq.sortedBy')
+def _sortedBy(size,shape):
+    s = Seq.new(_shuffled(size))
+    return lambda:s.sortedBy(lambda e:-e)
+
+
+def _dispatchValues(size):
+    values = [1,'a',[1],set([2]),Set(1),Bag(2),Seq(3),(4,),{5:6},None]
+    return (values*(size//len(values)+1))[:size]
+
+
+@benchmark('isCollection')
+def _isCollection(size,shape):
+    values = _dispatchValues(size)
+    isCollection = pyalaocl.isCollection
+    return lambda:[isCollection(v) for v in values]
+
+
+@benchmark('asCollection')
+def _asCollection(size,shape):
+    values = [v for v in _dispatchValues(size) if pyalaocl.isCollection(v)]
+    asCollection = pyalaocl.asCollection
+    return lambda:[asCollection(v) for v in values]
+
+
+@benchmark('evaluate.callable')
+def _evaluateCallable(size,shape):
+    evaluate = pyalaocl.evaluate
+    function = lambda e:e * 2
+    elements = range(size)
+    return lambda:[evaluate(e,function) for e in elements]
+
+
+@benchmark('evaluate.string')
+def _evaluateString(size,shape):
+    evaluate = pyalaocl.evaluate
+    elements = range(size)
+    return lambda:[evaluate(e,'_ * 2') for e in elements]
+
+
+#==============================================================================
+#   Memory benchmarks
+#==============================================================================
+
+_MEMORY_BENCHMARKS = []
+
+
+def memoryBenchmark(name,shapes=('ints',),measure='structure',sizes=None):
+    """
+    Decorator registering a memory benchmark. As for benchmark, the
+    decorated function takes a size and a shape ('ints', 'strings' or
+    'nested'). According to measure, it returns:
+
+    - 'structure': a collection whose size is measured,
+    - 'wrapper': a collection whose object size is measured,
+    - 'peak': a function without parameters whose peak of memory is
+      measured.
+
+    sizes, if given, replaces the sizes requested.
+    """
+    def register(prepare):
+        _MEMORY_BENCHMARKS.append((name,shapes,measure,sizes,prepare))
+        return prepare
+    return register
+
+
+def _memoryElements(kind,size,shape):
+    if shape == 'ints':
+        return range(size)
+    elif shape == 'strings':
+        return ['e%i' % i for i in xrange(size)]
+    n = min(NESTED_SIZE,size)
+    return [kind.new(range(i,i+n)) for i in xrange(0,size,n)]
+
+
+def _structure(kind):
+    def prepare(size,shape):
+        return kind.new(_memoryElements(kind,size,shape))
+    return prepare
+
+
+def _wrapper(kind):
+    def prepare(size,shape):
+        return kind.new()
+    return prepare
+
+for _kind in (Set,Bag,Seq,pyalaocl.OrderedSet):
+    memoryBenchmark(_kind.__name__,('ints','strings','nested'))(
+        _structure(_kind))
+    memoryBenchmark(_kind.__name__+'.wrapper',measure='wrapper',sizes=[0])(
+        _wrapper(_kind))
+
+
+@memoryBenchmark('collect.peak',measure='peak')
+def _collectPeak(size,shape):
+    s = Seq.new(range(size))
+    return lambda:s.collect(lambda e:Seq(e,-e))
+
+
+@memoryBenchmark('collectNested.flatten.peak',measure='peak')
+def _flattenPeak(size,shape):
+    s = Seq.new(range(size))
+    return lambda:s.collectNested(lambda e:Seq(e,-e)).flatten()
+
+
+@memoryBenchmark('closure.peak',measure='peak')
+def _closurePeak(size,shape):
+    s = Set(0)
+    return lambda:s.closure(
+        lambda x:[y for y in (2*x+1,2*x+2) if y < size])
+
+
+#------------------------------------------------------------------------------
+#   Memory measures
+#------------------------------------------------------------------------------
+
+_CONTAINERS = (set,frozenset,list,tuple,dict)
+
+
+def _attributeValues(value):
+    # Values of the instance attributes, in __dict__ or in slots
+    values = list(getattr(value,'__dict__',{}).values())
+    for cls in type(value).__mro__:
+        for name in cls.__dict__.get('__slots__',()):
+            if name not in ('__dict__','__weakref__'):
+                try:
+                    values.append(getattr(value,name))
+                except AttributeError:
+                    pass
+    return values
+
+
+def _wrapperSize(collection):
+    # Size of the collection object, without its representation
+    size = sys.getsizeof(collection)
+    if hasattr(collection,'__dict__'):
+        size += sys.getsizeof(collection.__dict__)
+    return size
+
+
+def _structureSize(value,seen=None):
+    """
+    Return the number of bytes used by the collections and containers in
+    the value. Leaf elements are not counted.
+    """
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    if isinstance(value,pyalaocl.Collection):
+        seen.add(id(value))
+        return _wrapperSize(value) + sum(
+            _structureSize(v,seen) for v in _attributeValues(value))
+    elif isinstance(value,_CONTAINERS):
+        seen.add(id(value))
+        size = sys.getsizeof(value)
+        if isinstance(value,dict):
+            items = (x for pair in value.iteritems() for x in pair)
+        else:
+            items = value
+        return size + sum(_structureSize(v,seen) for v in items
+                          if isinstance(v,(pyalaocl.Collection,)
+                                        +_CONTAINERS))
+    return 0
+
+
+def _residentSizes():
+    # Current and maximum resident sizes in bytes (Linux only). Unlike
+    # ru_maxrss, VmHWM is not inherited from the parent process.
+    sizes = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(('VmRSS:','VmHWM:')):
+                sizes[line[:5]] = int(line.split()[1]) * 1024
+    return (sizes['VmRSS'],sizes['VmHWM'])
+
+
+def _childPeak(name,size,shape):
+    # Executed in a new interpreter by _isolatedPeak
+    [prepare] = [p for (n,_,measure,_,p) in _MEMORY_BENCHMARKS if n == name]
+    function = prepare(size,shape)
+    gc.collect()
+    (before,_) = _residentSizes()
+    function()
+    (_,peak) = _residentSizes()
+    print max(0,peak-before)
+
+
+def _isolatedPeak(name,size,shape):
+    # The benchmark is run in a new interpreter, as memory freed in this
+    # one would be reused without changing the resident size.
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = os.pathsep.join(
+        [root]+[p for p in [environment.get('PYTHONPATH')] if p])
+    code = ('import pyalaocl.benchmarks as b; b._childPeak(%r,%r,%r)'
+            % (name,size,shape))
+    output = subprocess.check_output([sys.executable,'-c',code],
+                                     env=environment)
+    return int(output.strip())
+
+
+def _peakMemory(name,size,shape,prepare):
+    if tracemalloc is not None and (hasattr(tracemalloc,'reset_peak')
+                                    or not tracemalloc.is_tracing()):
+        function = prepare(size,shape)
+        gc.collect()
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+        else:
+            tracemalloc.start()
+        try:
+            start = tracemalloc.get_traced_memory()[0]
+            function()
+            return tracemalloc.get_traced_memory()[1] - start
+        finally:
+            if not tracing:
+                tracemalloc.stop()
+    elif os.path.exists('/proc/self/status'):
+        return _isolatedPeak(name,size,shape)
+    return None
+
+
+def runMemory(sizes=None,names=None,shapes=None,report=None):
+    """
+    Run the memory benchmarks and return the list of results, that is a
+    list of dictionaries with the keys name, shape, size, bytes and
+    bytesPerElement. Parameters are as for run. Sizes default to
+    MEMORY_SIZES.
+    """
+    results = []
+    for (name,benchmarkShapes,measure,fixedSizes,prepare) \
+            in _MEMORY_BENCHMARKS:
+        if names is not None and not re.search(names,name):
+            continue
+        for shape in benchmarkShapes:
+            if shapes is not None and shape not in shapes:
+                continue
+            for size in fixedSizes or (MEMORY_SIZES if sizes is None
+                                       else sizes):
+                if measure == 'structure':
+                    bytes = _structureSize(prepare(size,shape))
+                elif measure == 'wrapper':
+                    bytes = _wrapperSize(prepare(size,shape))
+                else:
+                    bytes = _peakMemory(name,size,shape,prepare)
+                result = {
+                    'name': name,
+                    'shape': shape,
+                    'size': size,
+                    'bytes': bytes,
+                    'bytesPerElement':
+                        None if bytes is None or size == 0
+                        else float(bytes) / size,
+                }
+                results.append(result)
+                if report is not None:
+                    report(result)
+    return results
+
+
+#==============================================================================
+#   Execution
+#==============================================================================
+
+def _measure(function,minTime):
+    # Return (seconds per call, number of calls). The best of several runs
+    # is kept, as timeit does.
+    timer = timeit.default_timer
+    gcEnabled = gc.isenabled()
+    gc.collect()
+    gc.disable()
+    try:
+        best = None
+        calls = 0
+        start = timer()
+        while calls == 0 or timer() - start < minTime:
+            t0 = timer()
+            function()
+            t = timer() - t0
+            calls += 1
+            best = t if best is None else min(best,t)
+        return (best,calls)
+    finally:
+        if gcEnabled:
+            gc.enable()
+
+
+def run(sizes=None,names=None,shapes=None,minTime=MIN_TIME,report=None):
+    """
+    Run the benchmarks and return the list of results, that is a list of
+    dictionaries with the keys name, shape, size, seconds and calls.
+
+    :param sizes: The sizes of the collections. Default to SIZES.
+    :param names: A regular expression selecting the benchmarks by name.
+    :param shapes: The shapes to run, 'flat' and/or 'nested'.
+    :param minTime: The minimal duration of each measure.
+    :param report: A function called with each result when available.
+    """
+    results = []
+    for (name,benchmarkShapes,prepare) in _BENCHMARKS:
+        if names is not None and not re.search(names,name):
+            continue
+        for shape in benchmarkShapes:
+            if shapes is not None and shape not in shapes:
+                continue
+            for size in (SIZES if sizes is None else sizes):
+                function = prepare(size,shape)
+                (seconds,calls) = _measure(function,minTime)
+                result = {
+                    'name': name,
+                    'shape': shape,
+                    'size': size,
+                    'seconds': seconds,
+                    'calls': calls,
+                }
+                results.append(result)
+                if report is not None:
+                    report(result)
+    return results
+
+
+def compare(results,baseline,threshold=1.2):
+    """
+    Return the list of (name,shape,size,ratio) for results that are slower
+    (or bigger for memory results) than the same benchmark in the baseline
+    by more than the threshold.
+    """
+    def measureOf(r):
+        return r['seconds'] if 'seconds' in r else r['bytes']
+    reference = dict(((r['name'],r['shape'],r['size']),measureOf(r))
+                     for r in baseline)
+    regressions = []
+    for r in results:
+        key = (r['name'],r['shape'],r['size'])
+        if reference.get(key) and measureOf(r) is not None:
+            ratio = float(measureOf(r)) / reference[key]
+            if ratio > threshold:
+                regressions.append(key+(ratio,))
+    return regressions
+
+
+def _gitRevision():
+    try:
+        return subprocess.check_output(
+            ['git','rev-parse','HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT).strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+
+def _metadata():
+    return {
+        'python': sys.version.split()[0],
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'revision': _gitRevision(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def main(argv=None):
+    """
+    Command line entry point. See the documentation of the module.
+    """
+    parser = argparse.ArgumentParser(
+        prog='pyalaocl.benchmarks',
+        description='Benchmarks of pyalaocl collection operations.')
+    parser.add_argument(
+        '--sizes',type=int,nargs='+',default=None,
+        help='sizes of the collections')
+    parser.add_argument(
+        '--max-size',type=int,default=None,
+        help='ignore sizes greater than this one')
+    parser.add_argument(
+        '--filter',default=None,
+        help='regular expression selecting benchmarks by name')
+    parser.add_argument(
+        '--shape',choices=['flat','nested','ints','strings'],
+        action='append',help='run only this shape of data')
+    parser.add_argument(
+        '--min-time',type=float,default=MIN_TIME,
+        help='minimal duration of each measure in seconds')
+    parser.add_argument(
+        '--output',default=None,
+        help='file where the JSON results are written (default: stdout)')
+    parser.add_argument(
+        '--compare',default=None,
+        help='JSON results of a previous run used as a baseline')
+    parser.add_argument(
+        '--threshold',type=float,default=1.2,
+        help='ratio to the baseline above which a result is a regression')
+    parser.add_argument(
+        '--memory',action='store_true',
+        help='run the memory benchmarks instead of the speed benchmarks')
+    parser.add_argument(
+        '--list',action='store_true',
+        help='list the benchmarks and exit')
+    options = parser.parse_args(argv)
+
+    if options.list:
+        for (name,shapes,_) in _BENCHMARKS:
+            print '%-30s %s' % (name,', '.join(shapes))
+        for (name,shapes,measure,_,_) in _MEMORY_BENCHMARKS:
+            print '%-30s %s (memory)' % (name,', '.join(shapes))
+        return 0
+    sizes = options.sizes or (MEMORY_SIZES if options.memory else SIZES)
+    sizes = [s for s in sizes
+             if options.max_size is None or s <= options.max_size]
+
+    def report(r):
+        if 'seconds' in r:
+            measure = '%12.6f s' % r['seconds']
+        else:
+            measure = '%12s B' % r['bytes']
+        sys.stderr.write('%-30s %-7s %8i %s\n'
+                         % (r['name'],r['shape'],r['size'],measure))
+
+    if options.memory:
+        results = runMemory(sizes,options.filter,options.shape,report)
+    else:
+        results = run(sizes,options.filter,options.shape,options.min_time,
+                      report)
+    document = {'metadata': _metadata(),'results': results}
+    text = json.dumps(document,indent=1,sort_keys=True)
+    if options.output is None:
+        print text
+    else:
+        with open(options.output,'w') as f:
+            f.write(text+'\n')
+
+    if options.compare is not None:
+        with open(options.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results,baseline,options.threshold)
+        for (name,shape,size,ratio) in regressions:
+            sys.stderr.write('REGRESSION %s %s %i: %.2f times %s\n'
+                             % (name,shape,size,ratio,
+                                'bigger' if options.memory else 'slower'))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
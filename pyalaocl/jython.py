@@ -24,7 +24,7 @@ if _WITH_JYTHON:
 
 
     # noinspection PyClassicStyleClass
-    class JavaCollectionExtension(pyalaocl.GenericCollection):
+    class JavaCollectionExtension:  # old-class style required
         # Defined in java
         # size()  java native
         # __len__ jython
@@ -70,6 +70,12 @@ if _WITH_JYTHON:
         def excluding(self,value):
             return self.asCollection().excluding(value)
 
+        def includingAll(self,values):
+            return self.asCollection().includingAll(values)
+
+        def excludingAll(self,values):
+            return self.asCollection().excludingAll(values)
+
         def union(self,anyCollection):
             return self.asCollection().union(anyCollection)
 
@@ -90,14 +96,14 @@ if _WITH_JYTHON:
         def flatten(self):
             return self.asCollection().flatten()
 
-        def select(self,expression):
-            return self.asCollection().select(expression)
+        def select(self,expression,**options):
+            return self.asCollection().select(expression,**options)
 
-        def collectNested(self,expression):
-            return self.asCollection().collectNested(expression)
+        def collectNested(self,expression,**options):
+            return self.asCollection().collectNested(expression,**options)
 
-        def sortedBy(self,expression):
-            return self.asCollection().sortedBy(expression)
+        def sortedBy(self,expression,**options):
+            return self.asCollection().sortedBy(expression,**options)
 
         def asSet(self):
             return pyalaocl.Set.new(self)
@@ -108,6 +114,9 @@ if _WITH_JYTHON:
         def asSeq(self):
             return pyalaocl.Seq.new(self)
 
+        def asOrderedSet(self):
+            return pyalaocl.OrderedSet.new(self)
+
         # abstract method
         def asCollection(self):
             raise NotImplementedError()
@@ -116,6 +125,9 @@ if _WITH_JYTHON:
         def emptyCollection(self):
             raise NotImplementedError()
 
+    # GenericCollection is a new-style class, so its operations are copied
+    pyalaocl._copyGenericOperations(JavaCollectionExtension)
+
 
 
 
@@ -228,6 +240,8 @@ if _WITH_JYTHON:
 
         pyalaocl.utils.injector.addSuperclass(JavaSetExtension,JAVA_JDK_SETS)
         pyalaocl.utils.injector.addSuperclass(JavaListExtension,JAVA_JDK_LISTS)
+        for javaClass in JAVA_JDK_COLLECTIONS:
+            pyalaocl.GenericCollection.register(javaClass)
 
 
     load()
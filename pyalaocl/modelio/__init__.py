@@ -89,6 +89,7 @@ if WITH_MODELIO:
     ]
 
     import inspect
+    import types
 
 
     import pyalaocl
@@ -477,14 +478,23 @@ if WITH_MODELIO:
             return isMetaClass(value1)
 
         # TODO log print '    Registering Modelio isKindOf/isTypeOf functions ...',
-        pyalaocl.registerIsKindOfFunction(_isKindOf)
-        pyalaocl.registerIsTypeOfFunction(_isTypeOf)
+        # The results depend only on the java class of the value, so they
+        # can be memoized.
+        pyalaocl.registerIsKindOfFunction(
+            _isKindOf,typeKind=(MClass,JavaClass),cacheable=True)
+        pyalaocl.registerIsTypeOfFunction(
+            _isTypeOf,typeKind=(MClass,JavaClass),cacheable=True)
         # The function works both for Kind and Type since no hierarchy
-        pyalaocl.registerIsKindOfFunction(_isTypeOfMetaInterface)
-        pyalaocl.registerIsTypeOfFunction(_isTypeOfMetaInterface)
-        # The function works both for Kind and Type since no hierarchy
-        pyalaocl.registerIsKindOfFunction(_isTypeOfMetaClass)
-        pyalaocl.registerIsTypeOfFunction(_isTypeOfMetaClass)
+        pyalaocl.registerIsKindOfFunction(
+            _isTypeOfMetaInterface,typeKind=type)
+        pyalaocl.registerIsTypeOfFunction(
+            _isTypeOfMetaInterface,typeKind=type)
+        # The function works both for Kind and Type since no hierarchy.
+        # MetaClass is an old-style class.
+        pyalaocl.registerIsKindOfFunction(
+            _isTypeOfMetaClass,typeKind=types.ClassType)
+        pyalaocl.registerIsTypeOfFunction(
+            _isTypeOfMetaClass,typeKind=types.ClassType)
         # print 'done'
 
 
@@ -15,7 +15,8 @@ if pyalaocl.modelio.WITH_MODELIO:
         # THIS LIST IS EXTENDED DYNAMICALLY
         #  ...
         #
-        'symbolGroups'
+        'symbolGroups',
+        'stereotypeChildrenIndex',
         #----------------------------------------------------------------------
         #  Stereotypes support
         #----------------------------------------------------------------------
@@ -49,6 +50,7 @@ if pyalaocl.modelio.WITH_MODELIO:
     ]
 
     import pyalaocl
+    import pyalaocl.reachability
     import pyalaocl.utils.injector
     # from  import \
     #    readOnlyPropertyOf, methodOf, export, attributeOf
@@ -141,6 +143,20 @@ if pyalaocl.modelio.WITH_MODELIO:
     def allChildren(self):
         return pyalaocl.Set(self).closure('child').excluding(self).asSet()
 
+    def stereotypeChildrenIndex():
+        """
+        Return a new index of the stereotype hierarchy. It can be used
+        instead of allChildren when many queries are made while the
+        stereotypes do not change, e.g. during a validation::
+
+            index = stereotypeChildrenIndex()
+            children = index.closure(stereotype).excluding(stereotype)
+
+        The index is not updated when the model changes: create a new one
+        or call its invalidate() method.
+        """
+        return pyalaocl.reachability.ReachabilityIndex(None, 'child')
+
     @pyalaocl.utils.injector.methodOf(
         StereotypeImpl, 'metaProperty')
     def new(self, *args, **kwargs):
@@ -279,8 +295,10 @@ if pyalaocl.modelio.WITH_MODELIO:
                     return False
             else:
                 return False
-        pyalaocl.registerIsTypeOfFunction(_isTypeOf)
-        pyalaocl.registerIsKindOfFunction(_isKindOf)
+        # Stereotypes are applied to elements, not to their types, so the
+        # results cannot be memoized.
+        pyalaocl.registerIsTypeOfFunction(_isTypeOf,typeKind=Stereotype)
+        pyalaocl.registerIsKindOfFunction(_isKindOf,typeKind=Stereotype)
 
     def _addGlobalFunctionsIsSTEREOTYPE():
         pass
@@ -0,0 +1,524 @@
+# coding=utf-8
+"""
+The pyalaocl.numeric module provides implementations of sequences and bags
+of numbers based on NumPy arrays. NumPy is optional: it is only needed when
+numeric collections are created.
+
+- NumericSeq stores its elements in an array.
+
+- NumericBag stores the distinct elements in a sorted array and their
+  number of occurrences in a second array.
+
+Elements must be either all integers or all floats. sum, max, min, count,
+includes, asSet, sortedBy('_') and select with simple comparisons like
+'_ > 3', '0 <= _ < 10' or '_ % 2 == 0 and _ != 4' are executed on arrays.
+Other operations are executed as for Seq and Bag and their results are
+regular collections.
+
+These classes are subclasses of Seq and Bag, with the same value
+semantics: a NumericSeq is equal to a Seq with the same elements. Integer
+sums that could overflow 64 bits are computed with Python integers. Float
+sums use the pairwise summation of NumPy, so the last digits may differ
+from a sum computed element by element.
+
+For instance::
+
+    s = NumericSeq.new(range(10))
+    s.select('_ % 3 == 0').sum()        # both computed on the array
+    asNumeric(pyalaocl.Bag(3,1,3,2)).sortedBy('_')
+
+NumPy can be installed with the 'numeric' extra. The examples of this
+module are in __test__ rather than in the docstrings, so that they are
+run only when NumPy is available.
+"""
+
+import ast
+import numbers
+import operator
+from collections import Counter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import pyalaocl
+
+__all__ = (
+    'NumericSeq',
+    'NumericBag',
+    'asNumeric',
+)
+
+
+#==============================================================================
+#   Arrays
+#==============================================================================
+
+_INT64_MAX = 2**63 - 1
+
+
+def _checkNumPy():
+    if numpy is None:
+        raise pyalaocl.Invalid('NumPy is required for numeric collections.')
+
+
+def _isInteger(value):
+    return (isinstance(value,numbers.Integral)
+            and not isinstance(value,bool))
+
+
+def _isFloat(value):
+    return isinstance(value,float) or isinstance(value,numpy.floating)
+
+
+def _toArray(values):
+    # Return an array of int64 or float64 with the given values
+    _checkNumPy()
+    values = list(values)
+    if all(_isInteger(v) for v in values):
+        if values and not (-_INT64_MAX-1 <= min(values)
+                           and max(values) <= _INT64_MAX):
+            raise pyalaocl.Invalid(
+                'Numeric collections contain 64 bits integers.')
+        return numpy.array(values,dtype=numpy.int64)
+    elif all(_isFloat(v) for v in values):
+        return numpy.array(values,dtype=numpy.float64)
+    else:
+        raise pyalaocl.Invalid(
+            'Numeric collections contain either integers or floats.')
+
+
+def _isNumber(value):
+    return isinstance(value,numbers.Number)
+
+
+def _sum(values,counts=None):
+    # Sum of values*counts. Integers are summed with numpy only if the
+    # result cannot overflow.
+    if len(values) == 0:
+        return 0
+    if values.dtype.kind == 'i':
+        total = len(values) if counts is None else int(counts.sum())
+        bound = max(abs(int(values.min())),abs(int(values.max())))
+        if bound * total > _INT64_MAX:
+            if counts is None:
+                return sum(values.tolist())
+            return sum(v*n for (v,n) in zip(values.tolist(),counts.tolist()))
+    if counts is None:
+        return values.sum().item()
+    return numpy.dot(values,counts).item()
+
+
+#------------------------------------------------------------------------------
+#   Vectorized predicates
+#------------------------------------------------------------------------------
+
+_COMPARISONS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+}
+
+
+def _constant(node):
+    # Return the number denoted by the node, or None
+    if isinstance(node,ast.Num):
+        return node.n
+    if (isinstance(node,ast.UnaryOp) and isinstance(node.op,ast.USub)
+            and isinstance(node.operand,ast.Num)):
+        return -node.operand.n
+    return None
+
+
+def _vectorTerm(node):
+    # Return a function computing the value of the node for an array,
+    # or None if the node is not supported.
+    if isinstance(node,ast.Name) and node.id == '_':
+        return lambda a:a
+    value = _constant(node)
+    if value is not None:
+        return lambda a:value
+    if (isinstance(node,ast.BinOp) and isinstance(node.op,ast.Mod)
+            and isinstance(node.left,ast.Name) and node.left.id == '_'):
+        divisor = _constant(node.right)
+        if divisor:
+            # numpy.mod has the same sign convention as python
+            return lambda a:numpy.mod(a,divisor)
+    return None
+
+
+def _vectorTest(node):
+    # Return a function computing a boolean mask for an array, or None
+    if isinstance(node,ast.Compare):
+        operands = [node.left]+node.comparators
+        if all(_constant(n) is not None for n in operands):
+            # no element involved, so this is not a mask
+            return None
+        terms = [_vectorTerm(n) for n in operands]
+        operators = [_COMPARISONS.get(type(op)) for op in node.ops]
+        if None in terms or None in operators:
+            return None
+        comparisons = [(terms[i],c,terms[i+1])
+                       for (i,c) in enumerate(operators)]
+        def test(a):
+            masks = [c(f(a),g(a)) for (f,c,g) in comparisons]
+            return reduce(numpy.logical_and,masks)
+        return test
+    if isinstance(node,ast.BoolOp):
+        tests = [_vectorTest(n) for n in node.values]
+        if None in tests:
+            return None
+        combine = numpy.logical_and if isinstance(node.op,ast.And) \
+            else numpy.logical_or
+        return lambda a:reduce(combine,[t(a) for t in tests])
+    if isinstance(node,ast.UnaryOp) and isinstance(node.op,ast.Not):
+        test = _vectorTest(node.operand)
+        if test is None:
+            return None
+        return lambda a:numpy.logical_not(test(a))
+    return None
+
+
+def _vectorPredicate(predicate):
+    """
+    Return a function computing a boolean mask for an array if the
+    predicate is a string made of comparisons between '_', '_ % n' and
+    numbers, combined with 'and', 'or' and 'not'. Otherwise return None.
+    """
+    if not isinstance(predicate,basestring):
+        return None
+    try:
+        tree = ast.parse(predicate.strip(),mode='eval').body
+    except SyntaxError:
+        return None
+    return _vectorTest(tree)
+
+
+def _isIdentity(expression):
+    return isinstance(expression,basestring) and expression.strip() == '_'
+
+
+#==============================================================================
+#   Numeric collections
+#==============================================================================
+
+class NumericSeq(pyalaocl.Seq):
+    """
+    Sequence of numbers stored in a NumPy array.
+    """
+    # theList is a property computing _list from the array
+    __slots__ = ('theArray','_list')
+
+    def __init__(self,*args):
+        pyalaocl.Collection.__init__(self)
+        self.theArray = _toArray(args)
+        self._list = None
+
+    @classmethod
+    def new(cls,anyCollection=()):
+        if isinstance(anyCollection,NumericSeq):
+            return anyCollection
+        return cls._fromArray(_toArray(pyalaocl.listAll(anyCollection)))
+
+    @classmethod
+    def _fromArray(cls,theArray):
+        # Create a sequence with the given array, without copying it
+        newSeq = object.__new__(cls)
+        newSeq.theArray = theArray
+        newSeq._list = None
+        return newSeq
+
+    @classmethod
+    def _fromList(cls,theList):
+        return cls._fromArray(_toArray(theList))
+
+    @property
+    def theList(self):
+        # Used by the operations inherited from Seq
+        if self._list is None:
+            self._list = self.theArray.tolist()
+        return self._list
+
+    def emptyCollection(self):
+        return NumericSeq.new()
+
+    def size(self):
+        return len(self.theArray)
+
+    def isEmpty(self):
+        return len(self.theArray) == 0
+
+    def count(self,element):
+        if not _isNumber(element):
+            return 0
+        return int(numpy.count_nonzero(self.theArray == element))
+
+    def includes(self,element):
+        return self.count(element) > 0
+
+    def __contains__(self,item):
+        return self.includes(item)
+
+    def sum(self):
+        return _sum(self.theArray)
+
+    def max(self):
+        if self.isEmpty():
+            return super(NumericSeq,self).max()
+        return self.theArray.max().item()
+
+    def min(self):
+        if self.isEmpty():
+            return super(NumericSeq,self).min()
+        return self.theArray.min().item()
+
+    @pyalaocl._parallelizable
+    def select(self,predicate):
+        test = _vectorPredicate(predicate)
+        if test is None:
+            return super(NumericSeq,self).select(predicate)
+        return NumericSeq._fromArray(self.theArray[test(self.theArray)])
+
+    @pyalaocl._parallelizable
+    def sortedBy(self,expression):
+        if not _isIdentity(expression):
+            return super(NumericSeq,self).sortedBy(expression)
+        return NumericSeq._fromArray(
+            numpy.sort(self.theArray,kind='mergesort'))
+
+    def asSet(self):
+        return pyalaocl.Set.new(numpy.unique(self.theArray).tolist())
+
+    def asBag(self):
+        (values,counts) = numpy.unique(self.theArray,return_counts=True)
+        return NumericBag._fromArrays(values,counts,len(self.theArray))
+
+    def __getitem__(self,item):
+        value = self.theArray[item]
+        if isinstance(item,slice):
+            return value.tolist()
+        return value.item()
+
+    def __eq__(self,value):
+        if isinstance(value,NumericSeq):
+            return numpy.array_equal(self.theArray,value.theArray)
+        return super(NumericSeq,self).__eq__(value)
+
+    def __hash__(self):
+        return super(NumericSeq,self).__hash__()
+
+
+class NumericBag(pyalaocl.Bag):
+    """
+    Bag of numbers. The distinct elements are stored in a sorted NumPy
+    array and their number of occurrences in another array.
+    """
+    # theCounter is a property computing _counter from the arrays
+    __slots__ = ('theValues','theCounts','_counter')
+
+    def __init__(self,*args):
+        pyalaocl.Collection.__init__(self)
+        (values,counts) = numpy.unique(_toArray(args),return_counts=True)
+        self._setArrays(values,counts,len(args))
+
+    def _setArrays(self,theValues,theCounts,size):
+        self.theValues = theValues
+        self.theCounts = theCounts
+        self.theSize = size
+        self._counter = None
+
+    @classmethod
+    def new(cls,anyCollection=()):
+        if isinstance(anyCollection,NumericBag):
+            return anyCollection
+        elif isinstance(anyCollection,(pyalaocl.Bag,Counter)):
+            if isinstance(anyCollection,pyalaocl.Bag):
+                counter = anyCollection.theCounter
+            else:
+                counter = anyCollection
+            return cls._fromCounter(counter)
+        elements = _toArray(pyalaocl.listAll(anyCollection))
+        (values,counts) = numpy.unique(elements,return_counts=True)
+        return cls._fromArrays(values,counts,len(elements))
+
+    @classmethod
+    def _fromArrays(cls,theValues,theCounts,size=None):
+        # Create a bag with the given arrays, without copying them. Values
+        # must be sorted and distinct.
+        newBag = object.__new__(cls)
+        if size is None:
+            size = int(theCounts.sum())
+        newBag._setArrays(theValues,theCounts,size)
+        return newBag
+
+    @classmethod
+    def _fromCounter(cls,theCounter,size=None):
+        pairs = sorted((e,n) for (e,n) in theCounter.iteritems() if n > 0)
+        values = _toArray([e for (e,n) in pairs])
+        counts = numpy.array([n for (e,n) in pairs],dtype=numpy.int64)
+        return cls._fromArrays(values,counts,size)
+
+    @property
+    def theCounter(self):
+        # Used by the operations inherited from Bag
+        if self._counter is None:
+            self._counter = Counter(dict(zip(self.theValues.tolist(),
+                                             self.theCounts.tolist())))
+        return self._counter
+
+    def emptyCollection(self):
+        return NumericBag.new()
+
+    def count(self,value):
+        if not _isNumber(value):
+            return 0
+        i = numpy.searchsorted(self.theValues,value)
+        if i < len(self.theValues) and self.theValues[i] == value:
+            return int(self.theCounts[i])
+        return 0
+
+    def includes(self,value):
+        return self.count(value) > 0
+
+    def __contains__(self,value):
+        return self.includes(value)
+
+    def sum(self):
+        return _sum(self.theValues,self.theCounts)
+
+    def max(self):
+        if self.isEmpty():
+            return super(NumericBag,self).max()
+        return self.theValues[-1].item()
+
+    def min(self):
+        if self.isEmpty():
+            return super(NumericBag,self).min()
+        return self.theValues[0].item()
+
+    @pyalaocl._parallelizable
+    def select(self,predicate):
+        test = _vectorPredicate(predicate)
+        if test is None:
+            return super(NumericBag,self).select(predicate)
+        mask = test(self.theValues)
+        return NumericBag._fromArrays(
+            self.theValues[mask],self.theCounts[mask])
+
+    @pyalaocl._parallelizable
+    def sortedBy(self,expression):
+        if not _isIdentity(expression):
+            return super(NumericBag,self).sortedBy(expression)
+        return NumericSeq._fromArray(
+            numpy.repeat(self.theValues,self.theCounts))
+
+    def asSet(self):
+        return pyalaocl.Set.new(self.theValues.tolist())
+
+    def asSeq(self):
+        return NumericSeq._fromArray(
+            numpy.repeat(self.theValues,self.theCounts))
+
+    def __eq__(self,value):
+        if isinstance(value,NumericBag):
+            return (numpy.array_equal(self.theValues,value.theValues)
+                    and numpy.array_equal(self.theCounts,value.theCounts))
+        return super(NumericBag,self).__eq__(value)
+
+    def __hash__(self):
+        return super(NumericBag,self).__hash__()
+
+
+#==============================================================================
+#   Selection of numeric collections
+#==============================================================================
+
+_NUMERIC_CLASSES = {
+    pyalaocl.Seq: NumericSeq,
+    pyalaocl.Bag: NumericBag,
+}
+
+
+def asNumeric(collection):
+    """
+    Return a numeric collection with the same elements. The collection
+    must be a sequence or a bag of integers or of floats.
+    """
+    collection = pyalaocl.asCollection(collection)
+    for (base,numeric) in _NUMERIC_CLASSES.items():
+        if isinstance(collection,base):
+            return numeric.new(collection)
+    raise ValueError('No numeric collection for %s' % type(collection))
+
+
+#==============================================================================
+#   Examples
+#==============================================================================
+
+# Run by doctest only when NumPy is installed, so that the test suite
+# passes without it.
+if numpy is not None:
+    __test__ = {
+        'numeric': """
+            >>> s = NumericSeq.new(range(10))
+            >>> s.sum(), s.max(), s.count(3)
+            (45, 9, 1)
+            >>> s.select('_ % 3 == 0') == pyalaocl.Seq(0,3,6,9)
+            True
+            >>> b = asNumeric(pyalaocl.Bag(3,1,3,2))
+            >>> b.sum(), b.count(3), b.sortedBy('_')
+            (9, 2, Seq(1, 2, 3, 3))
+            >>> b.select('_ >= 2') == pyalaocl.Bag(2,3,3)
+            True
+            >>> NumericSeq(1,'a')
+            Traceback (most recent call last):
+              ...
+            Invalid: Numeric collections contain either integers or floats.
+            >>> asNumeric(pyalaocl.Seq(1,2)).sum()
+            3
+        """,
+        'NumericSeq': """
+            >>> s = NumericSeq(3.5,1.0,2.0)
+            >>> s.sortedBy('_') == pyalaocl.Seq(1.0,2.0,3.5)
+            True
+            >>> s.min(), s.includes(2), s.asSet() == pyalaocl.Set(1,2,3.5)
+            (1.0, True, True)
+            >>> s.select('not 1 < _ < 3') == pyalaocl.Seq(3.5,1.0)
+            True
+            >>> s.select(lambda e:e > 1) == pyalaocl.Seq(3.5,2.0)
+            True
+            >>> s[0], s[1:], s.at(3)
+            (3.5, [1.0, 2.0], 2.0)
+            >>> hasattr(s,'__dict__')
+            False
+            >>> import pickle
+            >>> pickle.loads(pickle.dumps(s,2)) == s
+            True
+        """,
+        'NumericBag': """
+            >>> b = NumericBag.new([5,1,5,5,2])
+            >>> b.size(), b.sum(), b.max(), b.min()
+            (5, 18, 5, 1)
+            >>> b.count(5), b.count(3), b.count('a'), 2 in b
+            (3, 0, 0, True)
+            >>> b.asSet() == pyalaocl.Set(1,2,5)
+            True
+            >>> b == pyalaocl.Bag(1,2,5,5,5), b.including(7).count(7)
+            (True, 1)
+            >>> hasattr(b,'__dict__')
+            False
+        """,
+    }
+else:
+    __test__ = {
+        'numeric': """
+            >>> NumericSeq(1,2)
+            Traceback (most recent call last):
+              ...
+            Invalid: NumPy is required for numeric collections.
+        """,
+    }
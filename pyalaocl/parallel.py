@@ -0,0 +1,573 @@
+# coding=utf-8
+"""
+The pyalaocl.parallel module provides the executors used when collection
+operations are called with the 'parallel' or 'executor' options, e.g.::
+
+    Class.allInstances().forAll('_.isWellFormed()', parallel=True)
+
+The operations select, reject, collect, collectNested, forAll, exists and
+sortedBy accept these options. The expression is evaluated on chunks of
+elements by an executor, then the result is built as usual, so the kind
+of the result and the order of sequences are preserved.
+
+The operations forAll, exists, any and one stop as soon as the result is
+known, that is when a worker finds a witness (or a counterexample for
+forAll), or a second match for one. Chunks not started yet are cancelled
+and running chunks stop at the next check. As the first witness is often
+found among the first elements, these operations start with small chunks
+and use larger chunks afterwards.
+
+Three backends are available:
+
+* 'serial': the current thread,
+* 'thread': a pool of threads. This is the backend of choice with jython
+  (which has no global interpreter lock) or when the expression waits for
+  I/O,
+* 'process': a pool of processes (CPython only). Expressions and elements
+  are sent to the processes, so they must be picklable: use string
+  expressions like '_.size() > 2' rather than lambdas.
+
+With parallel=True the backend is chosen according to the size of the
+collection, the platform and the kind of expression. parallel can also be
+the name of a backend, and executor an Executor. lastExecution() reports
+the backend chosen for the last operation of the current thread.
+Operations called with these options by an expression that a worker is
+evaluating are executed serially.
+
+Examples:
+    >>> from pyalaocl import Set, Bag, Seq
+    >>> from pyalaocl.parallel import lastExecution, SerialExecutor
+    >>> s = Seq.new(range(2000))
+    >>> s.select('_ % 3 == 0', parallel='thread') == s.select('_ % 3 == 0')
+    True
+    >>> lastExecution()['backend'], lastExecution()['elements']
+    ('thread', 2000)
+    >>> s.collect(lambda e:e * 2, parallel='thread')[0:4]
+    [0, 2, 4, 6]
+    >>> Set(3,1,2).sortedBy(lambda e:-e, executor=SerialExecutor())
+    OrderedSet(3, 2, 1)
+    >>> s.exists(lambda e:e == 10, parallel='thread')
+    True
+    >>> lastExecution()['chunks']
+    1
+    >>> s.one(lambda e:e > 1990, parallel='thread')
+    False
+    >>> Bag.new([1,2,3]*1000).any('_ > 2', parallel='thread')
+    3
+    >>> s.collect(lambda e:Seq(e).exists(lambda x:x == e, parallel='thread'),
+    ...           parallel='thread').size()
+    2000
+    >>> Seq(1,2,3).forAll('_ > 0', parallel=True)
+    True
+    >>> lastExecution()['backend'], lastExecution()['reason']
+    ('serial', 'less than 1000 elements')
+    >>> s.forAll(lambda e:e >= 0, parallel='process')
+    Traceback (most recent call last):
+      ...
+    Invalid: forAll(): the expression cannot be sent to processes. Use a string expression or the thread backend.
+"""
+
+import functools
+import logging
+import math
+import pickle
+import sys
+import threading
+import Queue
+
+try:
+    import multiprocessing
+except ImportError:
+    # not available with jython
+    multiprocessing = None
+
+import pyalaocl
+
+__all__ = (
+    'Executor',
+    'SerialExecutor',
+    'ThreadExecutor',
+    'ProcessExecutor',
+    'getExecutor',
+    'lastExecution',
+)
+
+log = logging.getLogger('pyalaocl')
+
+# With parallel=True, smaller collections are processed serially
+MIN_PARALLEL_SIZE = 1000
+
+# Number of chunks per worker. More chunks balance the load better.
+CHUNKS_PER_WORKER = 4
+
+MAX_CHUNK_SIZE = 10000
+
+
+def cpuCount():
+    try:
+        return multiprocessing.cpu_count()
+    except (AttributeError,NotImplementedError):
+        pass
+    try:
+        # noinspection PyUnresolvedReferences
+        from java.lang import Runtime
+        return Runtime.getRuntime().availableProcessors()
+    except ImportError:
+        return 2
+
+
+# Set while a worker evaluates an expression. The operations called by
+# the expression are then executed serially: submitting their tasks to the
+# pool that runs the worker could deadlock.
+_WORKER = threading.local()
+
+
+def _inWorker(function):
+    @functools.wraps(function)
+    def work(task):
+        _WORKER.active = True
+        try:
+            return function(task)
+        finally:
+            _WORKER.active = False
+    return work
+
+
+@_inWorker
+def _evaluateChunk(task):
+    # Executed by the workers. Module level so that processes can use it.
+    (expression,isPredicate,chunk) = task
+    if isPredicate:
+        function = pyalaocl.compilePredicate(expression)
+    else:
+        function = pyalaocl.compileExpression(expression)
+    return [function(e) for e in chunk]
+
+
+# Elements evaluated between two checks of the stop event
+CHECK_INTERVAL = 64
+
+
+@_inWorker
+def _searchChunk(task):
+    # Executed by the workers for short-circuit operations. chunk is a list
+    # of (element,count) pairs starting at the given offset. Return the
+    # indexes of matching pairs, with enough matches to reach 'limit', or
+    # None if the search has been stopped. The stop event is only
+    # available with threads: processes stop at chunk boundaries.
+    (expression,expected,limit,offset,chunk,stop) = task
+    test = pyalaocl.compilePredicate(expression)
+    matches = []
+    found = 0
+    for (i,(e,n)) in enumerate(chunk):
+        if (stop is not None and i % CHECK_INTERVAL == 0
+                and stop.is_set()):
+            return None
+        if test(e) == expected:
+            matches.append(offset+i)
+            found += n
+            if found >= limit:
+                break
+    return matches
+
+
+def _guarded(functionAndTask):
+    # The callbacks of multiprocessing are not called when the function
+    # fails, so exceptions are returned as results.
+    (function,task) = functionAndTask
+    try:
+        return (True,function(task))
+    except Exception, e:
+        try:
+            pickle.dumps(e,pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            e = pyalaocl.Invalid('%s: %s' % (e.__class__.__name__,e))
+        return (False,e)
+
+
+#------------------------------------------------------------------------------
+#   Executors
+#------------------------------------------------------------------------------
+
+class Executor(object):
+    """
+    Base class of executors. An executor applies a function to a list of
+    tasks and produces the results in the order of the tasks.
+    """
+    backend = None
+
+    def __init__(self,workers=None):
+        self.workers = cpuCount() if workers is None else workers
+
+    def mapTasks(self,function,tasks):
+        """
+        Return an iterator on the results of function(task) for each task,
+        in order. Tasks that are not started yet are cancelled when the
+        iterator is closed.
+        """
+        raise NotImplementedError()
+
+    def mapUnordered(self,function,tasks):
+        """
+        Return an iterator on the results of function(task) for each task,
+        in the order in which they are computed. Tasks are consumed from
+        the iterable as workers become available, so tasks that are not
+        needed are never submitted when the iterator is closed.
+        """
+        return self.mapTasks(function,tasks)
+
+    def shutdown(self):
+        pass
+
+    def __str__(self):
+        return '%s(%s)' % (self.__class__.__name__,self.workers)
+
+
+class SerialExecutor(Executor):
+    backend = 'serial'
+
+    def __init__(self,workers=1):
+        super(SerialExecutor,self).__init__(1)
+
+    def mapTasks(self,function,tasks):
+        for task in tasks:
+            yield function(task)
+
+
+class _Future(object):
+    def __init__(self,function,task,completed=None):
+        self.function = function
+        self.task = task
+        self.completed = completed
+        self.cancelled = False
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def run(self):
+        if not self.cancelled:
+            try:
+                self.result = self.function(self.task)
+            except BaseException:
+                self.error = sys.exc_info()
+        self.done.set()
+        if self.completed is not None:
+            self.completed.put(self)
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error[0],self.error[1],self.error[2]
+        return self.result
+
+
+class ThreadExecutor(Executor):
+    """
+    Pool of daemon threads. Unlike multiprocessing.pool.ThreadPool, it
+    works with jython.
+    """
+    backend = 'thread'
+
+    def __init__(self,workers=None):
+        super(ThreadExecutor,self).__init__(workers)
+        self._queue = Queue.Queue()
+        self._threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._work,name='pyalaocl-worker-%i' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            future = self._queue.get()
+            if future is None:
+                return
+            future.run()
+
+    def mapTasks(self,function,tasks):
+        futures = [_Future(function,task) for task in tasks]
+        for future in futures:
+            self._queue.put(future)
+        try:
+            for future in futures:
+                yield future.wait()
+        finally:
+            for future in futures:
+                future.cancelled = True
+
+    def mapUnordered(self,function,tasks):
+        completed = Queue.Queue()
+        tasks = iter(tasks)
+        pending = set()
+        try:
+            while True:
+                for task in tasks:
+                    future = _Future(function,task,completed)
+                    pending.add(future)
+                    self._queue.put(future)
+                    if len(pending) >= 2*self.workers:
+                        break
+                if not pending:
+                    return
+                future = completed.get()
+                pending.discard(future)
+                yield future.wait()
+        finally:
+            for future in pending:
+                future.cancelled = True
+
+    def shutdown(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        self._threads = []
+
+
+class ProcessExecutor(Executor):
+    """
+    Pool of processes based on multiprocessing (CPython only).
+    """
+    backend = 'process'
+
+    def __init__(self,workers=None):
+        if multiprocessing is None:
+            raise pyalaocl.Invalid(
+                'Process pools are not available on this platform.')
+        super(ProcessExecutor,self).__init__(workers)
+        self._pool = multiprocessing.Pool(self.workers)
+
+    def mapTasks(self,function,tasks):
+        return self._pool.imap(function,tasks)
+
+    def mapUnordered(self,function,tasks):
+        # At most two tasks per worker are submitted at a time, so that the
+        # pool can be left as soon as the result is known.
+        completed = Queue.Queue()
+        tasks = iter(tasks)
+        pending = 0
+        while True:
+            for task in tasks:
+                self._pool.apply_async(
+                    _guarded,((function,task),),callback=completed.put)
+                pending += 1
+                if pending >= 2*self.workers:
+                    break
+            if pending == 0:
+                return
+            (succeeded,result) = completed.get()
+            pending -= 1
+            if not succeeded:
+                raise result
+            yield result
+
+    def shutdown(self):
+        self._pool.terminate()
+
+
+_BACKENDS = {
+    'serial': SerialExecutor,
+    'thread': ThreadExecutor,
+    'process': ProcessExecutor,
+}
+
+_EXECUTORS = {}
+_EXECUTORS_LOCK = threading.Lock()
+
+
+def getExecutor(backend):
+    """
+    Return the default executor of the given backend ('serial', 'thread'
+    or 'process'). It is created on first use, with one worker per
+    processor.
+    """
+    if backend not in _BACKENDS:
+        raise pyalaocl.Invalid('Unknown parallel backend: %r' % backend)
+    with _EXECUTORS_LOCK:
+        if backend not in _EXECUTORS:
+            _EXECUTORS[backend] = _BACKENDS[backend]()
+        return _EXECUTORS[backend]
+
+
+#------------------------------------------------------------------------------
+#   Execution of operations
+#------------------------------------------------------------------------------
+
+_LAST_EXECUTION = threading.local()
+
+
+def lastExecution():
+    """
+    Return a dictionary describing how the last operation executed with
+    the parallel or executor options was run in the current thread:
+    operation, backend, workers, elements, chunks and reason of the choice.
+    """
+    return getattr(_LAST_EXECUTION,'report',None)
+
+
+def _isPicklable(expression):
+    if isinstance(expression,basestring):
+        return True
+    try:
+        pickle.dumps(expression,pickle.HIGHEST_PROTOCOL)
+        return True
+    except Exception:
+        return False
+
+
+def _chooseBackend(parallel,expression,size):
+    # Return (backend, reason) for parallel=True
+    if size < MIN_PARALLEL_SIZE:
+        return ('serial','less than %i elements' % MIN_PARALLEL_SIZE)
+    if multiprocessing is None or sys.platform.startswith('java'):
+        return ('thread','no process pool on this platform')
+    if isinstance(expression,basestring):
+        return ('process','string expression')
+    return ('thread','the expression cannot be sent to processes')
+
+
+def _executorFor(parallel,executor,expression,size):
+    # Return (executor, reason)
+    if getattr(_WORKER,'active',False):
+        return (getExecutor('serial'),'nested call in a worker')
+    if executor is not None:
+        return (executor,'executor given')
+    if parallel is True:
+        (backend,reason) = _chooseBackend(parallel,expression,size)
+    elif parallel in _BACKENDS:
+        (backend,reason) = (parallel,'backend given')
+    else:
+        raise pyalaocl.Invalid('Invalid parallel option: %r' % parallel)
+    return (getExecutor(backend),reason)
+
+
+def _chunkSize(size,workers):
+    size = int(math.ceil(size / float(workers*CHUNKS_PER_WORKER)))
+    return max(1,min(size,MAX_CHUNK_SIZE))
+
+
+def _chunks(elements,workers):
+    size = _chunkSize(len(elements),workers)
+    return [elements[i:i+size] for i in xrange(0,len(elements),size)]
+
+
+# Size of the first chunks of short-circuit operations
+FIRST_CHUNK_SIZE = 64
+
+
+def _growingChunks(elements,workers):
+    # The first chunk of each worker is small, then sizes double up to the
+    # regular chunk size.
+    maxSize = _chunkSize(len(elements),workers)
+    size = min(FIRST_CHUNK_SIZE,maxSize)
+    i = 0
+    n = 0
+    while i < len(elements):
+        yield (i,elements[i:i+size])
+        i += size
+        n += 1
+        if n >= workers:
+            size = min(size*2,maxSize)
+
+
+# operation: (value of the test searched, number of matches needed)
+_SHORT_CIRCUITS = {
+    'exists': (True,1),
+    'any': (True,1),
+    'forAll': (False,1),
+    'one': (True,2),
+}
+
+
+def _search(executor,operation,expression,pairs,report):
+    # Return the (element,count) pairs found, no more than needed.
+    (expected,limit) = _SHORT_CIRCUITS[operation]
+    # the stop event cannot be sent to processes
+    stop = threading.Event() if executor.backend == 'thread' else None
+    tasks = ((expression,expected,limit,offset,chunk,stop)
+             for (offset,chunk) in _growingChunks(pairs,executor.workers))
+    results = executor.mapUnordered(_searchChunk,tasks)
+    matches = []
+    found = 0
+    try:
+        for indexes in results:
+            report['chunks'] += 1
+            for i in indexes or ():
+                matches.append(pairs[i])
+                found += pairs[i][1]
+                if found >= limit:
+                    return matches
+        return matches
+    finally:
+        if stop is not None:
+            stop.set()
+        results.close()
+
+
+def _shortCircuit(operation,expression,executor,pairs,report):
+    matches = _search(executor,operation,expression,pairs,report)
+    if operation == 'exists':
+        return len(matches) > 0
+    elif operation == 'forAll':
+        return len(matches) == 0
+    elif operation == 'one':
+        return sum(n for (e,n) in matches) == 1
+    elif matches:
+        return matches[0][0]
+    else:
+        raise pyalaocl.Invalid(".any(...) failed: No such element.")
+
+
+def run(collection,method,expression,parallel=None,executor=None):
+    """
+    Execute the operation method(collection,expression) with an executor.
+    This function is called by the operations when the parallel or
+    executor options are given.
+    """
+    operation = method.__name__
+    pairs = list(collection.lazy()._pairs())
+    (executor,reason) = _executorFor(
+        parallel,executor,expression,len(pairs))
+    if executor.backend == 'process' and not _isPicklable(expression):
+        raise pyalaocl.Invalid(
+            '%s(): the expression cannot be sent to processes. '
+            'Use a string expression or the thread backend.' % operation)
+    report = {
+        'operation': operation,
+        'backend': executor.backend,
+        'workers': executor.workers,
+        'elements': len(pairs),
+        'chunks': 0,
+        'reason': reason,
+    }
+    _LAST_EXECUTION.report = report
+    log.debug('%s() on %i elements: %s backend with %i workers (%s)',
+              operation,len(pairs),executor.backend,executor.workers,
+              reason)
+    if executor.backend == 'serial':
+        return method(collection,expression)
+    if operation in _SHORT_CIRCUITS:
+        # 'chunks' is the number of chunks actually evaluated
+        return _shortCircuit(operation,expression,executor,pairs,report)
+    elements = [e for (e,n) in pairs]
+    chunks = _chunks(elements,executor.workers)
+    report['chunks'] = len(chunks)
+    isPredicate = operation in ('select','reject')
+    tasks = [(expression,isPredicate,chunk) for chunk in chunks]
+    results = executor.mapTasks(_evaluateChunk,tasks)
+    values = [v for chunkValues in results for v in chunkValues]
+    return method(collection,_computed(collection,elements,values))
+
+
+def _computed(collection,elements,values):
+    # Return the function giving the value computed by the workers for an
+    # element, so that the operation is executed as usual. Elements of
+    # sets, bags and ordered sets are distinct and hashable, so values are
+    # found by element. Elements of sequences can be repeated or
+    # unhashable, but sequence operations evaluate their expression on
+    # each element in order, so values are returned in this order.
+    if isinstance(collection,pyalaocl.Seq):
+        nextValue = iter(values).next
+        return lambda e:nextValue()
+    values = dict(zip(elements,values))
+    return lambda e:values[e]
@@ -0,0 +1,977 @@
+# coding=utf-8
+"""
+The pyalaocl.persistent module provides persistent implementations of OCL
+collections, that is implementations where a new collection shares most of
+its structure with the collection it is derived from. Operations like
+including, excluding, append or prepend are then in O(log n) instead of
+O(n), so building a collection with repeated calls to these operations is
+no longer quadratic.
+
+- PersistentSet and PersistentBag are based on a hash array mapped trie
+  (HashTrieMap).
+
+- PersistentSeq is based on Vector, a balanced tree of small chunks
+  allowing indexing, append, prepend, concatenation and slicing in
+  O(log n).
+
+These classes are subclasses of Set, Bag and Seq. They have the same
+interface and the same value semantics: a PersistentSet is equal to a Set
+with the same elements. Persistent collections can be selected per
+collection (e.g. PersistentSet(1,2) or asPersistent(aSet)) or globally
+with usePersistentCollections(), in which case Set(...), Set.new(...) and
+the like create persistent collections.
+"""
+
+import pyalaocl
+
+__all__ = (
+    'HashTrieMap',
+    'HashTrieSet',
+    'Vector',
+    'PersistentSet',
+    'PersistentBag',
+    'PersistentSeq',
+    'asPersistent',
+    'usePersistentCollections',
+)
+
+
+#==============================================================================
+#   Hash array mapped trie
+#==============================================================================
+
+_BITS = 5
+_MASK = (1 << _BITS) - 1
+_HASH_MASK = (1 << 64) - 1
+
+
+def _hashOf(key):
+    return hash(key) & _HASH_MASK
+
+
+def _bitCount(n):
+    return bin(n).count('1')
+
+
+def _sameKey(key1,key2):
+    return key1 is key2 or key1 == key2
+
+
+class _Leaf(object):
+    __slots__ = ('hash','key','value')
+
+    def __init__(self,h,key,value):
+        self.hash = h
+        self.key = key
+        self.value = value
+
+
+class _CollisionNode(object):
+    # Keys with exactly the same hash
+    __slots__ = ('hash','leaves')
+
+    def __init__(self,h,leaves):
+        self.hash = h
+        self.leaves = leaves
+
+    def find(self,key):
+        for leaf in self.leaves:
+            if _sameKey(leaf.key,key):
+                return leaf
+        return None
+
+    def assoc(self,h,shift,key,value):
+        if h != self.hash:
+            # move this node one level down in a bitmap node
+            node = _BitmapNode(1 << ((self.hash >> shift) & _MASK),(self,))
+            return node.assoc(h,shift,key,value)
+        for (i,leaf) in enumerate(self.leaves):
+            if _sameKey(leaf.key,key):
+                if leaf.value is value:
+                    return (self,False)
+                leaves = self.leaves[:i]+(_Leaf(h,key,value),) \
+                         +self.leaves[i+1:]
+                return (_CollisionNode(h,leaves),False)
+        return (_CollisionNode(h,self.leaves+(_Leaf(h,key,value),)),True)
+
+    def dissoc(self,h,shift,key):
+        for (i,leaf) in enumerate(self.leaves):
+            if _sameKey(leaf.key,key):
+                leaves = self.leaves[:i]+self.leaves[i+1:]
+                if len(leaves) == 1:
+                    return leaves[0]
+                return _CollisionNode(h,leaves)
+        return self
+
+    def leavesIter(self):
+        return iter(self.leaves)
+
+
+def _merge(leaf1,leaf2,shift):
+    # Return a node containing two leaves with different keys
+    if leaf1.hash == leaf2.hash:
+        return _CollisionNode(leaf1.hash,(leaf1,leaf2))
+    fragment1 = (leaf1.hash >> shift) & _MASK
+    fragment2 = (leaf2.hash >> shift) & _MASK
+    if fragment1 == fragment2:
+        return _BitmapNode(1 << fragment1,
+                           (_merge(leaf1,leaf2,shift+_BITS),))
+    elif fragment1 < fragment2:
+        return _BitmapNode((1 << fragment1) | (1 << fragment2),(leaf1,leaf2))
+    else:
+        return _BitmapNode((1 << fragment1) | (1 << fragment2),(leaf2,leaf1))
+
+
+class _BitmapNode(object):
+    # Entries are leaves or sub nodes, in the order of the bitmap
+    __slots__ = ('bitmap','entries')
+
+    def __init__(self,bitmap,entries):
+        self.bitmap = bitmap
+        self.entries = entries
+
+    def find(self,h,key):
+        node = self
+        shift = 0
+        while True:
+            if isinstance(node,_CollisionNode):
+                return node.find(key) if node.hash == h else None
+            bit = 1 << ((h >> shift) & _MASK)
+            if not node.bitmap & bit:
+                return None
+            entry = node.entries[_bitCount(node.bitmap & (bit-1))]
+            if isinstance(entry,_Leaf):
+                if entry.hash == h and _sameKey(entry.key,key):
+                    return entry
+                return None
+            node = entry
+            shift += _BITS
+
+    def _replaced(self,index,entry):
+        entries = self.entries[:index]+(entry,)+self.entries[index+1:]
+        return _BitmapNode(self.bitmap,entries)
+
+    def assoc(self,h,shift,key,value):
+        bit = 1 << ((h >> shift) & _MASK)
+        index = _bitCount(self.bitmap & (bit-1))
+        if not self.bitmap & bit:
+            entries = self.entries[:index]+(_Leaf(h,key,value),) \
+                      +self.entries[index:]
+            return (_BitmapNode(self.bitmap | bit,entries),True)
+        entry = self.entries[index]
+        if isinstance(entry,_Leaf):
+            if entry.hash == h and _sameKey(entry.key,key):
+                if entry.value is value:
+                    return (self,False)
+                return (self._replaced(index,_Leaf(h,key,value)),False)
+            sub = _merge(entry,_Leaf(h,key,value),shift+_BITS)
+            return (self._replaced(index,sub),True)
+        (sub,added) = entry.assoc(h,shift+_BITS,key,value)
+        if sub is entry:
+            return (self,added)
+        return (self._replaced(index,sub),added)
+
+    def dissoc(self,h,shift,key):
+        # Return the new node, None if empty, self if the key is not there
+        bit = 1 << ((h >> shift) & _MASK)
+        if not self.bitmap & bit:
+            return self
+        index = _bitCount(self.bitmap & (bit-1))
+        entry = self.entries[index]
+        if isinstance(entry,_Leaf):
+            if not (entry.hash == h and _sameKey(entry.key,key)):
+                return self
+            sub = None
+        else:
+            sub = entry.dissoc(h,shift+_BITS,key)
+            if sub is entry:
+                return self
+        if sub is None:
+            if self.bitmap == bit:
+                return None
+            entries = self.entries[:index]+self.entries[index+1:]
+            return _BitmapNode(self.bitmap ^ bit,entries)
+        if (isinstance(sub,_BitmapNode) and len(sub.entries) == 1
+                and isinstance(sub.entries[0],_Leaf)):
+            # keep the trie compact
+            sub = sub.entries[0]
+        return self._replaced(index,sub)
+
+    def leavesIter(self):
+        stack = [iter(self.entries)]
+        while stack:
+            for entry in stack[-1]:
+                if isinstance(entry,_Leaf):
+                    yield entry
+                else:
+                    stack.append(iter(entry.entries)
+                                 if isinstance(entry,_BitmapNode)
+                                 else entry.leavesIter())
+                    break
+            else:
+                stack.pop()
+
+
+_EMPTY_NODE = _BitmapNode(0,())
+
+
+class HashTrieMap(object):
+    """
+    Immutable mapping based on a hash array mapped trie.
+
+    set and remove return new maps sharing most of their structure with
+    the original one. They are in O(log32 n). Iteration order is
+    unspecified. Maps compare equal to dictionaries with the same items.
+
+    Examples:
+        >>> m1 = HashTrieMap.new([('a',1),('b',2)])
+        >>> m2 = m1.set('c',3).remove('a')
+        >>> sorted(m1.items()), sorted(m2.items())
+        ([('a', 1), ('b', 2)], [('b', 2), ('c', 3)])
+        >>> m2['c'], m2.get('a',0), 'b' in m2, len(m2)
+        (3, 0, True, 2)
+        >>> m2 == {'b':2,'c':3}, m2 == m1
+        (True, False)
+        >>> m = HashTrieMap()
+        >>> for i in range(1000):
+        ...     m = m.set(i,i*i)
+        >>> len(m), m[999], len(m.remove(3).remove(3))
+        (1000, 998001, 999)
+    """
+    __slots__ = ('root','count','_hash')
+
+    def __init__(self,root=_EMPTY_NODE,count=0):
+        self.root = root
+        self.count = count
+        self._hash = None
+
+    @classmethod
+    def new(cls,pairs=()):
+        if isinstance(pairs,HashTrieMap):
+            return pairs
+        root = _EMPTY_NODE
+        count = 0
+        items = pairs.iteritems() if isinstance(pairs,dict) else pairs
+        for (key,value) in items:
+            (root,added) = root.assoc(_hashOf(key),0,key,value)
+            if added:
+                count += 1
+        return cls(root,count)
+
+    def get(self,key,default=None):
+        leaf = self.root.find(_hashOf(key),key)
+        return default if leaf is None else leaf.value
+
+    def __getitem__(self,key):
+        leaf = self.root.find(_hashOf(key),key)
+        if leaf is None:
+            raise KeyError(key)
+        return leaf.value
+
+    def __contains__(self,key):
+        return self.root.find(_hashOf(key),key) is not None
+
+    def set(self,key,value):
+        (root,added) = self.root.assoc(_hashOf(key),0,key,value)
+        if root is self.root:
+            return self
+        return HashTrieMap(root,self.count+1 if added else self.count)
+
+    def remove(self,key):
+        root = self.root.dissoc(_hashOf(key),0,key)
+        if root is self.root:
+            return self
+        if root is None:
+            root = _EMPTY_NODE
+        return HashTrieMap(root,self.count-1)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return (leaf.key for leaf in self.root.leavesIter())
+
+    def iterkeys(self):
+        return self.__iter__()
+
+    def itervalues(self):
+        return (leaf.value for leaf in self.root.leavesIter())
+
+    def iteritems(self):
+        return ((leaf.key,leaf.value) for leaf in self.root.leavesIter())
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def elements(self):
+        """
+        Iterate over keys repeated as many times as their value, as
+        Counter.elements() does.
+        """
+        for (key,value) in self.iteritems():
+            for _ in xrange(value):
+                yield key
+
+    def __eq__(self,other):
+        if isinstance(other,HashTrieMap):
+            if self.root is other.root:
+                return True
+        elif not isinstance(other,dict):
+            return False
+        if len(self) != len(other):
+            return False
+        for (key,value) in self.iteritems():
+            if key not in other or other[key] != value:
+                return False
+        return True
+
+    def __ne__(self,other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(frozenset(self.iteritems()))
+        return self._hash
+
+    def __repr__(self):
+        return 'HashTrieMap(%s)' % dict(self.iteritems())
+
+
+class HashTrieSet(object):
+    """
+    Immutable set based on a HashTrieMap. including and excluding return
+    new sets sharing most of their structure with the original one.
+    Sets compare equal to python sets with the same elements.
+
+    Examples:
+        >>> s = HashTrieSet.new([1,2,3])
+        >>> s.including(4).excluding(1) == {2,3,4}, s == {1,2,3}
+        (True, True)
+        >>> hash(s) == hash(frozenset([1,2,3]))
+        True
+    """
+    __slots__ = ('map',)
+
+    def __init__(self,map=HashTrieMap()):
+        self.map = map
+
+    @classmethod
+    def new(cls,elements=()):
+        if isinstance(elements,HashTrieSet):
+            return elements
+        return cls(HashTrieMap.new((e,True) for e in elements))
+
+    def including(self,value):
+        map = self.map.set(value,True)
+        return self if map is self.map else HashTrieSet(map)
+
+    def excluding(self,value):
+        map = self.map.remove(value)
+        return self if map is self.map else HashTrieSet(map)
+
+    def __contains__(self,value):
+        return value in self.map
+
+    def __len__(self):
+        return len(self.map)
+
+    def __iter__(self):
+        return self.map.iterkeys()
+
+    def __eq__(self,other):
+        if isinstance(other,HashTrieSet):
+            if self.map.root is other.map.root:
+                return True
+        elif not isinstance(other,(set,frozenset)):
+            return False
+        if len(self) != len(other):
+            return False
+        for e in self:
+            if e not in other:
+                return False
+        return True
+
+    def __ne__(self,other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        if self.map._hash is None:
+            self.map._hash = hash(frozenset(self))
+        return self.map._hash
+
+    def __repr__(self):
+        return 'HashTrieSet(%s)' % list(self)
+
+
+#==============================================================================
+#   Vector
+#==============================================================================
+
+# Vectors are AVL trees whose leaves are tuples of at most _CHUNK elements.
+# Each node records the size and the height of the subtree, allowing
+# indexing in O(log n) and concatenation by joining trees.
+
+_CHUNK = 32
+
+
+class _Node(object):
+    __slots__ = ('left','right','size','height')
+
+    def __init__(self,left,right):
+        self.left = left
+        self.right = right
+        self.size = _size(left)+_size(right)
+        self.height = max(_height(left),_height(right))+1
+
+
+def _size(node):
+    return len(node) if isinstance(node,tuple) else node.size
+
+
+def _height(node):
+    return 0 if isinstance(node,tuple) else node.height
+
+
+def _balanced(left,right):
+    # Build a node from two balanced trees whose heights differ by at most 2
+    hl = _height(left)
+    hr = _height(right)
+    if hl > hr+1:
+        if _height(left.left) >= _height(left.right):
+            return _Node(left.left,_Node(left.right,right))
+        return _Node(_Node(left.left,left.right.left),
+                     _Node(left.right.right,right))
+    if hr > hl+1:
+        if _height(right.right) >= _height(right.left):
+            return _Node(_Node(left,right.left),right.right)
+        return _Node(_Node(left,right.left.left),
+                     _Node(right.left.right,right.right))
+    return _Node(left,right)
+
+
+def _join(left,right):
+    if not _size(left):
+        return right
+    if not _size(right):
+        return left
+    hl = _height(left)
+    hr = _height(right)
+    if hl > hr+1:
+        return _balanced(left.left,_join(left.right,right))
+    if hr > hl+1:
+        return _balanced(_join(left,right.left),right.right)
+    if (isinstance(left,tuple) and isinstance(right,tuple)
+            and len(left)+len(right) <= _CHUNK):
+        return left+right
+    return _Node(left,right)
+
+
+def _append(node,value):
+    if isinstance(node,tuple):
+        if len(node) < _CHUNK:
+            return node+(value,)
+        return _Node(node,(value,))
+    return _balanced(node.left,_append(node.right,value))
+
+
+def _prepend(node,value):
+    if isinstance(node,tuple):
+        if len(node) < _CHUNK:
+            return (value,)+node
+        return _Node((value,),node)
+    return _balanced(_prepend(node.left,value),node.right)
+
+
+def _split(node,index):
+    # Return the trees with the index first elements and the others
+    if isinstance(node,tuple):
+        return (node[:index],node[index:])
+    leftSize = _size(node.left)
+    if index < leftSize:
+        (l,r) = _split(node.left,index)
+        return (l,_join(r,node.right))
+    elif index > leftSize:
+        (l,r) = _split(node.right,index-leftSize)
+        return (_join(node.left,l),r)
+    else:
+        return (node.left,node.right)
+
+
+def _fromIterable(values):
+    values = tuple(values)
+    nodes = [values[i:i+_CHUNK] for i in xrange(0,len(values),_CHUNK)]
+    if not nodes:
+        return ()
+    while len(nodes) > 1:
+        nodes = [_join(nodes[i],nodes[i+1]) if i+1 < len(nodes)
+                 else nodes[i]
+                 for i in xrange(0,len(nodes),2)]
+    return nodes[0]
+
+
+class Vector(object):
+    """
+    Immutable sequence supporting indexing, append, prepend,
+    concatenation and slicing in O(log n), with structural sharing.
+    Vectors compare equal to lists or tuples with the same elements.
+
+    Examples:
+        >>> v = Vector.new(range(100))
+        >>> w = v.append(100).prepend(-1)
+        >>> len(v), len(w), w[0], w[-1], w[50]
+        (100, 102, -1, 100, 49)
+        >>> w[1:4] == [0,1,2], v == range(100)
+        (True, True)
+        >>> (v+v)[150], 99 in v, v.count(5), v.index(7)
+        (50, True, 1, 7)
+        >>> x = Vector()
+        >>> for i in range(1000):
+        ...     x = x.prepend(i)
+        >>> list(x) == range(999,-1,-1)
+        True
+    """
+    __slots__ = ('root',)
+
+    def __init__(self,root=()):
+        self.root = root
+
+    @classmethod
+    def new(cls,values=()):
+        if isinstance(values,Vector):
+            return values
+        return cls(_fromIterable(values))
+
+    def __len__(self):
+        return _size(self.root)
+
+    def __iter__(self):
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if isinstance(node,tuple):
+                for e in node:
+                    yield e
+            else:
+                stack.append(node.right)
+                stack.append(node.left)
+
+    def __getitem__(self,index):
+        if isinstance(index,slice):
+            (start,stop,step) = index.indices(len(self))
+            if step != 1:
+                return Vector.new(list(self)[index])
+            if stop <= start:
+                return Vector()
+            (_,right) = _split(self.root,start)
+            (middle,_) = _split(right,stop-start)
+            return Vector(middle)
+        size = len(self)
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError('Vector index out of range')
+        node = self.root
+        while not isinstance(node,tuple):
+            leftSize = _size(node.left)
+            if index < leftSize:
+                node = node.left
+            else:
+                index -= leftSize
+                node = node.right
+        return node[index]
+
+    def append(self,value):
+        return Vector(_append(self.root,value))
+
+    def prepend(self,value):
+        return Vector(_prepend(self.root,value))
+
+    def insert(self,index,value):
+        (left,right) = _split(self.root,index)
+        return Vector(_join(_append(left,value),right))
+
+    def concat(self,values):
+        return Vector(_join(self.root,Vector.new(values).root))
+
+    def __add__(self,values):
+        return self.concat(values)
+
+    def __contains__(self,value):
+        for e in self:
+            if e == value:
+                return True
+        return False
+
+    def count(self,value):
+        return sum(1 for e in self if e == value)
+
+    def index(self,value):
+        for (i,e) in enumerate(self):
+            if e == value:
+                return i
+        raise ValueError('%s is not in the vector' % (value,))
+
+    def __eq__(self,other):
+        if isinstance(other,Vector):
+            if self.root is other.root:
+                return True
+        elif not isinstance(other,(list,tuple)):
+            return False
+        if len(self) != len(other):
+            return False
+        for (e1,e2) in zip(self,other):
+            if e1 != e2:
+                return False
+        return True
+
+    def __ne__(self,other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return 'Vector(%s)' % list(self)
+
+
+#==============================================================================
+#   Persistent OCL collections
+#==============================================================================
+
+
+class PersistentSet(pyalaocl.Set):
+    """
+    Set sharing its structure with the sets it is derived from.
+
+    Examples:
+        >>> s = PersistentSet()
+        >>> for i in range(100):
+        ...     s = s.including(i % 50)
+        >>> s.size(), s == pyalaocl.Set.new(range(50))
+        (50, True)
+        >>> s.excluding(3).includes(3), s.includes(3)
+        (False, True)
+        >>> s.select(lambda e:e<3) == pyalaocl.Set(0,1,2)
+        True
+        >>> isinstance(s.union([100]),PersistentSet)
+        True
+        >>> s.excludingAll(range(10,50)).includingAll([-1]) \
+                == pyalaocl.Set.new(range(-1,10))
+        True
+    """
+    __slots__ = ()
+
+    def __init__(self,*args):
+        pyalaocl.Collection.__init__(self)
+        self.theSet = HashTrieSet.new(args)
+
+    @classmethod
+    def new(cls,anyCollection=()):
+        if isinstance(anyCollection,PersistentSet):
+            return anyCollection
+        return cls._fromSet(HashTrieSet.new(anyCollection))
+
+    def emptyCollection(self):
+        return PersistentSet.new()
+
+    def including(self,value):
+        return self._fromSet(self.theSet.including(value))
+
+    def excluding(self,value):
+        return self._fromSet(self.theSet.excluding(value))
+
+    def includingAll(self,values):
+        fresh = self.theSet
+        for e in pyalaocl._elementsOf(values):
+            fresh = fresh.including(e)
+        return self._fromSet(fresh)
+
+    def excludingAll(self,values):
+        fresh = self.theSet
+        for e in pyalaocl._elementsOf(values):
+            fresh = fresh.excluding(e)
+        return self._fromSet(fresh)
+
+    def union(self,anyCollection):
+        assert pyalaocl.isCollection(anyCollection), \
+            'Any collection expected, but found %s' % anyCollection
+        fresh = self.theSet
+        for e in anyCollection:
+            fresh = fresh.including(e)
+        return self._fromSet(fresh)
+
+    def intersection(self,anyCollection):
+        assert pyalaocl.isCollection(anyCollection), \
+            'Any collection expected, but found %s' % anyCollection
+        other = set(anyCollection)
+        return self.select(lambda e:e in other)
+
+    def difference(self,anyCollection):
+        assert pyalaocl.isCollection(anyCollection), \
+            'Any collection expected, but found %s' % anyCollection
+        fresh = self.theSet
+        for e in anyCollection:
+            fresh = fresh.excluding(e)
+        return self._fromSet(fresh)
+
+    def symmetricDifference(self,anyCollection):
+        assert pyalaocl.isCollection(anyCollection), \
+            'Any collection expected, but found %s' % anyCollection
+        fresh = self.theSet
+        for e in set(anyCollection):
+            if e in fresh:
+                fresh = fresh.excluding(e)
+            else:
+                fresh = fresh.including(e)
+        return self._fromSet(fresh)
+
+    @pyalaocl._parallelizable
+    def select(self,predicate):
+        test = pyalaocl.compilePredicate(predicate)
+        return PersistentSet.new(e for e in self.theSet if test(e))
+
+    def flatten(self):
+        return PersistentSet.new(super(PersistentSet,self).flatten())
+
+    def _hashValue(self):
+        return hash(self.theSet)
+
+
+class PersistentBag(pyalaocl.Bag):
+    """
+    Bag sharing its structure with the bags it is derived from. Elements
+    are mapped to their number of occurrences in a HashTrieMap.
+
+    Examples:
+        >>> b = PersistentBag()
+        >>> for i in range(100):
+        ...     b = b.including(i % 10)
+        >>> b.size(), b.count(3), b == pyalaocl.Bag.new(range(10)*10)
+        (100, 10, True)
+        >>> b.excluding(3).count(3), b.count(3), 3 in b
+        (0, 10, True)
+        >>> b.excludingAll([1,2,2]).includingAll([0]).size()
+        81
+        >>> PersistentBag(1,1,2).union(pyalaocl.Bag(1,3)) \
+                == pyalaocl.Bag(1,1,1,2,3)
+        True
+    """
+    __slots__ = ()
+
+    def __init__(self,*args):
+        pyalaocl.Collection.__init__(self)
+        self.theCounter = self._countsOf(args)
+        self.theSize = len(args)
+
+    @staticmethod
+    def _countsOf(elements,counts=HashTrieMap()):
+        for e in elements:
+            counts = counts.set(e,counts.get(e,0)+1)
+        return counts
+
+    @classmethod
+    def new(cls,anyCollection=()):
+        if isinstance(anyCollection,PersistentBag):
+            return anyCollection
+        elif isinstance(anyCollection,pyalaocl.Bag):
+            pairs = anyCollection.theCounter.iteritems()
+        elif isinstance(anyCollection,dict):
+            pairs = ((e,n) for (e,n) in anyCollection.iteritems() if n > 0)
+        else:
+            elements = pyalaocl.listAll(anyCollection)
+            return cls._fromCounter(cls._countsOf(elements),len(elements))
+        return cls._fromCounter(HashTrieMap.new(pairs))
+
+    def emptyCollection(self):
+        return PersistentBag.new()
+
+    def count(self,value):
+        return self.theCounter.get(value,0)
+
+    def __contains__(self,value):
+        return value in self.theCounter
+
+    def including(self,value):
+        return self._fromCounter(
+            self.theCounter.set(value,self.theCounter.get(value,0)+1),
+            self.theSize+1)
+
+    def excluding(self,value):
+        return self._fromCounter(
+            self.theCounter.remove(value),
+            self.theSize-self.theCounter.get(value,0))
+
+    def includingAll(self,values):
+        added = list(pyalaocl._elementsOf(values))
+        return self._fromCounter(
+            self._countsOf(added,self.theCounter),self.theSize+len(added))
+
+    def excludingAll(self,values):
+        fresh = self.theCounter
+        size = self.theSize
+        for e in pyalaocl._elementsOf(values):
+            size -= fresh.get(e,0)
+            fresh = fresh.remove(e)
+        return self._fromCounter(fresh,size)
+
+    def union(self,anyCollection):
+        assert pyalaocl.isCollection(anyCollection), \
+            'Any collection expected, but found %s' % anyCollection
+        added = pyalaocl.listAll(anyCollection)
+        return self._fromCounter(
+            self._countsOf(added,self.theCounter),self.theSize+len(added))
+
+    def intersection(self,anyCollection):
+        assert pyalaocl.isCollection(anyCollection), \
+            'Any collection expected, but found %s' % anyCollection
+        other = pyalaocl.Counter(pyalaocl.listAll(anyCollection))
+        return self._fromCounter(HashTrieMap.new(
+            (e,min(n,other[e])) for (e,n) in self.theCounter.iteritems()
+            if other[e] > 0))
+
+    @pyalaocl._parallelizable
+    def select(self,predicate):
+        test = pyalaocl.compilePredicate(predicate)
+        return self._fromCounter(HashTrieMap.new(
+            (e,n) for (e,n) in self.theCounter.iteritems() if test(e)))
+
+    def flatten(self):
+        return PersistentBag.new(super(PersistentBag,self).flatten())
+
+    @pyalaocl._parallelizable
+    def collectNested(self,expression):
+        return PersistentBag.new(
+            super(PersistentBag,self).collectNested(expression))
+
+
+class PersistentSeq(pyalaocl.Seq):
+    """
+    Sequence sharing its structure with the sequences it is derived from.
+
+    Examples:
+        >>> s = PersistentSeq()
+        >>> for i in range(100):
+        ...     s = s.append(i).prepend(-i)
+        >>> s.size(), s.first(), s.last(), s.at(100)
+        (200, -99, 99, 0)
+        >>> s.subSequence(100,102) == pyalaocl.Seq(0,0,1)
+        True
+        >>> PersistentSeq(1,2).including(3) == pyalaocl.Seq(1,2,3)
+        True
+    """
+    __slots__ = ()
+
+    def __init__(self,*args):
+        pyalaocl.Collection.__init__(self)
+        self.theList = Vector.new(args)
+
+    @classmethod
+    def new(cls,anyCollection=()):
+        if isinstance(anyCollection,PersistentSeq):
+            return anyCollection
+        return cls._fromList(Vector.new(pyalaocl.listAll(anyCollection)))
+
+    def emptyCollection(self):
+        return PersistentSeq.new()
+
+    def including(self,value):
+        return self.append(value)
+
+    def excluding(self,value):
+        return PersistentSeq.new(e for e in self.theList if e != value)
+
+    def includingAll(self,values):
+        return self._fromList(
+            self.theList.concat(list(pyalaocl._elementsOf(values))))
+
+    def excludingAll(self,values):
+        excluded = pyalaocl._membershipOf(values)
+        return PersistentSeq.new(
+            e for e in self.theList if e not in excluded)
+
+    @pyalaocl._parallelizable
+    def select(self,predicate):
+        test = pyalaocl.compilePredicate(predicate)
+        return PersistentSeq.new(e for e in self.theList if test(e))
+
+    def union(self,anyCollection):
+        assert pyalaocl.isCollection(anyCollection), \
+            'Any collection expected, but found %s' % anyCollection
+        return self._fromList(
+            self.theList.concat(pyalaocl.listAll(anyCollection)))
+
+    def append(self,value):
+        return self._fromList(self.theList.append(value))
+
+    def prepend(self,value):
+        return self._fromList(self.theList.prepend(value))
+
+    def subSequence(self,lower,upper):
+        return self._fromList(self.theList[lower-1:upper])
+
+    def flatten(self):
+        return PersistentSeq.new(super(PersistentSeq,self).flatten())
+
+    @pyalaocl._parallelizable
+    def collectNested(self,expression):
+        return PersistentSeq.new(
+            super(PersistentSeq,self).collectNested(expression))
+
+    @pyalaocl._parallelizable
+    def sortedBy(self,expression):
+        return PersistentSeq.new(
+            super(PersistentSeq,self).sortedBy(expression))
+
+
+#==============================================================================
+#   Selection of persistent collections
+#==============================================================================
+
+_PERSISTENT_CLASSES = {
+    pyalaocl.Set: PersistentSet,
+    pyalaocl.Bag: PersistentBag,
+    pyalaocl.Seq: PersistentSeq,
+}
+
+
+def asPersistent(collection):
+    """
+    Return a persistent collection with the same elements.
+
+    Examples:
+        >>> asPersistent(pyalaocl.Seq(1,2)).append(3) == pyalaocl.Seq(1,2,3)
+        True
+    """
+    collection = pyalaocl.asCollection(collection)
+    for (base,persistent) in _PERSISTENT_CLASSES.items():
+        if isinstance(collection,base):
+            return persistent.new(collection)
+    raise ValueError('No persistent collection for %s' % type(collection))
+
+
+def usePersistentCollections(enabled=True):
+    """
+    Select persistent collections globally. When enabled, Set, Bag and Seq
+    constructors (including Set.new, etc.) create persistent collections.
+
+    Examples:
+        >>> usePersistentCollections()
+        >>> isinstance(pyalaocl.Set(1,2),PersistentSet)
+        True
+        >>> isinstance(pyalaocl.Seq.new([1,2]).append(3),PersistentSeq)
+        True
+        >>> usePersistentCollections(False)
+        >>> isinstance(pyalaocl.Bag(1),PersistentBag)
+        False
+    """
+    for (base,persistent) in _PERSISTENT_CLASSES.items():
+        if enabled:
+            pyalaocl.COLLECTION_IMPLEMENTATIONS[base] = persistent
+        else:
+            pyalaocl.COLLECTION_IMPLEMENTATIONS.pop(base,None)
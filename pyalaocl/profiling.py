@@ -0,0 +1,332 @@
+# coding=utf-8
+"""
+The pyalaocl.profiling module measures the time spent in each OCL
+operation and in each expression, to find out which part of a validation
+is slow::
+
+    with profile() as p:
+        validateModel()
+    print p.text()
+
+While a profile is active, the public operations of GenericCollection,
+Collection, Set, Bag, Seq and OrderedSet are instrumented, and so are the
+functions returned by compileExpression and compilePredicate. For each
+operation (e.g. 'Set.select') and for each operation and expression
+(e.g. 'Set.select' with '_.isAbstract'), the profile records the number
+of calls, the cumulative time, the self time (cumulative time minus the
+time spent in other instrumented operations) and the total number of
+elements of the input and output collections.
+
+Each evaluation of an expression, by an operation or by evaluate, is
+recorded as the operation 'evaluate' with the expression. The time spent
+in expressions is therefore not part of the self time of the operations
+using them.
+
+Expressions are identified by their source for strings, and by their
+file and line (co_filename:lineno) for functions.
+
+The operations are instrumented when the profile starts and restored when
+it ends, so profiling costs nothing when it is not active.
+
+Examples:
+    >>> from pyalaocl import Set, Seq
+    >>> select = Seq.__dict__['select']
+    >>> with profile() as p:
+    ...     s = Seq(1,2,3,4).select('_ > 2').collect(lambda x:Set(x,-x))
+    >>> p.operations['Seq.select'].calls
+    1
+    >>> stats = p.operations['Seq.select']
+    >>> stats.inputSize, stats.outputSize
+    (4, 2)
+    >>> p.expressions[('Seq.select','_ > 2')].calls
+    1
+    >>> p.expressions[('evaluate','_ > 2')].calls
+    4
+    >>> 'Seq.select' in p.text()
+    True
+    >>> import json
+    >>> json.loads(p.json())['operations']['Seq.select']['calls']
+    1
+    >>> Seq.__dict__['select'] is select
+    True
+
+The self time of an expression is reported next to the self time of the
+operation evaluating it:
+
+    >>> import time
+    >>> def slow(x):
+    ...     time.sleep(0.01)
+    ...     return True
+    >>> with profile() as p:
+    ...     ok = Seq(1,2,3).forAll(slow)
+    >>> expression = p.expressions[('evaluate',_expressionKey(slow))]
+    >>> operation = p.operations['Seq.forAll']
+    >>> expression.calls, expression.selfTime > 0.025
+    (3, True)
+    >>> operation.selfTime < expression.selfTime
+    True
+"""
+
+import functools
+import inspect
+import json
+import threading
+import timeit
+
+import pyalaocl
+
+__all__ = (
+    'profile',
+    'Profile',
+    'OperationStats',
+)
+
+# Names of the first parameter of operations taking an expression
+_EXPRESSION_PARAMETERS = ('expression','predicate','body')
+
+
+class OperationStats(object):
+    """
+    Statistics of an operation or of an expression.
+    """
+    __slots__ = ('calls','cumulativeTime','selfTime','inputSize','outputSize')
+
+    def __init__(self):
+        self.calls = 0
+        self.cumulativeTime = 0.0
+        self.selfTime = 0.0
+        self.inputSize = 0
+        self.outputSize = 0
+
+    def add(self,cumulativeTime,selfTime,inputSize,outputSize):
+        self.calls += 1
+        self.cumulativeTime += cumulativeTime
+        self.selfTime += selfTime
+        self.inputSize += inputSize or 0
+        self.outputSize += outputSize or 0
+
+    def asDict(self):
+        return dict((name,getattr(self,name)) for name in self.__slots__)
+
+
+def _expressionKey(expression):
+    if isinstance(expression,basestring):
+        return expression
+    code = getattr(expression,'__code__',None)
+    if code is not None:
+        return '%s:%i' % (code.co_filename,code.co_firstlineno)
+    return getattr(expression,'__name__',repr(expression))
+
+
+def _takesExpression(function):
+    try:
+        parameters = inspect.getargspec(function).args
+    except TypeError:
+        return False
+    return len(parameters) >= 2 and parameters[1] in _EXPRESSION_PARAMETERS
+
+
+#==============================================================================
+#   Profiles
+#==============================================================================
+
+_ACTIVE = []
+_ACTIVE_LOCK = threading.Lock()
+
+
+class Profile(object):
+    """
+    Statistics collected while a profile is active. operations maps
+    operation names to OperationStats, expressions maps pairs (operation
+    name, expression key) to OperationStats.
+    """
+
+    def __init__(self):
+        self.operations = {}
+        self.expressions = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._originals = []
+
+    #---- instrumentation -----------------------------------------------------
+
+    def _classes(self):
+        return [pyalaocl.GenericCollection,pyalaocl.Collection,
+                pyalaocl.Set,pyalaocl.Bag,pyalaocl.Seq,pyalaocl.OrderedSet]
+
+    def _install(self):
+        for cls in self._classes():
+            for (name,value) in cls.__dict__.items():
+                if name.startswith('_'):
+                    continue
+                if isinstance(value,classmethod):
+                    wrapped = classmethod(self._wrap(value.__func__,name))
+                elif inspect.isfunction(value):
+                    wrapped = self._wrap(value,name)
+                else:
+                    continue
+                self._originals.append((cls,name,value))
+                setattr(cls,name,wrapped)
+        # Operations and evaluate() get their functions from the compilers:
+        # the functions returned are timed as evaluations of the expression
+        for name in ('compileExpression','compilePredicate'):
+            compiler = getattr(pyalaocl,name)
+            self._originals.append((pyalaocl,name,compiler))
+            setattr(pyalaocl,name,self._wrapCompiler(compiler))
+
+    def _uninstall(self):
+        for (owner,name,value) in reversed(self._originals):
+            setattr(owner,name,value)
+        self._originals = []
+
+    def _wrap(self,function,name):
+        # Operations are named after the class of the receiver
+        withExpression = _takesExpression(function)
+        profile = self
+
+        @functools.wraps(function)
+        def operation(receiver,*args,**kwargs):
+            owner = receiver if isinstance(receiver,type) \
+                else receiver.__class__
+            return profile._call(
+                function,'%s.%s' % (owner.__name__,name),receiver,
+                args,kwargs,withExpression)
+        return operation
+
+    def _wrapCompiler(self,compiler):
+        profile = self
+        local = self._local
+
+        @functools.wraps(compiler)
+        def wrapper(expression):
+            # compilePredicate may call compileExpression: only the
+            # outermost compiler wraps the function
+            if getattr(local,'compiling',False):
+                return compiler(expression)
+            local.compiling = True
+            try:
+                function = compiler(expression)
+            finally:
+                local.compiling = False
+            key = _expressionKey(expression)
+
+            def evaluation(value):
+                return profile._call(
+                    function,'evaluate',value,(),{},False,
+                    measure=False,expression=key)
+            return evaluation
+        return wrapper
+
+    #---- measures ------------------------------------------------------------
+
+    def _sizeOf(self,value):
+        if isinstance(value,pyalaocl.GenericCollection):
+            # size() is itself instrumented
+            self._local.paused = True
+            try:
+                return len(value)
+            finally:
+                self._local.paused = False
+        return None
+
+    def _call(self,function,name,receiver,args,kwargs,withExpression,
+              measure=True,expression=None):
+        local = self._local
+        if getattr(local,'paused',False):
+            return function(receiver,*args,**kwargs)
+        if not hasattr(local,'stack'):
+            local.stack = []
+        stack = local.stack
+        inputSize = self._sizeOf(receiver) if measure else None
+        stack.append(0.0)
+        timer = timeit.default_timer
+        start = timer()
+        result = None
+        try:
+            result = function(receiver,*args,**kwargs)
+            return result
+        finally:
+            elapsed = timer() - start
+            children = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            outputSize = self._sizeOf(result) if measure else None
+            if withExpression and args:
+                expression = _expressionKey(args[0])
+            self._record(name,expression,elapsed,elapsed-children,
+                         inputSize,outputSize)
+
+    def _record(self,name,expression,cumulativeTime,selfTime,
+                inputSize,outputSize):
+        with self._lock:
+            keys = [(self.operations,name)]
+            if expression is not None:
+                keys.append((self.expressions,(name,expression)))
+            for (table,key) in keys:
+                if key not in table:
+                    table[key] = OperationStats()
+                table[key].add(cumulativeTime,selfTime,inputSize,outputSize)
+
+    #---- context manager -----------------------------------------------------
+
+    def __enter__(self):
+        with _ACTIVE_LOCK:
+            if _ACTIVE:
+                raise pyalaocl.Invalid('A profile is already active.')
+            _ACTIVE.append(self)
+            self._install()
+        return self
+
+    def __exit__(self,excType,excValue,traceback):
+        with _ACTIVE_LOCK:
+            self._uninstall()
+            _ACTIVE.remove(self)
+        return False
+
+    #---- reports -------------------------------------------------------------
+
+    def asDict(self):
+        """
+        Return the statistics as a dictionary with two entries, operations
+        and expressions. Expressions are listed with their operation.
+        """
+        return {
+            'operations': dict(
+                (name,stats.asDict())
+                for (name,stats) in self.operations.items()),
+            'expressions': [
+                dict(stats.asDict(),operation=name,expression=expression)
+                for ((name,expression),stats) in self.expressions.items()],
+        }
+
+    def json(self,indent=1):
+        """ Return the statistics in JSON. See asDict. """
+        return json.dumps(self.asDict(),indent=indent,sort_keys=True)
+
+    def text(self,limit=30,sortBy='selfTime'):
+        """
+        Return a textual report of the operations and of the expressions,
+        the most expensive first.
+        """
+        def rows(items):
+            items = sorted(items,key=lambda (k,s):getattr(s,sortBy),
+                           reverse=True)[:limit]
+            return ['%8i %10.4f %10.4f %10i %10i  %s' % (
+                s.calls,s.cumulativeTime,s.selfTime,s.inputSize,
+                s.outputSize,k) for (k,s) in items]
+        header = '%8s %10s %10s %10s %10s  %s' % (
+            'calls','cumul(s)','self(s)','in','out','%s')
+        lines = [header % 'operation']
+        lines += rows(self.operations.items())
+        lines += ['',header % 'operation / expression']
+        lines += rows(('%s / %s' % key,s)
+                      for (key,s) in self.expressions.items())
+        return '\n'.join(lines)
+
+
+def profile():
+    """
+    Return a new Profile to be used as a context manager. Only one profile
+    can be active at a time.
+    """
+    return Profile()
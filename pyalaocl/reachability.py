@@ -0,0 +1,264 @@
+# coding=utf-8
+"""
+The pyalaocl.reachability module provides an index to answer repeated
+closure queries on the same relation, for instance closure('general') or
+closure('owner') evaluated on each element of a model.
+
+The strongly connected components of the graph defined by the relation are
+computed once (Tarjan algorithm). Queries like closure(x), reaches(x,y) or
+ancestors(y) are then answered from the condensed graph of components,
+which is acyclic. The components reachable from a queried element are
+memoized.
+
+The index is extended on demand when an element not yet indexed is
+queried. When the relation changes the index must be invalidated, either
+with the invalidate() method or, for all indexes at once, with the
+invalidateAllIndexes() function.
+"""
+
+import weakref
+
+import pyalaocl
+
+__all__ = (
+    'ReachabilityIndex',
+    'invalidateAllIndexes',
+)
+
+
+_INDEXES = weakref.WeakKeyDictionary()
+
+
+def invalidateAllIndexes():
+    """
+    Invalidate all existing reachability indexes. This function is
+    intended to be called when the model changes.
+    """
+    for index in list(_INDEXES.keys()):
+        index.invalidate()
+
+
+class ReachabilityIndex(object):
+    """
+    Index of the transitive closure of a relation.
+
+    The relation is given by an expression, as for the closure operation.
+    It is evaluated only once per element. Elements must be hashable.
+    As with the closure operation, an element is always considered as
+    reachable from itself.
+
+    Examples:
+        >>> successors = {1:[2], 2:[1, 3], 3:[4], 4:[], 5:[3]}
+        >>> index = ReachabilityIndex([1,5],lambda x:successors[x])
+        >>> index.closure(1) == pyalaocl.Set(1,2,3,4)
+        True
+        >>> index.closure(5) == pyalaocl.Set(5,3,4)
+        True
+        >>> index.reaches(2,4), index.reaches(4,2), index.reaches(4,4)
+        (True, False, True)
+        >>> index.ancestors(3) == pyalaocl.Set(1,2,3,5)
+        True
+        >>> index.sameComponent(1,2), index.sameComponent(1,3)
+        (True, False)
+        >>> successors[4] = [1]
+        >>> index.invalidate()
+        >>> index.reaches(4,2)
+        True
+    """
+
+    def __init__(self,elements=None,expression=None):
+        """
+        Create an index for the relation defined by the expression.
+
+        :param elements: The elements to index first. Other elements are
+            indexed when queried.
+        :type elements: collection|NoneType
+        :param expression: The relation as a function or a string
+            expression returning an element, a collection or None.
+        :type expression: X->X|X->collection[X]|str
+        """
+        self.elements = elements
+        self.expression = expression
+        self.function = pyalaocl.compileExpression(expression)
+        self.invalidate()
+        _INDEXES[self] = True
+
+    def invalidate(self):
+        """
+        Forget everything computed so far. Must be called when the relation
+        changes.
+        """
+        self._built = False
+        self._successors = {}
+        self._dfsIndex = {}
+        self._lowLink = {}
+        self._componentOf = {}
+        self._components = []
+        self._dag = []
+        self._reverseDag = None
+        self._reach = {}
+        self._reachedBy = {}
+
+    #---- queries -------------------------------------------------------------
+
+    def closure(self,element):
+        """
+        Return the Set of all elements reachable from the given element,
+        including the element itself.
+        """
+        return self._membersOf(self._reachable(self._component(element)))
+
+    def reaches(self,element1,element2):
+        """
+        Return True if element2 is reachable from element1.
+        """
+        return (self._component(element2)
+                in self._reachable(self._component(element1)))
+
+    def ancestors(self,element):
+        """
+        Return the Set of all indexed elements from which the given element
+        is reachable, including the element itself.
+        """
+        return self._membersOf(self._reachingBy(self._component(element)))
+
+    def sameComponent(self,element1,element2):
+        """
+        Return True if both elements are reachable from each other.
+        """
+        return self._component(element1) == self._component(element2)
+
+    def components(self):
+        """
+        Return the strongly connected components of the indexed elements.
+
+        :rtype: Seq[Set]
+        """
+        self._build()
+        return pyalaocl.Seq.new(
+            [pyalaocl.Set.new(members) for members in self._components])
+
+    #---- implementation ------------------------------------------------------
+
+    def _build(self):
+        if not self._built:
+            self._built = True
+            if self.elements is not None:
+                for element in self.elements:
+                    if element not in self._dfsIndex:
+                        self._strongConnect(element)
+
+    def _component(self,element):
+        self._build()
+        if element not in self._componentOf:
+            self._strongConnect(element)
+        return self._componentOf[element]
+
+    def _membersOf(self,componentIds):
+        members = []
+        for c in componentIds:
+            members.extend(self._components[c])
+        return pyalaocl.Set.new(members)
+
+    def _successorsOf(self,element):
+        try:
+            return self._successors[element]
+        except KeyError:
+            result = self.function(element)
+            if result is None:
+                successors = []
+            elif pyalaocl.isCollection(result):
+                successors = [s for s in result if s is not None]
+            else:
+                successors = [result]
+            self._successors[element] = successors
+            return successors
+
+    def _number(self,element,stack,onStack):
+        n = len(self._dfsIndex)
+        self._dfsIndex[element] = n
+        self._lowLink[element] = n
+        stack.append(element)
+        onStack.add(element)
+
+    def _strongConnect(self,root):
+        # Iterative version of Tarjan algorithm. Elements already in a
+        # component are never on the stack, so the index can be extended
+        # with new roots at any time. Components are found in reverse
+        # topological order: successors of a component in the condensed
+        # graph always have a smaller component id.
+        dfsIndex = self._dfsIndex
+        lowLink = self._lowLink
+        stack = []
+        onStack = set()
+        self._number(root,stack,onStack)
+        work = [(root,iter(self._successorsOf(root)))]
+        while work:
+            (element,successors) = work[-1]
+            for s in successors:
+                if s not in dfsIndex:
+                    self._number(s,stack,onStack)
+                    work.append((s,iter(self._successorsOf(s))))
+                    break
+                elif s in onStack:
+                    lowLink[element] = min(lowLink[element],dfsIndex[s])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowLink[parent] = min(lowLink[parent],lowLink[element])
+                if lowLink[element] == dfsIndex[element]:
+                    self._addComponent(element,stack,onStack)
+
+    def _addComponent(self,element,stack,onStack):
+        c = len(self._components)
+        members = []
+        while True:
+            member = stack.pop()
+            onStack.discard(member)
+            members.append(member)
+            self._componentOf[member] = c
+            if member is element:
+                break
+        self._components.append(members)
+        successors = set()
+        for member in members:
+            for s in self._successorsOf(member):
+                successors.add(self._componentOf[s])
+        successors.discard(c)
+        self._dag.append(successors)
+        # the reverse graph is recomputed on demand
+        self._reverseDag = None
+        self._reachedBy = {}
+
+    def _reachable(self,c):
+        return self._memoized(c,self._dag,self._reach)
+
+    def _reachingBy(self,c):
+        if self._reverseDag is None:
+            self._reverseDag = [set() for _ in self._components]
+            for (source,targets) in enumerate(self._dag):
+                for target in targets:
+                    self._reverseDag[target].add(source)
+        return self._memoized(c,self._reverseDag,self._reachedBy)
+
+    @staticmethod
+    def _memoized(c,graph,memo):
+        # Depth first search in the (acyclic) graph of components. Only the
+        # results of queried components are memoized, but they are reused
+        # by later searches.
+        if c in memo:
+            return memo[c]
+        reached = set([c])
+        toVisit = [c]
+        while toVisit:
+            current = toVisit.pop()
+            for d in graph[current]:
+                if d not in reached:
+                    if d in memo:
+                        reached.update(memo[d])
+                    else:
+                        reached.add(d)
+                        toVisit.append(d)
+        memo[c] = frozenset(reached)
+        return memo[c]
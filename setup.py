@@ -77,9 +77,14 @@ setup(
         'pyalaocl.modelio'],
 
     install_requires=getRequirements(),
-    # extras_require={
-    #    'testing': ['pytest'],
-    # }
+    entry_points={
+        'console_scripts': [
+            'pyalaocl-benchmarks = pyalaocl.benchmarks:main',
+        ],
+    },
+    extras_require={
+        'numeric': ['numpy'],
+    },
     # include_package_data=True,
 
 